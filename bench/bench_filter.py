@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Content filter benchmark
+
+Checks status lines against banned word lists of growing size, once with
+the legacy loop running a find() per word and once with the Aho-Corasick
+matcher from utils/content_filter.py, and reports the time per line and
+how long building the matcher took.
+
+    python bench/bench_filter.py
+    python bench/bench_filter.py --words 10 1000 10000 --hit-rate 0.1
+"""
+import argparse
+import random
+import string
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+from content_filter import ContentFilter  # noqa: E402
+
+WORD_COUNTS = [2, 100, 1000, 10000]
+STATUSES = ['open', 'closed', 'varattu', 'auki', 'reserved']
+EXTRAS = ['pelit', 'lautapelit ja pizzaa', 'Smash-turnaus klo 18',
+          'siivous', 'hallituksen kokous', '']
+
+
+def random_word(rng, length):
+    return ''.join(rng.choice(string.ascii_uppercase) for _ in range(length))
+
+
+def make_lines(rng, words, count, hit_rate):
+    '''Status lines like the ones users send, some containing a word'''
+    lines = []
+    for _ in range(count):
+        line = '{} {}'.format(rng.choice(STATUSES), rng.choice(EXTRAS))
+        if rng.random() < hit_rate:
+            line += ' ' + rng.choice(words).lower()
+        lines.append(line.strip())
+    return lines
+
+
+def legacy_check(words, line):
+    '''What legacy/sopel-modules/cortana.py did for every status change'''
+    for banned in words:
+        if line.upper().find(banned) != -1:
+            return True
+    return False
+
+
+def measure(call, lines, duration):
+    '''Microseconds per line, running over lines for about duration'''
+    clock = time.perf_counter
+    calls = 0
+    start = clock()
+    deadline = start + duration
+    while True:
+        for line in lines:
+            call(line)
+        calls += len(lines)
+        end = clock()
+        if end > deadline:
+            break
+    return (end - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--words', type=int, nargs='+', default=WORD_COUNTS,
+                        help='Banned list sizes to run')
+    parser.add_argument('--lines', type=int, default=1000,
+                        help='Distinct lines to check')
+    parser.add_argument('--hit-rate', type=float, default=0.05,
+                        help='Share of lines containing a banned word')
+    parser.add_argument('--duration', type=float, default=0.5,
+                        help='Seconds per measurement')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print('{:>8} {:>10} {:>12} {:>12} {:>8}'.format(
+        'words', 'build ms', 'legacy us', 'filter us', 'speedup'))
+    for count in args.words:
+        words = [random_word(rng, rng.randint(4, 10)) for _ in range(count)]
+        lines = make_lines(rng, words, args.lines, args.hit_rate)
+
+        start = time.perf_counter()
+        content_filter = ContentFilter(words)
+        build = (time.perf_counter() - start) * 1000
+
+        # Both have to agree before their speed means anything
+        for line in lines:
+            assert legacy_check(words, line) == \
+                (content_filter.check(None, line) is not None), line
+
+        legacy = measure(lambda line: legacy_check(words, line), lines,
+                         args.duration)
+        matcher = measure(lambda line: content_filter.check('bench', line),
+                          lines, args.duration)
+        print('{:>8} {:>10.1f} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+            count, build, legacy, matcher, legacy / matcher))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Handler micro-benchmarks
+
+Runs the cortana plugin entry points against a fake in-process bot for a
+range of channel counts and reports throughput and latency percentiles.
+
+    python bench/bench_handlers.py
+    python bench/bench_handlers.py --save bench/baselines/pi.json
+    python bench/bench_handlers.py --compare bench/baselines/pi.json
+
+With --compare the exit status is 1 if any benchmark got slower than the
+baseline by more than --tolerance.
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fakebot import FakeBot, cortana, make_trigger, prime
+
+CHANNEL_COUNTS = [1, 10, 100, 1000]
+STATUSES = ['open', 'closed', 'varattu pelit', 'auki', 'kiinni']
+
+
+def bench_irc_commands(bot, channels):
+    triggers = [make_trigger(bot, cortana.handle_irc_commands,
+                             'Cortana: {}'.format(status), channel)
+                for channel, status in zip(channels, cycle(STATUSES))]
+    return lambda i: cortana.handle_irc_commands(
+        bot, triggers[i % len(triggers)])
+
+
+def bench_teleirc_commands(bot, channels):
+    triggers = [make_trigger(bot, cortana.handle_teleirc_commands,
+                             '<tg_user> Cortana: {}'.format(status), channel)
+                for channel, status in zip(channels, cycle(STATUSES))]
+    return lambda i: cortana.handle_teleirc_commands(
+        bot, triggers[i % len(triggers)])
+
+
+def bench_teleirc_chatter(bot, channels):
+    '''Bridged lines not addressed to us, the common case'''
+    triggers = [make_trigger(bot, cortana.handle_teleirc_commands,
+                             '<tg_user> Cortana is a nice bot', channel)
+                for channel in channels]
+    return lambda i: cortana.handle_teleirc_commands(
+        bot, triggers[i % len(triggers)])
+
+
+def bench_topic(bot, channels):
+    triggers = [make_trigger(
+        bot, cortana.handle_topic, 'JMT11CD: {} | bench'.format(status),
+        channel, args=('Cortana', channel,
+                       'JMT11CD: {} | bench'.format(status)),
+        event=cortana.events.RPL_TOPIC)
+        for channel, status in zip(channels, cycle(['open', 'closed']))]
+    return lambda i: cortana.handle_topic(bot, triggers[i % len(triggers)])
+
+
+def bench_update_status(bot, channels):
+    return lambda i: cortana.update_clubroom_status(
+        bot, channels[i % len(channels)], STATUSES[i % len(STATUSES)], None,
+        'bench')
+
+
+def bench_presence_event(bot, channels):
+    names = [cortana.presence_path(bot, channel).name for channel in channels]
+    return lambda i: cortana.handle_presence_event(
+        bot, names[i % len(names)], bool(i // len(names) % 2))
+
+
+def bench_presence_sweep(bot, channels):
+    '''Full pass over every channel, what the old 5 s timer did'''
+    return lambda i: cortana.sync_presence_all(bot)
+
+
+BENCHMARKS = {
+    'handle_irc_commands': bench_irc_commands,
+    'handle_teleirc_commands': bench_teleirc_commands,
+    'handle_teleirc_chatter': bench_teleirc_chatter,
+    'handle_topic': bench_topic,
+    'update_clubroom_status': bench_update_status,
+    'handle_presence_event': bench_presence_event,
+    'sync_presence_all': bench_presence_sweep,
+}
+
+
+def cycle(items):
+    while True:
+        yield from items
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run(name, channel_count, duration, presence_dir):
+    '''Run one benchmark for about duration seconds, returns the results'''
+    channels = ['#bench{}'.format(number) for number in range(channel_count)]
+    with FakeBot(channels) as bot:
+        return measure(bot, name, channels, duration, presence_dir)
+
+
+def measure(bot, name, channels, duration, presence_dir):
+    '''Time calls of benchmark name on bot'''
+    prime(bot, presence_dir)
+    call = BENCHMARKS[name](bot, channels)
+
+    # Warm up caches and the presence files
+    for i in range(min(100, len(channels) * 2)):
+        call(i)
+
+    samples = []
+    clock = time.perf_counter_ns
+    deadline = clock() + int(duration * 1e9)
+    i = 0
+    while True:
+        start = clock()
+        call(i)
+        end = clock()
+        samples.append(end - start)
+        i += 1
+        if end > deadline:
+            break
+        # Keep the recorder from growing without bounds
+        if len(bot.written) > 10000:
+            bot.written.clear()
+
+    samples.sort()
+    return {
+        'calls': len(samples),
+        'ops': len(samples) / (sum(samples) / 1e9),
+        'p50_us': percentile(samples, 0.50) / 1e3,
+        'p90_us': percentile(samples, 0.90) / 1e3,
+        'p99_us': percentile(samples, 0.99) / 1e3,
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''Print regressions against baseline, returns True if there were any'''
+    regressed = False
+    for name, counts in results.items():
+        for count, result in counts.items():
+            old = baseline.get(name, {}).get(count)
+            if old is None:
+                continue
+            change = result['p50_us'] / old['p50_us'] - 1
+            if change > tolerance:
+                regressed = True
+                print('REGRESSION {} @ {} channels: p50 {:.1f}us -> {:.1f}us '
+                      '({:+.0%})'.format(name, count, old['p50_us'],
+                                         result['p50_us'], change))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--channels', type=int, nargs='+',
+                        default=CHANNEL_COUNTS, help='Channel counts to run')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS),
+                        help='Run only these benchmarks')
+    parser.add_argument('--duration', type=float, default=0.5,
+                        help='Seconds per benchmark and channel count')
+    parser.add_argument('--save', type=Path, help='Save results as baseline')
+    parser.add_argument('--compare', type=Path, help='Baseline to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed p50 slowdown before failing')
+    args = parser.parse_args()
+
+    results = {}
+    print('{:<26} {:>8} {:>12} {:>10} {:>10} {:>10}'.format(
+        'benchmark', 'channels', 'ops/s', 'p50 us', 'p90 us', 'p99 us'))
+    with tempfile.TemporaryDirectory(prefix='cortana-bench-') as presence_dir:
+        for name in args.only or BENCHMARKS:
+            for count in args.channels:
+                result = run(name, count, args.duration, presence_dir)
+                results.setdefault(name, {})[str(count)] = result
+                print('{:<26} {:>8} {:>12,.0f} {:>10.1f} {:>10.1f} '
+                      '{:>10.1f}'.format(name, count, result['ops'],
+                                         result['p50_us'], result['p90_us'],
+                                         result['p99_us']))
+
+    if args.save:
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        args.save.write_text(json.dumps(results, indent=2, sort_keys=True))
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
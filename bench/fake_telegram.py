@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Fake Telegram Bot API
+
+Serves getUpdates (with long polling) and sendMessage from memory, so the
+Telegram bot can be run and measured without touching Telegram.
+
+    python bench/fake_telegram.py --messages 20 --chats 4 --who
+
+runs utils/telegram_bot.py in-process against it, sends status queries and
+presence changes and reports reply latency and how many requests the bot
+made. With --serve it only runs the server, for pointing TELEGRAM_API_URL
+at.
+"""
+import argparse
+import asyncio
+import itertools
+import sys
+import time
+from pathlib import Path
+
+from aiohttp import web
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'utils'))
+import telegram_bot  # noqa: E402
+import wordlists  # noqa: E402
+
+CHAT = {'id': -1001, 'title': 'Polygame', 'type': 'supergroup'}
+USER = {'id': 42, 'is_bot': False, 'first_name': 'Bench'}
+STATUS_LINES = set(wordlists.STATUS_OPEN + wordlists.STATUS_CLOSED)
+
+
+class FakeTelegram:
+    '''In-memory Bot API, messages from users are added with inject()'''
+
+    def __init__(self, chat_interval: float = 0.0):
+        # Answer 429 to sends closer than this to the last one in a chat
+        self.chat_interval = chat_interval
+        self.last_send = {}
+        self.throttled = 0
+        self.updates = []
+        self.sent = []
+        self.requests = {}
+        self._ids = itertools.count(1)
+        self._changed = asyncio.Condition()
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self._handle)
+
+    async def start(self, port: int = 0) -> int:
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', port)
+        await site.start()
+        return self.runner.addresses[0][1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def inject(self, text: str, chat: dict = CHAT):
+        '''Add a message from a user, returns its update_id'''
+        update_id = next(self._ids)
+        message = {'message_id': update_id, 'date': int(time.time()),
+                   'chat': chat, 'from': USER, 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                    'length': len(text.split()[0])}]
+        self.updates.append({'update_id': update_id, 'message': message})
+        async with self._changed:
+            self._changed.notify_all()
+        return update_id
+
+    async def _handle(self, request):
+        method = request.match_info['method']
+        self.requests[method] = self.requests.get(method, 0) + 1
+        params = await request.json() if request.can_read_body else {}
+        if method == 'getUpdates':
+            result = await self._get_updates(params)
+        elif method == 'sendMessage':
+            now = time.monotonic()
+            last = self.last_send.get(params['chat_id'], float('-inf'))
+            if now - last < self.chat_interval:
+                self.throttled += 1
+                return web.json_response({
+                    'ok': False, 'error_code': 429,
+                    'description': 'Too Many Requests: retry after 1',
+                    'parameters': {'retry_after': 1}})
+            self.last_send[params['chat_id']] = now
+            self.sent.append((time.monotonic(), params['chat_id'],
+                              params['text']))
+            result = {'message_id': next(self._ids), 'chat': CHAT,
+                      'date': int(time.time()), 'text': params['text']}
+        else:
+            return web.json_response(
+                {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = params.get('offset') or 0
+        # Confirmed updates are forgotten, like Telegram does
+        self.updates = [update for update in self.updates
+                        if update['update_id'] >= offset]
+        if not self.updates and params.get('timeout'):
+            async with self._changed:
+                try:
+                    await asyncio.wait_for(self._changed.wait(),
+                                           params['timeout'])
+                except asyncio.TimeoutError:
+                    pass
+        return list(self.updates)
+
+
+def chat(number: int) -> dict:
+    if not number:
+        return CHAT
+    return {'id': CHAT['id'] - number, 'title': 'Chat {}'.format(number),
+            'type': 'group'}
+
+
+async def bench(args):
+    server = FakeTelegram(args.chat_interval)
+    port = await server.start()
+    bot = telegram_bot.TelegramBot(
+        'TOKEN', api_url='http://127.0.0.1:{}'.format(port),
+        chat_title=CHAT['title'])
+    async with bot:
+        poller = asyncio.ensure_future(bot.run())
+        latencies = []
+        started = time.monotonic()
+        for number in range(args.messages):
+            if number % 10 == 5:
+                # Presence change pushed to the bot, announced to the chat
+                bot.set_presence(not bot.present)
+            sent_before = len(server.sent)
+            at = time.monotonic()
+            target = chat(number % args.chats)
+            await server.inject('cortana status', target)
+            if args.who:
+                await server.inject('cortana who are you?', target)
+            reply = None
+            while reply is None:
+                await asyncio.sleep(0.001)
+                reply = next((sent_at for sent_at, chat_id, text
+                              in server.sent[sent_before:]
+                              if chat_id == target['id'] and
+                              STATUS_LINES.intersection(text.split('\n'))),
+                             None)
+            latencies.append(reply - at)
+            await asyncio.sleep(args.interval)
+        elapsed = time.monotonic() - started
+        await bot.outbox.close()
+        poller.cancel()
+        await asyncio.gather(poller, return_exceptions=True)
+    await server.stop()
+
+    latencies.sort()
+    print('messages:   {} in {:.1f}s'.format(args.messages, elapsed))
+    print('requests:   {}'.format(', '.join(
+        '{} {}'.format(method, count)
+        for method, count in sorted(server.requests.items()))))
+    print('delivered:  {} messages, {} answered 429'.format(
+        len(server.sent), server.throttled))
+    print('legacy bot: about {} getUpdates at one per 0.5 s'.format(
+        int(elapsed / 0.5)))
+    print('reply ms:   p50 {:.1f}  p90 {:.1f}  max {:.1f}'.format(
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.9)] * 1000, latencies[-1] * 1000))
+
+
+async def serve(port: int):
+    server = FakeTelegram()
+    port = await server.start(port)
+    print('Fake Bot API on http://127.0.0.1:{}'.format(port))
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=50,
+                        help='Status queries to send')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='Seconds between queries')
+    parser.add_argument('--chats', type=int, default=1,
+                        help='Spread queries over this many chats')
+    parser.add_argument('--who', action='store_true',
+                        help='Also ask who the bot is after every query')
+    parser.add_argument('--chat-interval', type=float, default=0.0,
+                        help='Answer 429 to sends to a chat closer than this')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='Only run the fake API on PORT')
+    args = parser.parse_args()
+    if args.serve is not None:
+        asyncio.run(serve(args.serve))
+    else:
+        asyncio.run(bench(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Fake Sopel bot
+
+Just enough of Sopel's bot and trigger objects to call the cortana plugin
+handlers in-process, without a network connection or background workers.
+"""
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+from sopel.config import Config
+from sopel.tools import (SopelMemory, compile_rule,
+                         get_nickname_command_regexp)
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO / 'modules'))
+
+import cortana  # noqa: E402
+
+CONFIG_TEMPLATE = '''[core]
+nick = {nick}
+host = localhost
+owner = bench
+homedir = {homedir}
+channels = {channels}
+
+[cortana]
+'''
+
+
+class FakeChannel:
+    def __init__(self, topic=''):
+        self.topic = topic
+
+
+class FakeBot:
+    '''Stand-in for sopel.bot.Sopel recording everything written
+
+    Without a homedir one is made in a temporary directory, removed by
+    close() or when used as a context manager.
+    '''
+
+    def __init__(self, channels, nick='Cortana', homedir=None):
+        self._tempdir = None
+        if homedir is None:
+            self._tempdir = tempfile.TemporaryDirectory(
+                prefix='cortana-bench-')
+            homedir = self._tempdir.name
+        self.homedir = Path(homedir)
+        config_path = self.homedir / 'default.cfg'
+        config_path.write_text(CONFIG_TEMPLATE.format(
+            nick=nick, homedir=self.homedir, channels=','.join(channels)))
+        self.config = Config(str(config_path))
+        self.config.define_section('cortana', cortana.CortanaSection)
+        self.nick = nick
+        self.memory = SopelMemory()
+        self.channels = {channel: FakeChannel('JMT11CD: closed | bench')
+                         for channel in channels}
+        self.written = []
+        self.said = []
+
+    def close(self):
+        if self._tempdir is not None:
+            self._tempdir.cleanup()
+            self._tempdir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, args, text=None):
+        self.written.append((args, text))
+
+    def say(self, text, recipient=None, max_messages=1):
+        self.said.append((recipient, text))
+
+    def reply(self, text, dest=None, reply_to=None, notice=False):
+        self.said.append((dest, text))
+
+
+class FakeTrigger:
+    '''Stand-in for sopel.trigger.Trigger built from a real rule match'''
+
+    def __init__(self, match, sender, nick='bench', args=(), event='PRIVMSG'):
+        self.match = match
+        self.sender = sender
+        self.nick = nick
+        self.args = list(args)
+        self.event = event
+
+    def group(self, *groups):
+        return self.match.group(*groups)
+
+    def groups(self):
+        return self.match.groups()
+
+
+def make_trigger(bot, handler, line, sender, args=(), event='PRIVMSG'):
+    '''Match line against the rules Sopel would use for handler'''
+    for rule in rules_for(handler, bot.config):
+        match = rule.match(line)
+        if match:
+            return FakeTrigger(match, sender, args=args, event=event)
+    raise ValueError('{!r} does not trigger {}'.format(line, handler.__name__))
+
+
+def rules_for(handler, config):
+    '''Compile handler rules the way sopel.loader.clean_callable does'''
+    rules = [compile_rule(config.core.nick, rule, config.core.alias_nicks)
+             for rule in getattr(handler, 'rule', [])]
+    for command in getattr(handler, 'nickname_commands', []):
+        rules.append(get_nickname_command_regexp(
+            config.core.nick, command, config.core.alias_nicks))
+    return rules
+
+
+def prime(bot, presence_dir):
+    '''Set up plugin state without starting any background workers'''
+    bot.memory['presence_file'] = str(
+        Path(presence_dir) / 'cortana.presence.{}')
+    bot.memory['clubroom_status'] = SopelMemory()
+    bot.memory['reconciling'] = {}
+    bot.memory['content_filter'] = cortana.ContentFilter(
+        bot.config.cortana.banned_words, bot.config.cortana.banned_users)
+    # Benchmarks fire commands far faster than anyone is allowed to
+    bot.memory['nick_limiter'] = cortana.RateLimiter(1e9, 1e9)
+    bot.memory['channel_limiter'] = cortana.RateLimiter(1e9, 1e9)
+    for channel in bot.config.core.channels:
+        bot.memory['clubroom_status'][channel] = cortana.ChannelState()
+    bot.memory['status_dirty'] = set(bot.memory['clubroom_status'])
+    bot.memory['status_published'] = {}
+    bot.memory['status_lock'] = threading.Lock()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+End-to-end load harness
+
+Runs the real Sopel bot with only the cortana module loaded against a
+minimal local IRC server, replays synthetic traffic at a fixed rate and
+measures how long each state change takes to show up as a TOPIC write and
+how many TOPIC writes each state change costs.
+
+    python bench/load_harness.py --rate 5 --duration 30 --channels 2
+    python bench/load_harness.py --mix irc=1 button=3 --min-interval 0
+
+Sopel refuses to run as root through its launcher, so the bot is started
+in-process instead.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from pathlib import Path
+
+from sopel.bot import Sopel
+from sopel.config import Config
+
+REPO = Path(__file__).resolve().parent.parent
+SERVER = 'irc.emulator'
+STATUS_PREFIX = 'JMT11CD: '
+
+CONFIG_TEMPLATE = '''[core]
+nick = Cortana
+user = cortana
+host = 127.0.0.1
+port = {port}
+owner = harness
+channels = {channels}
+enable = cortana
+extra = {modules}
+homedir = {homedir}
+logdir = {homedir}/logs
+pid_dir = {homedir}
+timeout = 120
+
+[cortana]
+topic_debounce = {debounce}
+topic_min_interval = {min_interval}
+presence_file = {homedir}/cortana.presence.{{}}
+ipc_socket = {homedir}/cortana.sopel.sock
+gpio_socket = {homedir}/cortana.gpio.sock
+# The harness is a flood by design, measure the topic writes instead
+nick_rate = 1e9
+nick_burst = 1000000
+channel_rate = 1e9
+channel_burst = 1000000
+'''
+
+
+class IRCEmulator:
+    '''Just enough of an IRC server for a single Sopel client
+
+    Answers registration, JOIN with RPL_TOPIC/RPL_NOTOPIC, TOPIC queries
+    and changes (echoed back like a real server) and PING. Every TOPIC
+    write from the bot is recorded with a timestamp.
+    '''
+
+    def __init__(self, initial_topic='JMT11CD: closed | Load test'):
+        self.initial_topic = initial_topic
+        self.topics = {}
+        self.topic_writes = []
+        self.joined = {}
+        self.nick = None
+        self.writer = None
+        self.ready = asyncio.Event()
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self._client, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    def send(self, line):
+        if self.writer is not None:
+            self.writer.write((line + '\r\n').encode('utf-8'))
+
+    def inject(self, source, channel, text):
+        '''Deliver a PRIVMSG from another user to the bot'''
+        self.send(':{0}!{0}@users PRIVMSG {1} :{2}'.format(
+            source, channel, text))
+
+    def _numeric(self, number, *params):
+        self.send(':{} {} {} {}'.format(SERVER, number, self.nick,
+                                        ' '.join(params)))
+
+    def _send_topic(self, channel):
+        topic = self.topics.get(channel)
+        if topic:
+            self._numeric('332', channel, ':' + topic)
+        else:
+            self._numeric('331', channel, ':No topic is set')
+
+    async def _client(self, reader, writer):
+        self.writer = writer
+        while True:
+            data = await reader.readline()
+            if not data:
+                break
+            line = data.decode('utf-8', 'replace').rstrip('\r\n')
+            self._handle(line)
+            if writer.is_closing():
+                break
+            await writer.drain()
+        self.writer = None
+
+    def _handle(self, line):
+        params, _, trailing = line.partition(' :')
+        params = params.split()
+        if not params:
+            return
+        command = params[0].upper()
+        if command == 'CAP' and params[1:2] == ['LS']:
+            self.send(':{} CAP * LS :'.format(SERVER))
+        elif command == 'CAP' and params[1:2] == ['REQ']:
+            self.send(':{} CAP * NAK :{}'.format(SERVER, trailing))
+        elif command == 'NICK':
+            self.nick = params[1] if len(params) > 1 else trailing
+        elif command == 'USER':
+            self._numeric('001', ':Welcome to the emulator')
+            self._numeric('376', ':End of MOTD')
+        elif command == 'PING':
+            self.send(':{} PONG {} :{}'.format(
+                SERVER, SERVER, trailing or params[-1]))
+        elif command == 'JOIN':
+            for channel in params[1].split(','):
+                self.topics.setdefault(channel, self.initial_topic)
+                self.send(':{0}!cortana@bot JOIN {1}'.format(
+                    self.nick, channel))
+                self._send_topic(channel)
+                self._numeric('353', '=', channel, ':@' + self.nick)
+                self._numeric('366', channel, ':End of NAMES list')
+                self.joined[channel] = time.monotonic()
+            self.ready.set()
+        elif command == 'WHO':
+            self._numeric('315', params[1], ':End of WHO list')
+        elif command == 'TOPIC':
+            channel = params[1]
+            if len(params) == 2 and not trailing and ' :' not in line:
+                self._send_topic(channel)
+                return
+            self.topic_writes.append((time.monotonic(), channel, trailing))
+            self.topics[channel] = trailing
+            self.send(':{0}!cortana@bot TOPIC {1} :{2}'.format(
+                self.nick, channel, trailing))
+        elif command == 'QUIT':
+            if self.writer is not None:
+                self.writer.close()
+
+
+def topic_state(topic):
+    '''Whether a topic says the clubroom is open'''
+    return not topic.startswith(STATUS_PREFIX + 'closed')
+
+
+def analyse(events, topic_writes, end):
+    '''Match state changes to the TOPIC writes that published them'''
+    latencies = []
+    superseded = missed = 0
+    by_channel = {}
+    for event in events:
+        by_channel.setdefault(event[1], []).append(event)
+    final = {}
+    for _, channel, topic in topic_writes:
+        final[channel] = topic_state(topic)
+    for channel, channel_events in by_channel.items():
+        writes = [(at, topic_state(topic)) for at, name, topic in topic_writes
+                  if name == channel]
+        for number, (at, _, state, _) in enumerate(channel_events):
+            following = channel_events[number + 1][0] \
+                if number + 1 < len(channel_events) else end
+            published = next((write_at for write_at, write_state in writes
+                              if write_at >= at and write_state == state),
+                             None)
+            if published is None:
+                # Nothing to write if the change was undone before the
+                # write went out, unless it was the final state
+                if number + 1 == len(channel_events) and \
+                        final.get(channel, False) != state:
+                    missed += 1
+                else:
+                    superseded += 1
+            elif published > following:
+                # A newer change got there first, coalesced into one write
+                superseded += 1
+            else:
+                latencies.append(published - at)
+    return latencies, superseded, missed
+
+
+async def drive(emulator, channels, presence_dir, args):
+    '''Replay traffic at args.rate events per second'''
+    kinds = []
+    for item in args.mix:
+        kind, _, weight = item.partition('=')
+        kinds += [kind] * int(weight or 1)
+    state = {channel: False for channel in channels}
+    events = []
+    interval = 1 / args.rate
+    deadline = time.monotonic() + args.duration
+    next_at = time.monotonic()
+    while next_at < deadline:
+        await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+        next_at += interval
+        channel = random.choice(channels)
+        kind = random.choice(kinds)
+        state[channel] = not state[channel]
+        word = 'open' if state[channel] else 'closed'
+        at = time.monotonic()
+        if kind == 'irc':
+            emulator.inject('tester', channel, 'Cortana: ' + word)
+        elif kind == 'teleirc':
+            emulator.inject('teleirc', channel,
+                            '<tg_user> Cortana: ' + word)
+        else:
+            presence_file = Path(presence_dir) / (
+                'cortana.presence.' + channel)
+            if state[channel]:
+                presence_file.touch()
+            elif presence_file.exists():
+                presence_file.unlink()
+        events.append((at, channel, state[channel], kind))
+    return events
+
+
+async def main_async(args):
+    # Sopel may still be closing its logs when this is removed
+    with tempfile.TemporaryDirectory(prefix='cortana-load-',
+                                     ignore_cleanup_errors=True) as homedir:
+        await load_test(args, homedir)
+
+
+async def load_test(args, homedir):
+    '''Run the bot against the emulator with its files in homedir'''
+    emulator = IRCEmulator()
+    port = await emulator.start()
+    channels = ['#load{}'.format(number) for number in range(args.channels)]
+
+    Path(homedir, 'logs').mkdir()
+    config_path = Path(homedir) / 'default.cfg'
+    config_path.write_text(CONFIG_TEMPLATE.format(
+        port=port, channels=','.join(channels), modules=REPO / 'modules',
+        homedir=homedir, debounce=args.debounce,
+        min_interval=args.min_interval))
+
+    bot = Sopel(Config(str(config_path)), daemon=False)
+    thread = threading.Thread(target=bot.run, args=('127.0.0.1', port),
+                              name='sopel', daemon=True)
+    thread.start()
+
+    await asyncio.wait_for(emulator.ready.wait(), 30)
+    # Let the bot settle on the topics it found when joining
+    await asyncio.sleep(args.settle)
+    settled_writes = len(emulator.topic_writes)
+
+    events = await drive(emulator, channels, homedir, args)
+    # Give queued writes time to go out
+    await asyncio.sleep(args.drain + args.min_interval + args.debounce)
+    end = time.monotonic()
+
+    bot.quit('Load test done')
+    # Sopel runs the module shutdown hooks once the server hangs up
+    await asyncio.get_running_loop().run_in_executor(None, thread.join, 10)
+    emulator.server.close()
+
+    writes = emulator.topic_writes[settled_writes:]
+    latencies, superseded, missed = analyse(events, writes, end)
+    latencies.sort()
+
+    print('events:            {}'.format(len(events)))
+    print('topic writes:      {} ({} while settling)'.format(
+        len(writes), settled_writes))
+    print('writes per change: {:.2f}'.format(
+        len(writes) / max(1, len(events))))
+    print('coalesced:         {}'.format(superseded))
+    print('never published:   {}'.format(missed))
+    if latencies:
+        def ms(fraction):
+            return latencies[min(len(latencies) - 1,
+                                 int(len(latencies) * fraction))] * 1000
+        print('latency ms:        p50 {:.1f}  p90 {:.1f}  p99 {:.1f}  '
+              'max {:.1f}'.format(ms(0.5), ms(0.9), ms(0.99),
+                                  latencies[-1] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--channels', type=int, default=1,
+                        help='Number of channels to join')
+    parser.add_argument('--rate', type=float, default=2.0,
+                        help='Events per second across all channels')
+    parser.add_argument('--duration', type=float, default=20.0,
+                        help='Seconds of traffic to generate')
+    parser.add_argument('--mix', nargs='+',
+                        default=['irc=1', 'teleirc=1', 'button=1'],
+                        help='Event kinds and weights: irc, teleirc, button')
+    parser.add_argument('--debounce', type=float, default=0.5,
+                        help='topic_debounce for the bot')
+    parser.add_argument('--min-interval', type=float, default=3.0,
+                        help='topic_min_interval for the bot')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='Seconds to wait after joining')
+    parser.add_argument('--drain', type=float, default=2.0,
+                        help='Seconds to wait for writes after traffic ends')
+    parser.add_argument('--seed', type=int, help='Random seed')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    status = 1
+    try:
+        asyncio.run(main_async(args))
+        status = 0
+    except Exception:
+        traceback.print_exc()
+    finally:
+        # Sopel leaves its ping and job threads behind, even when it fails
+        # to connect or load, its launcher does this too
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+if __name__ == '__main__':
+    main()
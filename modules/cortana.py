@@ -3,149 +3,683 @@ Cortana
 
 Dedicated bot for the OtaHOAS clubroom at JMT11CD
 """
+import configparser
+import os
+import random
 import re
+import sys
+import threading
+import time
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from sopel import module
-from sopel.tools import (SopelMemory, events, get_command_pattern,
-                         get_nickname_command_regexp)
+from sopel.config.types import ListAttribute, StaticSection, \
+    ValidatedAttribute
+from sopel.tools import SopelMemory, events
+
+# Helpers shared with the GPIO daemon live in utils/
+UTILS_PATH = str(Path(__file__).resolve().parent.parent / 'utils')
+# Runs again on every reload
+if UTILS_PATH not in sys.path:
+    sys.path.append(UTILS_PATH)
+
+
+def forget_helpers():
+    '''Drop cached utils/ modules, the imports below load them again
+
+    Sopel's reload only runs this file again. Without this the helpers
+    would keep the code they had when first loaded, whatever the state
+    layout of this file. Dropping them lets the imports take care of the
+    order they depend on each other in.
+    '''
+    for name, cached in list(sys.modules.items()):
+        path = getattr(cached, '__file__', None)
+        if path and str(Path(path).resolve().parent) == UTILS_PATH:
+            del sys.modules[name]
+
+
+forget_helpers()
+import audit_log  # noqa: E402
+from channel_state import ChannelState  # noqa: E402
+from content_filter import BANNED_USER, ContentFilter  # noqa: E402
+from presence_ipc import PresenceLink  # noqa: E402
+from history_log import HistoryLog  # noqa: E402
+from metrics import REGISTRY, start_exporter, timed  # noqa: E402
+from profiling import profiled, start_profiler  # noqa: E402
+from rate_limit import ALLOWED, LIMITED, RateLimiter  # noqa: E402
+from scheduler import Scheduler  # noqa: E402
+from occupancy import OccupancyStats  # noqa: E402
+from presence_watcher import PresenceWatcher  # noqa: E402
+from state_store import StateStore  # noqa: E402
+from status_page import PageWriter  # noqa: E402
+from status_server import StatusServer  # noqa: E402
+from topic_queue import TopicWriter  # noqa: E402
+import wordlists  # noqa: E402
 
 STATUS_PREFIX = 'JMT11CD: '  # @TODO Move to a channel specific config
 TOPIC_SEPARATOR = '|'  # @TODO Same as above
 PRESENCE_FILE_TEMPLATE = '/tmp/cortana.presence.{}'
+# Used only when inotify is not available
+PRESENCE_POLL_INTERVAL = 5
+# Sockets for talking to the GPIO daemon, see utils/presence_ipc.py
+IPC_SOCKET = '/tmp/cortana.sopel.sock'
+GPIO_SOCKET = '/tmp/cortana.gpio.sock'
+# Background workers kept in bot.memory, stopped in this order
+WORKERS = ['scheduler', 'presence_watcher', 'presence_link', 'topic_writer',
+           'status_server', 'state_store', 'audit_log', 'metrics_exporter', 'profiler']
+# Profile into this directory regardless of config
+PROFILE_ENV = 'CORTANA_PROFILE'
+# Layout of the channel state in bot.memory, bump it and add a migration
+# when it changes so a reload can take over the state of the old code
+STATE_VERSION = 3
+# Seconds to hold topic writes for a channel waiting for its topic, in case
+# the server never answers
+RECONCILE_TIMEOUT = 30
+
+# Recorded all the time, exported only if metrics_port or metrics_file is set
+COMMANDS = REGISTRY.counter(
+    'cortana_commands_total', 'Status commands seen', ['source', 'result'])
+TELEIRC_IGNORED = COMMANDS.labels('teleirc', 'ignored')
+PRESENCE_SYNCS = REGISTRY.counter(
+    'cortana_presence_syncs_total',
+    'Presence file checks, dirty ones changed the state', ['result'])
+SYNC_DIRTY = PRESENCE_SYNCS.labels('dirty')
+SYNC_CLEAN = PRESENCE_SYNCS.labels('clean')
+PRESENCE_UPDATES = REGISTRY.counter(
+    'cortana_presence_updates_total',
+    'Updates from the GPIO daemon per channel', ['result'])
+TRANSITIONS = REGISTRY.counter(
+    'cortana_transitions_total', 'State changes recorded', ['source'])
+FILTERED = REGISTRY.counter(
+    'cortana_commands_filtered_total',
+    'Status commands rejected by the content filter', ['reason'])
+RECONCILES = REGISTRY.counter(
+    'cortana_reconciles_total',
+    'Channel states settled against the topic after joining', ['result'])
+SCHEDULED = REGISTRY.counter(
+    'cortana_scheduled_total', 'Time based rules run', ['rule'])
 
 # Nick commands to change topic
-TOPIC_COMMANDS = [
-    '(?i)open[,:]?', '(?i)auki[,:]?', '(?i)closed[,:]?',
-    '(?i)kiinni[,:]?', '(?i)status[,:]?', '(?i)reporting[,:]?',
-    '(?i)reserved[,:]?', '(?i)varattu[,:]?'
+STATUS_KEYWORDS = [
+    'open', 'auki', 'closed', 'kiinni', 'status', 'reporting',
+    'reserved', 'varattu'
 ]
-TOPIC_COMMANDS_COMBINED = '|'.join(TOPIC_COMMANDS)
+# Sopel compiles these case-insensitively already, inline (?i) flags
+# are an error on newer Pythons
+TOPIC_COMMANDS = ['{}[,:]?'.format(keyword) for keyword in STATUS_KEYWORDS]
+# Strips the optional punctuation from commands above
+COMMAND_PUNCTUATION = str.maketrans('', '', ',:')
 # Regex rules for triggering nick commands above
 TOPIC_RULES = [
     r'^Hey,?\s$nickname,?\s?(.*)$'
 ]
 
 
+class CortanaSection(StaticSection):
+    topic_debounce = ValidatedAttribute('topic_debounce', float, default=0.5)
+    """Seconds to wait for more changes before writing the topic"""
+    topic_min_interval = ValidatedAttribute(
+        'topic_min_interval', float, default=3.0)
+    """Minimum seconds between topic writes to a channel"""
+    state_db = ValidatedAttribute('state_db')
+    """SQLite database for clubroom state, defaults to cortana.db in homedir"""
+    history_dir = ValidatedAttribute('history_dir')
+    """Directory for the status history log, defaults to history in homedir"""
+    presence_file = ValidatedAttribute(
+        'presence_file', default=PRESENCE_FILE_TEMPLATE)
+    """Presence file path, {} is replaced with the channel name"""
+    ipc_socket = ValidatedAttribute('ipc_socket', default=IPC_SOCKET)
+    """Socket we receive updates from the GPIO daemon on"""
+    gpio_socket = ValidatedAttribute('gpio_socket', default=GPIO_SOCKET)
+    """Socket the GPIO daemon receives updates on"""
+    metrics_port = ValidatedAttribute('metrics_port', int)
+    """Serve Prometheus metrics on this port on localhost"""
+    metrics_file = ValidatedAttribute('metrics_file')
+    """Rewrite Prometheus metrics to this file if there is no metrics_port"""
+    status_port = ValidatedAttribute('status_port', int)
+    """Serve the status over HTTP on this port, off when unset"""
+    status_host = ValidatedAttribute('status_host', default='127.0.0.1')
+    """Address to serve the status on"""
+    status_page = ValidatedAttribute('status_page')
+    """Keep a static status page at this path, off when unset"""
+    profile_dir = ValidatedAttribute('profile_dir')
+    """Profile handlers and write reports here, off when unset"""
+    profile_sample_rate = ValidatedAttribute(
+        'profile_sample_rate', float, default=0.1)
+    """Share of handler calls to run under cProfile"""
+    profile_interval = ValidatedAttribute(
+        'profile_interval', float, default=300.0)
+    """Seconds between profile reports"""
+    audit_file = ValidatedAttribute('audit_file')
+    """JSON lines audit log, defaults to cortana.audit.log in logdir"""
+    audit_max_bytes = ValidatedAttribute(
+        'audit_max_bytes', int, default=audit_log.MAX_BYTES)
+    """Rotate the audit log at this size"""
+    audit_backups = ValidatedAttribute(
+        'audit_backups', int, default=audit_log.BACKUPS)
+    """Rotated audit logs to keep"""
+    banned_words = ListAttribute(
+        'banned_words', default=wordlists.BANNED_WORDS)
+    """Status changes containing any of these are refused, in any case"""
+    banned_users = ListAttribute(
+        'banned_users', default=wordlists.BANNED_USERS)
+    """Nicks, or Telegram users over TeleIRC, not allowed to change status"""
+    nick_rate = ValidatedAttribute('nick_rate', float, default=6.0)
+    """Status changes allowed per minute from a single nick, 0 for no limit"""
+    nick_burst = ValidatedAttribute('nick_burst', int, default=3)
+    """Status changes a nick may make back to back"""
+    channel_rate = ValidatedAttribute('channel_rate', float, default=12.0)
+    """Status changes allowed per minute in a channel, 0 for no limit"""
+    channel_burst = ValidatedAttribute('channel_burst', int, default=6)
+    """Status changes a channel may see back to back"""
+    reserved_hours = ValidatedAttribute('reserved_hours', float)
+    """Close a reserved clubroom after this many hours, off when unset"""
+    stale_open_hours = ValidatedAttribute('stale_open_hours', float)
+    """Remind the channel every this many hours the clubroom stays open,
+    off when unset"""
+
+
+def configure(config):
+    config.define_section('cortana', CortanaSection)
+    config.cortana.configure_setting(
+        'topic_debounce',
+        'Seconds to wait for more status changes before writing the topic')
+    config.cortana.configure_setting(
+        'topic_min_interval', 'Minimum seconds between topic writes')
+
+
+class CommandMatcher:
+    '''Matcher for "<nick>[:,] <keyword> [rest]" lines
+
+    The regex only splits the line into the keyword and the rest, keywords
+    are looked up from a set so adding more of them costs nothing extra.
+    The regex is compiled once and again only if the nicks change.
+    '''
+
+    def __init__(self, keywords):
+        self.keywords = frozenset(keyword.lower() for keyword in keywords)
+        self._nicks = None
+        self._prefixes = ()
+        self._regex = None
+
+    def _compile(self, nick, alias_nicks):
+        if isinstance(alias_nicks, str):
+            alias_nicks = [alias_nicks]
+        nicks = (nick,) + tuple(alias_nicks)
+        if nicks != self._nicks:
+            self._prefixes = tuple(name.lower() for name in nicks)
+            self._regex = re.compile(
+                r'^(?:{})[:,]?\s+(\S+)(?:\s+(.*))?$'.format(
+                    '|'.join(re.escape(name) for name in nicks)),
+                re.IGNORECASE)
+            self._nicks = nicks
+
+    def match(self, line, nick, alias_nicks):
+        '''Return (keyword, rest) if the line is a command, None otherwise'''
+        self._compile(nick, alias_nicks)
+
+        # Cheap check to skip lines not addressed to us
+        head = line[:max(map(len, self._prefixes))].lower()
+        if not head.startswith(self._prefixes):
+            return None
+
+        match = self._regex.match(line)
+        if not match:
+            return None
+        keyword = match.group(1).lower().rstrip(',:')
+        if keyword not in self.keywords:
+            return None
+        return keyword, match.group(2)
+
+
+TOPIC_MATCHER = CommandMatcher(STATUS_KEYWORDS)
+
+
 def setup(bot):
-    if 'clubroom_status' not in bot.memory:
-        bot.memory['clubroom_status'] = SopelMemory()
+    bot.config.define_section('cortana', CortanaSection)
+    # Channels whose live state survived a reload
+    handed_over = handoff(bot)
+
+    # Rebuilt from config by the rehash command
+    bot.memory['content_filter'] = ContentFilter(
+        bot.config.cortana.banned_words, bot.config.cortana.banned_users)
+
+    # Flood protection for status changes, by nick and by channel
+    bot.memory['nick_limiter'] = RateLimiter(
+        bot.config.cortana.nick_rate / 60, bot.config.cortana.nick_burst)
+    bot.memory['channel_limiter'] = RateLimiter(
+        bot.config.cortana.channel_rate / 60,
+        bot.config.cortana.channel_burst)
+
+    bot.memory['metrics_exporter'] = start_exporter(
+        bot.config.cortana.metrics_port, bot.config.cortana.metrics_file)
+    profile_dir = os.environ.get(PROFILE_ENV) or bot.config.cortana.profile_dir
+    if profile_dir:
+        bot.memory['profiler'] = start_profiler(
+            profile_dir, bot.config.cortana.profile_sample_rate,
+            bot.config.cortana.profile_interval)
+
+    # Restore state saved before the last shutdown in one go, unless
+    # everything is already in memory
+    store = StateStore(bot.config.cortana.state_db or os.path.join(
+        bot.config.core.homedir, 'cortana.db'))
+    saved = {}
+    if not handed_over.issuperset(bot.config.core.channels):
+        saved = store.load()
+    store.start()
+    bot.memory['state_store'] = store
+    history = HistoryLog(bot.config.cortana.history_dir or
+                         os.path.join(bot.config.core.homedir, 'history'))
+    bot.memory['history'] = history
+
+    audit = audit_log.AuditLog(
+        bot.config.cortana.audit_file or
+        os.path.join(bot.config.core.logdir, 'cortana.audit.log'),
+        bot.config.cortana.audit_max_bytes, bot.config.cortana.audit_backups)
+    audit.start()
+    bot.memory['audit_log'] = audit
+
+    # Occupancy stats are rebuilt from the full history once, then kept
+    # up to date on every transition, also across reloads
+    if not handed_over or 'occupancy' not in bot.memory:
+        bot.memory['occupancy'] = OccupancyStats.rebuild(
+            (event.timestamp, event.channel, event.status)
+            for event in history.query())
+
     for channel in bot.config.core.channels:
         # Initialize state for each autojoin channel
-        bot.memory['clubroom_status'][channel] = {
-            'presence': False,
-            'status': 'closed',
-            'extra': '',
-            'topic_updated': datetime.now()
+        if channel not in handed_over:
+            bot.memory['clubroom_status'][channel] = ChannelState.from_dict(
+                saved.get(channel, {}))
+        audit.prime(channel, bot.memory['clubroom_status'][channel].as_dict())
+
+    # Time based rules, rescheduled on every state change. Config lookups
+    # are slow, the settings are copied to memory
+    bot.memory['time_rules'] = (bot.config.cortana.reserved_hours,
+                                bot.config.cortana.stale_open_hours)
+    scheduler = Scheduler()
+    scheduler.start()
+    bot.memory['scheduler'] = scheduler
+
+    # Topic writes wait until the topic is known, see reconcile(). Channels
+    # are added on join, or here if we're reloaded while already on them.
+    # Sopel tracks their topics, so those are settled at the end of setup
+    joined = [channel for channel in bot.config.core.channels
+              if channel in bot.channels]
+    bot.memory['reconciling'] = {}
+    hold_topic_writes(bot, joined)
+    # Channels changed since the last publish_status()
+    bot.memory['status_dirty'] = set(bot.memory['clubroom_status'])
+    bot.memory['status_published'] = {}
+    bot.memory['status_lock'] = threading.Lock()
+
+    # Status for web pages and dashboards, served from memory
+    if bot.config.cortana.status_port is not None:
+        server = StatusServer(bot.config.cortana.status_port,
+                              bot.config.cortana.status_host)
+        server.start()
+        bot.memory['status_server'] = server
+    if bot.config.cortana.status_page:
+        bot.memory['status_page'] = PageWriter(bot.config.cortana.status_page)
+    publish_status(bot)
+
+    # All topic writes go through here to avoid spamming the network
+    writer = TopicWriter(
+        lambda channel, topic: bot.write(('TOPIC', channel), topic),
+        debounce=bot.config.cortana.topic_debounce,
+        min_interval=bot.config.cortana.topic_min_interval)
+    writer.start()
+    bot.memory['topic_writer'] = writer
+
+    # Structured updates from the GPIO daemon, the presence files below
+    # stay as a fallback for when it's not there
+    link = PresenceLink(
+        'sopel', bot.config.cortana.ipc_socket,
+        bot.config.cortana.gpio_socket,
+        lambda update: handle_presence_update(bot, update))
+    link.start()
+    bot.memory['presence_link'] = link
+
+    # Start watching for presence file changes before the initial sync
+    # so nothing slips through between the two
+    bot.memory['presence_file'] = bot.config.cortana.presence_file
+    prefix = presence_path(bot, '')
+    watcher = PresenceWatcher(
+        prefix.parent,
+        lambda name, present: handle_presence_event(bot, name, present),
+        match=lambda name: name.startswith(prefix.name),
+        poll_interval=PRESENCE_POLL_INTERVAL)
+    watcher.start()
+    bot.memory['presence_watcher'] = watcher
+    sync_presence_all(bot)
+    for channel in joined:
+        topic = bot.channels[channel].topic
+        confirm_topic(bot, channel, topic)
+        reconcile(bot, channel, topic)
+    for channel in bot.memory['clubroom_status']:
+        # Deadlines passed while we were away run right away
+        schedule_rules(bot, channel)
+
+
+def handoff(bot):
+    '''Take over channel state left in memory, returns its channels'''
+    states = bot.memory.get('clubroom_status')
+    version = bot.memory.get('cortana_state_version', 0)
+    if states is None or version > STATE_VERSION:
+        # First load, or downgraded to code that can't read the state
+        bot.memory['clubroom_status'] = SopelMemory()
+        bot.memory['cortana_state_version'] = STATE_VERSION
+        return set()
+    for migrate in MIGRATIONS[version:]:
+        migrate(states)
+    for channel, data in list(states.items()):
+        if type(data) is not ChannelState:
+            # Made by the helpers loaded before the reload
+            states[channel] = ChannelState.from_dict(data.as_dict())
+    bot.memory['cortana_state_version'] = STATE_VERSION
+    return set(states)
+
+
+def migrate_unversioned(states):
+    '''State from before versioning, fill in and clean up the fields'''
+    for channel, data in list(states.items()):
+        # handle_topic used to leave the padding around status and extra
+        states[channel] = {
+            'presence': bool(data.get('presence')),
+            'status': (data.get('status') or 'closed').strip(),
+            'extra': (data.get('extra') or '').strip(),
+            'topic_updated': data.get('topic_updated') or datetime.now()
         }
 
 
+def migrate_to_objects(states):
+    '''Dicts to ChannelState'''
+    for channel, data in list(states.items()):
+        states[channel] = ChannelState.from_dict(data)
+
+
+def migrate_status_since(states):
+    '''ChannelState gained status_since, unknown so far'''
+    for channel, data in list(states.items()):
+        states[channel] = ChannelState.from_dict(
+            {name: getattr(data, name) for name in
+             ('presence', 'status', 'extra', 'topic_updated')})
+
+
+# MIGRATIONS[n] brings state from version n to n + 1, in place
+MIGRATIONS = [migrate_unversioned, migrate_to_objects, migrate_status_since]
+
+
+def shutdown(bot):
+    '''Stop background workers, also called on module reload'''
+    for name in WORKERS:
+        worker = bot.memory.get(name)
+        if worker is not None:
+            worker.stop()
+            del bot.memory[name]
+    history = bot.memory.get('history')
+    if history is not None:
+        history.close()
+        del bot.memory['history']
+
+
 @module.nickname_commands(*TOPIC_COMMANDS)
 @module.rule(*TOPIC_RULES)
+@timed()
+@profiled()
 def handle_irc_commands(bot, trigger):
     '''Update presence and status from IRC'''
     channel = trigger.sender
-    status = trigger.group(1).lower().translate(str.maketrans('', '', ',:'))
+    status = trigger.group(1).lower().translate(COMMAND_PUNCTUATION)
     rest = None
     if len(trigger.groups()) > 1:
         rest = trigger.group(2)
-    update_clubroom_status(bot, channel, status, rest)
+    if not screen_command(bot, 'irc', trigger.nick, channel, status, rest):
+        return
+    update_clubroom_status(bot, channel, status, rest, 'irc', trigger.nick)
 
 
 @module.rule(r"^<(.*)>\s($nickname[\s\:\,]?.*?)$")
+@timed()
+@profiled()
 def handle_teleirc_commands(bot, trigger):
     """Trigger for handling bridged messages from TeleIRC"""
     # Group 1 has sender's Telegram username
-    #sender = trigger.group(1)
+    sender = trigger.group(1)
     # Group 2 has the rest of the line, including the bot nickname
     line = trigger.group(2)
 
     # Compare against the known commands
-    regex = get_nickname_command_regexp(
-        bot.config.core.nick, TOPIC_COMMANDS_COMBINED, bot.config.core.alias_nicks)
-    match = re.match(regex, line)
+    match = TOPIC_MATCHER.match(
+        line, bot.config.core.nick, bot.config.core.alias_nicks)
 
     # Bail if no commands matched
     if not match:
+        TELEIRC_IGNORED.inc()
         return
 
-    # parse the channel and status
+    # parse the channel, status and extra (if any)
     channel = trigger.sender
-    status = match.group(1).lower().translate(str.maketrans('', '', ',:'))
-
-    # grab extra (if any), should always be in group 2
-    rest = None
-    if len(match.groups()) > 1:
-        rest = match.group(2)
+    status, rest = match
+    if not screen_command(bot, 'teleirc', sender, channel, status, rest):
+        return
 
     # Fire an update
-    update_clubroom_status(bot, channel, status, rest)
+    update_clubroom_status(bot, channel, status, rest, 'teleirc', sender)
+
+
+def screen_command(bot, source, nick, channel, status, rest):
+    '''Run a status command past the filter and rate limits, and log it'''
+    text = status if rest is None else status + ' ' + rest
+    result = 'accepted'
+    if rejected(bot, nick, text):
+        result = 'filtered'
+    # Everyone on Telegram shares the bridge's nick, limit them one by one
+    elif limited(bot, 'telegram:' + nick if source == 'teleirc' else nick,
+                 channel):
+        result = 'limited'
+    COMMANDS.labels(source, result).inc()
+    audit = bot.memory.get('audit_log')
+    if audit is not None:
+        audit.command(channel, source, nick, text, result)
+    return result == 'accepted'
+
+
+def rejected(bot, nick, text):
+    '''Check a status change against the content filter, replies if bad'''
+    reason = bot.memory['content_filter'].check(nick, text)
+    if reason is None:
+        return False
+    FILTERED.labels(reason).inc()
+    bot.reply(random.choice(wordlists.NOT_ALLOWED if reason == BANNED_USER
+                            else wordlists.STUPID_TOPIC))
+    return True
+
+
+def limited(bot, nick, channel):
+    '''Check nick and channel against their rate limits, replies once'''
+    # Nick first, so a flood from one nick doesn't eat the channel's share
+    result = bot.memory['nick_limiter'].check(nick.casefold())
+    if result == ALLOWED:
+        result = bot.memory['channel_limiter'].check(channel)
+    if result == ALLOWED:
+        return False
+    if result == LIMITED:
+        bot.reply(random.choice(wordlists.NOT_ALLOWED))
+    return True
+
+
+@module.nickname_commands('rehash')
+@module.require_admin()
+def handle_rehash(bot, trigger):
+    '''Reload the banned lists from the config file'''
+    # Only our section is taken from the file, other sections may have been
+    # changed at runtime. Settings removed from it go back to their defaults
+    fresh = configparser.RawConfigParser(allow_no_value=True)
+    fresh.read(bot.config.filename)
+    parser = bot.config.parser
+    parser.remove_section('cortana')
+    if fresh.has_section('cortana'):
+        parser.add_section('cortana')
+        for name, value in fresh.items('cortana', raw=True):
+            parser.set('cortana', name, value)
+    changed = bot.memory['content_filter'].update(
+        bot.config.cortana.banned_words, bot.config.cortana.banned_users)
+    bot.reply('Filter updated.' if changed else 'Filter unchanged.')
+
+
+@module.nickname_commands('stats')
+@timed()
+@profiled()
+def handle_stats(bot, trigger):
+    '''Tell when the clubroom has been open'''
+    stats = bot.memory['occupancy'].get(trigger.sender)
+    if stats is None:
+        bot.reply('I have no records for this channel yet.')
+        return
+
+    # Rendered once per change, repeated requests are free
+    lines = stats.render()
+    bot.reply(lines[0])
+    # Keep the hour-of-week histogram out of the channel
+    for line in lines[1:]:
+        bot.say(line, trigger.nick)
+
+
+@module.event('JOIN')
+@module.rule('.*')
+@module.thread(False)
+def handle_join(bot, trigger):
+    """Hold topic writes for channels we join until we know their topic"""
+    if trigger.nick == bot.nick and \
+            trigger.sender in bot.memory['clubroom_status']:
+        hold_topic_writes(bot, [trigger.sender])
 
 
 @module.event(events.RPL_TOPIC, events.RPL_NOTOPIC)
 @module.rule('.*')  # Dummy to make event match work (rtfm)
+@module.thread(False)  # In order with the JOIN and NAMES replies
+@timed()
+@profiled()
 def handle_topic(bot, trigger):
-    """Method for mangling the trigger enough to pass to IRC side"""
-    if len(trigger.args) < 3:
-        # No topic set
-        # @TODO Set the topic based on current state
+    """Topic sent on join or in reply to a TOPIC query"""
+    if len(trigger.args) < 2:
         return
+    channel = trigger.args[1]
+    topic = ''
+    if trigger.event == events.RPL_TOPIC and len(trigger.args) > 2:
+        topic = trigger.args[2]
+    confirm_topic(bot, channel, topic)
+    if channel in bot.memory['clubroom_status']:
+        reconcile(bot, channel, topic)
 
-    # Expand args into channel name and topic
-    _, channel, topic = trigger.args
 
-    # Parse out status bit and the real topic
-    status, _, topic = topic.partition(TOPIC_SEPARATOR)
+@module.event(events.RPL_ENDOFNAMES)
+@module.rule('.*')
+@module.thread(False)
+def handle_names_end(bot, trigger):
+    """Ends the join burst, no RPL_TOPIC before this means no topic"""
+    if len(trigger.args) < 2:
+        return
+    channel = trigger.args[1]
+    if channel in bot.memory['reconciling']:
+        reconcile(bot, channel, '')
 
-    # Parse out the real status and extra
-    status = status.replace(STATUS_PREFIX, '')
-    status, _, extra = status.partition(',')
 
-    # Check if topic needs updating
-    # @TODO let update_clubroom_status() handle this?
-    if channel in bot.memory['clubroom_status']:
-        # Grab the clubroom details from memory
-        clubroom_status = bot.memory['clubroom_status'][channel]
-
-        # Set our dirty bit to false
-        needs_updating = False
-
-        # Check if we need to set stuff
-        if status != clubroom_status['status']:
-            needs_updating = True
-        if extra != clubroom_status['extra']:
-            needs_updating = True
-        
-        # Only change if we have something to change
-        if needs_updating:
-            # Update memory and sync the file
-            presence = True if status in ['open', 'reserved'] else False
-            bot.memory['clubroom_status'][channel] = {
-                'presence': presence,
-                'status': status,
-                'extra': extra,
-                'topic_updated': datetime.now()
-            }
+@module.event('TOPIC')
+@module.rule('.*')
+@timed()
+@profiled()
+def handle_topic_change(bot, trigger):
+    """Track topic changes, including the echoes of our own writes"""
+    if len(trigger.args) < 2:
+        return
+    channel, topic = trigger.args[:2]
+    confirm_topic(bot, channel, topic)
+
+
+def hold_topic_writes(bot, channels):
+    '''Defer topic writes for channels until reconcile() is called'''
+    deadline = time.monotonic() + RECONCILE_TIMEOUT
+    scheduler = bot.memory.get('scheduler')
+    for channel in channels:
+        bot.memory['reconciling'][channel] = deadline
+        if scheduler is not None:
+            scheduler.schedule(
+                (channel, 'reconcile'), time.time() + RECONCILE_TIMEOUT,
+                lambda channel=channel: release_topic_writes(bot, channel))
+
+
+def release_topic_writes(bot, channel):
+    '''Scheduled, write what was held back if the topic never came'''
+    if bot.memory['reconciling'].pop(channel, None) is None:
+        # Reconciled in time
+        return
+    RECONCILES.labels('timeout').inc()
+    sync_channel_topic(bot, channel)
+
 
-            # Fire update to GPIO
-            sync_presence_file(bot, channel)
+def parse_topic(topic):
+    '''Return (status, extra) from a topic we set, None for other topics'''
+    status, _, _ = topic.partition(TOPIC_SEPARATOR)
+    if not status.startswith(STATUS_PREFIX):
+        return None
+    # We write "<prefix><status>, <extra> |", drop the padding
+    status, _, extra = status[len(STATUS_PREFIX):].partition(',')
+    status = status.strip()
+    if not status:
+        return None
+    return status, extra.strip()
 
 
-def update_clubroom_status(bot, channel, status, rest):
+@timed()
+def reconcile(bot, channel, topic):
+    '''Settle channel state against its topic, write it only if wrong'''
+    bot.memory['reconciling'].pop(channel, None)
+    data = bot.memory['clubroom_status'][channel]
+    parsed = parse_topic(topic)
+    if parsed is not None:
+        status, extra = parsed
+        differences = ChannelState(
+            status in ['open', 'reserved'], status, extra).diff(data)
+        # The presence file follows the button and wins over the topic,
+        # the topic only fills in details like reserved and the extra
+        if 'presence' not in differences:
+            if not differences:
+                RECONCILES.labels('unchanged').inc()
+                return
+            RECONCILES.labels('adopted').inc()
+            data.update(status=status, extra=extra,
+                        topic_updated=datetime.now())
+            state_changed(bot, channel, 'topic')
+            publish_presence(bot, channel, 'topic')
+            return
+
+    # No topic, someone else's topic or one contradicting the presence file
+    RECONCILES.labels('written').inc()
+    sync_channel_topic(bot, channel)
+
+
+def confirm_topic(bot, channel, topic):
+    '''Let the topic writer know what the server has'''
+    writer = bot.memory.get('topic_writer')
+    if writer is not None:
+        writer.confirm(channel, topic)
+
+
+@timed()
+def update_clubroom_status(bot, channel, status, rest, source, nick=None):
     '''Do the magic'''
-    presence = False
     extra = ''
 
-    # Process true-false-moose
+    # Process true-false-moose, presence follows from the status
     if status in ['open', 'auki', 'closed', 'kiinni']:
         # Handle simple open/closed states
         if status not in ['closed', 'kiinni',]:
             status = 'open'
-            presence = True
         else:
             status = 'closed'
-            presence = False
 
         # Handle additional information
         if rest is not None:
@@ -153,7 +687,6 @@ def update_clubroom_status(bot, channel, status, rest):
     else:
         # Handle moose-state, status will be extra
         # and the presence will be open
-        presence = True
         extra = status
         if rest is not None:
             # Grab extra from rest of the trigger,
@@ -166,65 +699,288 @@ def update_clubroom_status(bot, channel, status, rest):
             status = 'reserved'
 
     # Update memory with new status and extra
-    bot.memory['clubroom_status'][channel] = {
-        'presence': presence,
-        'status': status,
-        'extra': extra,
-        'topic_updated': datetime.now()
-    }
-
-    # Sync state to channel topic
+    changed = set_status(bot, channel, status, extra,
+                         topic_updated=datetime.now())
+
+    # Sync state to channel topic, even if unchanged in case someone
+    # edited our part of it
     sync_channel_topic(bot, channel)
+    if not changed:
+        return
+    state_changed(bot, channel, source, nick)
 
     # Sync state to presence file
     sync_presence_file(bot, channel)
+    publish_presence(bot, channel, source)
+
+
+@timed()
+@profiled()
+def handle_presence_event(bot, name, present):
+    '''Presence watcher callback, maps the file name back to a channel'''
+    template = bot.memory.get('presence_file', PRESENCE_FILE_TEMPLATE)
+    channel = name[len(os.path.basename(template.format(''))):]
+    if channel in bot.memory['clubroom_status']:
+        sync_presence(bot, channel, present)
+
+
+@timed()
+def sync_presence_all(bot):
+    '''Sync every channel from its presence file in one pass'''
+    # List the directory once instead of checking every file
+    directory = presence_path(bot, '').parent
+    try:
+        present = set(os.listdir(directory))
+    except OSError:
+        present = set()
+
+    # Make a local copy of the channel list
+    # Iterating the dictionary you are modifying is bad
+    for channel in list(bot.memory['clubroom_status'].keys()):
+        presence_file = presence_path(bot, channel)
+        sync_presence(bot, channel, presence_file.name in present)
+
+
+@timed()
+def sync_presence(bot, channel, present):
+    '''Update channel state and topic from the presence file'''
+    data = bot.memory['clubroom_status'][channel]
+    if present == data.presence:
+        SYNC_CLEAN.inc()
+        return
+    # Mark clubroom as open or closed
+    # @TODO Randomize these?
+    set_status(bot, channel, 'open' if present else 'closed')
+
+    # Channel topic requires updating, the topic writer skips writes of
+    # the topic the server already has
+    SYNC_DIRTY.inc()
+    state_changed(bot, channel, 'file')
+    sync_channel_topic(bot, channel)
+    publish_presence(bot, channel, 'file')
+
+
+@timed()
+@profiled()
+def handle_presence_update(bot, update):
+    '''Apply a state update received from the GPIO daemon'''
+    if update.channel is None:
+        # Daemon doesn't know about channels, update applies to all
+        channels = list(bot.memory['clubroom_status'].keys())
+    elif update.channel in bot.memory['clubroom_status']:
+        channels = [update.channel]
+    else:
+        PRESENCE_UPDATES.labels('unknown_channel').inc()
+        return
+
+    for channel in channels:
+        changed = set_status(bot, channel, update.status, update.extra,
+                             topic_updated=datetime.now())
+        if not changed:
+            PRESENCE_UPDATES.labels('unchanged').inc()
+            continue
+        PRESENCE_UPDATES.labels('applied').inc()
+        state_changed(bot, channel, update.source)
+        sync_channel_topic(bot, channel)
+        # Keep the file in sync for anything still watching it
+        sync_presence_file(bot, channel)
+
+
+def set_status(bot, channel, status, extra=None, topic_updated=None):
+    '''Set the status of channel, returns the names of changed fields
 
+    Shared by every source of status changes. Anything but closed means
+    someone is in the clubroom. Without an extra the current one is kept,
+    unless the clubroom closes on a later day than it was set.
+    '''
+    data = bot.memory['clubroom_status'][channel]
+    if extra is None:
+        extra = data.extra
+        # A closed clubroom gets it cleared at midnight by expire_extra(),
+        # one from before today would stay until the next midnight
+        if status == 'closed' and \
+                data.status_since.date() != datetime.now().date():
+            extra = ''
+    return data.update(presence=status != 'closed', status=status,
+                       extra=extra, topic_updated=topic_updated)
 
-@module.interval(5)
-def sync_presence_timer(bot):
-    '''Update channel topic from presence file'''
-    # Make a local copy of the memory
-    # Iterating the dictionary you are modifying is bad 
-    local_status = {}
-    for channel, data in bot.memory['clubroom_status'].items():
-        local_status[channel] = data
-
-    for channel, data in local_status.items():
-        # @TODO remove these if's an use an if-else instead?
-        presence_file = Path(PRESENCE_FILE_TEMPLATE.format(channel))
-        dirty = False
-        if presence_file.exists() and not data['presence']:
-            # Mark clubroom as open
-            # @TODO Randomize these?
-            dirty = True
-            bot.memory['clubroom_status'][channel]['status'] = 'open'
-            bot.memory['clubroom_status'][channel]['presence'] = True
-
-        if not presence_file.exists() and data['presence']:
-            # Mark clubroom as closed
-            # @TODO Randomize these?
-            dirty = True
-            bot.memory['clubroom_status'][channel]['status'] = 'closed'
-            bot.memory['clubroom_status'][channel]['presence'] = False
-
-            # Clear extra if we're past midnight and the day has changed
-            now = datetime.now()
-            topic_updated = bot.memory['clubroom_status'][channel]['topic_updated']
-            if now.hour >= 0 and now.day != topic_updated.day:
-                bot.memory['clubroom_status'][channel]['extra'] = ''
-
-        # Channel topic requires updating
-        # @TODO Sniff the topic to prevent spamming
-        if dirty:
-            sync_channel_topic(bot, channel)
 
+def state_changed(bot, channel, source, nick=None):
+    '''Save and record a status transition of channel'''
+    TRANSITIONS.labels(source).inc()
+    save_state(bot, channel)
+    data = bot.memory['clubroom_status'][channel]
+    audit = bot.memory.get('audit_log')
+    if audit is not None:
+        audit.state(channel, data.as_dict(), source, nick)
+    now = datetime.now()
+    history = bot.memory.get('history')
+    if history is not None:
+        history.append(channel, data.status, data.extra, source,
+                       now.timestamp())
+    occupancy = bot.memory.get('occupancy')
+    if occupancy is not None:
+        stats = occupancy.get(channel)
+        if stats is None:
+            stats = occupancy[channel] = OccupancyStats()
+        stats.transition(now, data.status)
+    schedule_rules(bot, channel)
+    publish_status(bot)
 
+
+def schedule_rules(bot, channel):
+    '''Schedule the time based rules that apply to the state of channel'''
+    scheduler = bot.memory.get('scheduler')
+    if scheduler is None:
+        return
+    data = bot.memory['clubroom_status'][channel]
+    reserved_hours, stale_open_hours = bot.memory['time_rules']
+
+    # The extra of a closed clubroom is cleared at the first midnight
+    # after it was set
+    key = (channel, 'midnight')
+    if data.status == 'closed' and data.extra:
+        midnight = datetime.combine(
+            data.status_since.date() + timedelta(days=1), datetime.min.time())
+        scheduler.schedule(key, midnight.timestamp(),
+                           lambda: expire_extra(bot, channel))
+    else:
+        scheduler.cancel(key)
+
+    # Counted from when the reservation was made or last changed, also
+    # across restarts
+    key = (channel, 'reserved')
+    if data.status == 'reserved' and reserved_hours:
+        scheduler.schedule(
+            key, data.status_since.timestamp() + reserved_hours * 3600,
+            lambda: close_reserved(bot, channel))
+    else:
+        scheduler.cancel(key)
+
+    # Reminders go out every stale_open_hours counted from opening, so a
+    # reload doesn't send one again
+    key = (channel, 'stale')
+    if data.status == 'open' and stale_open_hours:
+        interval = stale_open_hours * 3600
+        opened = open_since(bot, channel).timestamp()
+        now = time.time()
+        reminders = max(1, int((now - opened) // interval) + 1)
+        scheduler.schedule(key, opened + reminders * interval,
+                           lambda: remind_open(bot, channel))
+    else:
+        scheduler.cancel(key)
+
+
+def open_since(bot, channel):
+    '''When the clubroom was last opened, as far as we know'''
+    stats = bot.memory.get('occupancy', {}).get(channel)
+    if stats is not None and stats.open_since is not None:
+        return stats.open_since
+    return bot.memory['clubroom_status'][channel].status_since
+
+
+def expire_extra(bot, channel):
+    '''Scheduled, clear the extra of a closed clubroom at midnight'''
+    data = bot.memory['clubroom_status'][channel]
+    if data.status != 'closed':
+        return
+    SCHEDULED.labels('midnight').inc()
+    if data.update(extra='', topic_updated=datetime.now()):
+        state_changed(bot, channel, 'schedule')
+        sync_channel_topic(bot, channel)
+        publish_presence(bot, channel, 'schedule')
+
+
+def close_reserved(bot, channel):
+    '''Scheduled, close a clubroom that has been reserved too long'''
+    if bot.memory['clubroom_status'][channel].status != 'reserved':
+        return
+    SCHEDULED.labels('reserved').inc()
+    update_clubroom_status(bot, channel, 'closed', None, 'schedule')
+
+
+def remind_open(bot, channel):
+    '''Scheduled, ask if the clubroom really is still open'''
+    if bot.memory['clubroom_status'][channel].status != 'open':
+        return
+    SCHEDULED.labels('stale').inc()
+    hours = round((datetime.now() - open_since(bot, channel)).total_seconds()
+                  / 3600)
+    if channel in bot.channels:
+        bot.say(random.choice(wordlists.STALE_OPEN).format(hours=hours),
+                channel)
+    # Next reminder
+    schedule_rules(bot, channel)
+
+
+def save_state(bot, channel):
+    '''Queue the channel state for saving, written in the background'''
+    # Also goes out with the next publish_status()
+    bot.memory['status_dirty'].add(channel)
+    store = bot.memory.get('state_store')
+    if store is not None:
+        store.put(channel, bot.memory['clubroom_status'][channel].as_dict())
+
+
+def publish_presence(bot, channel, source):
+    '''Send the channel state to the GPIO daemon'''
+    link = bot.memory.get('presence_link')
+    if link is None:
+        return
+    data = bot.memory['clubroom_status'][channel]
+    link.send(channel, data.status, data.extra, source)
+
+
+@timed()
+def publish_status(bot):
+    '''Hand the state of every channel to the status endpoint and page'''
+    server = bot.memory.get('status_server')
+    page = bot.memory.get('status_page')
+    if server is None and page is None:
+        return
+    dirty = bot.memory['status_dirty']
+    if not dirty:
+        # Nothing changed since the last time
+        return
+    # Handler threads publish concurrently, one at a time keeps the
+    # published order the order of the changes
+    with bot.memory['status_lock']:
+        # Only channels that changed since the last time are rebuilt
+        channels = bot.memory['status_published']
+        changed = False
+        while dirty:
+            channel = dirty.pop()
+            data = bot.memory['clubroom_status'][channel]
+            channels[channel] = {
+                'status': data.status,
+                'extra': data.extra,
+                'presence': data.presence,
+                'updated': data.topic_updated.isoformat(timespec='seconds'),
+            }
+            changed = True
+        if not changed:
+            # Another thread published these
+            return
+        if server is not None:
+            server.publish(channels)
+        if page is not None:
+            # Written only if the rendered page changed
+            page.publish(channels)
+
+
+@timed()
 def sync_channel_topic(bot, channel):
     '''Helper for updating the clubroom status to the channel'''
     # Get the current topic and split it by the separator
     if channel not in bot.channels:
         # Skip updating at this time, bot is not currently on the channel
         return
+    deadline = bot.memory['reconciling'].get(channel)
+    if deadline is not None:
+        if time.monotonic() < deadline:
+            # Written by reconcile() if needed once the topic is known
+            return
+        del bot.memory['reconciling'][channel]
 
     # Parse topic into usable chunks by exploding it
     topic = bot.channels[channel].topic.split(TOPIC_SEPARATOR)
@@ -233,10 +989,12 @@ def sync_channel_topic(bot, channel):
         topic.insert(0, '')
 
     # Build the status string (with optional extra stuff)
-    status = bot.memory['clubroom_status'][channel]['status']
-    if bot.memory['clubroom_status'][channel]['extra']:
-        status = status + ', ' + bot.memory['clubroom_status'][channel]['extra']
-    bot.memory['clubroom_status'][channel]['topic_updated'] = datetime.now()
+    data = bot.memory['clubroom_status'][channel]
+    status = data.status
+    if data.extra:
+        status = status + ', ' + data.extra
+    data.topic_updated = datetime.now()
+    save_state(bot, channel)
 
     # Replace the first element in topic with clubroom status
     topic[0] = f'{STATUS_PREFIX}{status} '
@@ -245,12 +1003,20 @@ def sync_channel_topic(bot, channel):
     set_topic(bot, channel, f'{TOPIC_SEPARATOR}'.join(topic))
 
 
+def presence_path(bot, channel):
+    '''Path of the presence file for channel'''
+    # Config lookups are slow, setup() copies the template to memory
+    template = bot.memory.get('presence_file', PRESENCE_FILE_TEMPLATE)
+    return Path(template.format(channel))
+
+
+@timed()
 def sync_presence_file(bot, channel):
     '''Sync state from memory to presence file'''
-    presence_file = Path(PRESENCE_FILE_TEMPLATE.format(channel))
+    presence_file = presence_path(bot, channel)
 
     # Get the presence from memory
-    presence = bot.memory['clubroom_status'][channel]['presence']
+    presence = bot.memory['clubroom_status'][channel].presence
 
     # Link or unlink the file, depending on the desired state
     # @TODO remove the extra if and turn it into an else
@@ -262,4 +1028,9 @@ def sync_presence_file(bot, channel):
 
 def set_topic(bot, channel, topic):
     '''Set the clubroom channel's topic to given argument'''
-    bot.write(('TOPIC', channel), topic)
+    writer = bot.memory.get('topic_writer')
+    if writer is None:
+        bot.write(('TOPIC', channel), topic)
+        return
+    # Queued, written once the burst of changes is over
+    writer.submit(channel, topic)
@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+# Same layout as at runtime, utils/ modules import each other by name.
+# The plugin tests use the fake bot of the benchmarks
+ROOT = Path(__file__).resolve().parent.parent
+for path in (ROOT / 'utils', ROOT / 'modules', ROOT / 'bench'):
+    if str(path) not in sys.path:
+        sys.path.append(str(path))
@@ -0,0 +1,64 @@
+import json
+from datetime import datetime
+
+from audit_log import AuditLog
+
+
+def read(path):
+    with open(path, encoding='utf-8') as handle:
+        return [json.loads(line) for line in handle]
+
+
+def test_state_and_command_lines(tmp_path):
+    path = tmp_path / 'audit.log'
+    audit = AuditLog(str(path))
+    audit.start()
+    audit.prime('#a', {'status': 'closed', 'extra': '', 'presence': False,
+                       'topic_updated': datetime.now()})
+    audit.state('#a', {'status': 'open', 'extra': 'pelit', 'presence': True},
+                'irc', 'someone')
+    audit.command('#a', 'teleirc', 'troll', 'open äijät', 'filtered')
+    audit.stop()
+
+    state, command = read(path)
+    assert state['event'] == 'state'
+    assert state['channel'] == '#a'
+    assert (state['source'], state['nick']) == ('irc', 'someone')
+    assert state['old'] == {'status': 'closed', 'extra': '',
+                            'presence': False}
+    assert state['new'] == {'status': 'open', 'extra': 'pelit',
+                            'presence': True}
+    assert datetime.fromisoformat(state['time']).tzinfo is not None
+    assert command == {'time': command['time'], 'event': 'command',
+                       'channel': '#a', 'source': 'teleirc', 'nick': 'troll',
+                       'text': 'open äijät', 'result': 'filtered'}
+
+
+def test_stop_writes_out_the_queue(tmp_path):
+    path = tmp_path / 'audit.log'
+    audit = AuditLog(str(path))
+    audit.start()
+    for number in range(2000):
+        audit.command('#a', 'irc', 'nick', str(number), 'accepted')
+    audit.stop()
+    assert [entry['text'] for entry in read(path)] == \
+        [str(number) for number in range(2000)]
+
+
+def test_rotation_keeps_backups(tmp_path):
+    path = tmp_path / 'audit.log'
+    audit = AuditLog(str(path), max_bytes=1000, backups=2)
+    audit.start()
+    for number in range(200):
+        audit.command('#a', 'irc', 'nick', str(number), 'accepted')
+    audit.stop()
+    assert sorted(file.name for file in tmp_path.iterdir()) == \
+        ['audit.log', 'audit.log.1', 'audit.log.2']
+    # Newest last, whole lines in every file
+    texts = [entry['text'] for name in ('audit.log.2', 'audit.log.1',
+                                        'audit.log')
+             for entry in read(tmp_path / name)]
+    assert texts == [str(number) for number in
+                     range(200 - len(texts), 200)]
+    assert all((tmp_path / name).stat().st_size <= 1000
+               for name in ('audit.log', 'audit.log.1', 'audit.log.2'))
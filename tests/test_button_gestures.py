@@ -0,0 +1,98 @@
+import pytest
+
+from button_gestures import (DOUBLE_PRESS, LONG_PRESS, PRESS,
+                             GestureDetector)
+
+DEBOUNCE = 0.03
+
+
+def feed(detector, edges, until):
+    '''Feed (pressed, at) edges and poll up to until like the GPIO loop'''
+    gestures = []
+    now = 0.0
+    edges = list(edges)
+    while now <= until:
+        timeout = detector.timeout(now)
+        due = until + 1 if timeout is None else now + timeout
+        if edges and edges[0][1] <= due:
+            pressed, now = edges.pop(0)
+            gestures += detector.edge(pressed, now)
+        elif timeout is None or due > until:
+            break
+        else:
+            # Float rounding must not keep us short of the deadline
+            now = due + 1e-9
+            gestures += detector.poll(now)
+    return [gesture for gesture, _ in gestures]
+
+
+def press(start, length):
+    return [(True, start), (False, start + length)]
+
+
+def test_short_press_on_release():
+    detector = GestureDetector(DEBOUNCE, 1.0, 0.0)
+    assert feed(detector, press(0.0, 0.2), 5) == [PRESS]
+
+
+def test_press_reported_within_debounce_of_release():
+    detector = GestureDetector(DEBOUNCE, 1.0, 0.0)
+    assert detector.edge(True, 0.0) == []
+    assert detector.edge(False, 0.2) == []
+    assert detector.poll(0.2 + DEBOUNCE) == [(PRESS, 0.2 + DEBOUNCE)]
+
+
+def test_bounce_is_ignored():
+    detector = GestureDetector(DEBOUNCE, 1.0, 0.0)
+    bouncy = [(True, 0.0), (False, 0.002), (True, 0.004), (False, 0.006),
+              (True, 0.008), (False, 0.2), (True, 0.203), (False, 0.205)]
+    assert feed(detector, bouncy, 5) == [PRESS]
+
+
+def test_glitch_is_not_a_press():
+    detector = GestureDetector(DEBOUNCE, 1.0, 0.0)
+    assert feed(detector, press(0.0, 0.01), 5) == []
+
+
+def test_long_press_never_toggles_first():
+    detector = GestureDetector(DEBOUNCE, 1.0, 0.0)
+    # Still held, could go either way
+    assert feed(detector, [(True, 0.0)], 0.9) == []
+    detector = GestureDetector(DEBOUNCE, 1.0, 0.0)
+    assert feed(detector, press(0.0, 2.0), 5) == [LONG_PRESS]
+
+
+def test_long_press_while_held():
+    detector = GestureDetector(DEBOUNCE, 1.0, 0.0)
+    detector.edge(True, 0.0)
+    assert detector.poll(0.5) == []
+    gestures = detector.poll(1.5)
+    assert [gesture for gesture, _ in gestures] == [LONG_PRESS]
+
+
+@pytest.mark.parametrize('gap, expected', [
+    (0.2, [DOUBLE_PRESS]),
+    (0.8, [PRESS, PRESS]),
+])
+def test_double_press(gap, expected):
+    detector = GestureDetector(DEBOUNCE, 1.0, 0.4)
+    edges = press(0.0, 0.1) + press(0.1 + gap, 0.1)
+    assert feed(detector, edges, 5) == expected
+
+
+def test_first_of_double_press_waits_for_window():
+    detector = GestureDetector(DEBOUNCE, 1.0, 0.4)
+    assert feed(detector, press(0.0, 0.1), 0.3) == []
+    assert [gesture for gesture, _ in detector.poll(1.0)] == [PRESS]
+
+
+def test_triple_press():
+    detector = GestureDetector(DEBOUNCE, 1.0, 0.4)
+    edges = press(0.0, 0.1) + press(0.3, 0.1) + press(0.6, 0.1)
+    assert feed(detector, edges, 5) == [DOUBLE_PRESS, PRESS]
+
+
+def test_long_second_press_is_still_double():
+    detector = GestureDetector(DEBOUNCE, 1.0, 0.4)
+    edges = press(0.0, 0.1) + press(0.3, 2.0)
+    assert feed(detector, edges, 5) == [DOUBLE_PRESS]
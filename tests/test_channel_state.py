@@ -0,0 +1,56 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+from channel_state import ChannelState
+from state_store import StateStore
+
+EARLIER = datetime(2024, 5, 4, 18, 0)
+
+
+def test_update_reports_changes():
+    data = ChannelState()
+    assert data.update(status='open', presence=True) == {'status', 'presence'}
+    assert data.update(status='open') == frozenset()
+    assert data.diff(ChannelState()) == {'presence': (True, False),
+                                         'status': ('open', 'closed')}
+
+
+def test_status_since_moves_only_with_status_or_extra():
+    data = ChannelState(topic_updated=EARLIER)
+    assert data.status_since == EARLIER
+    # Topic rewrites and unchanged states leave it alone
+    data.update(status='closed', topic_updated=datetime.now())
+    data.topic_updated = datetime.now()
+    assert data.status_since == EARLIER
+    later = EARLIER + timedelta(hours=1)
+    data.update(extra='huomenna', topic_updated=later)
+    assert data.status_since == later
+
+
+def test_store_keeps_status_since(tmp_path):
+    store = StateStore(tmp_path / 'state.db', flush_delay=0)
+    store.start()
+    data = ChannelState(True, 'reserved', 'kokous', datetime.now(), EARLIER)
+    store.put('#a', data.as_dict())
+    store.stop()
+    saved = StateStore(tmp_path / 'state.db').load()
+    loaded = ChannelState.from_dict(saved['#a'])
+    assert loaded.status_since == EARLIER
+    assert loaded.status == 'reserved'
+
+
+def test_store_adds_status_since_to_old_databases(tmp_path):
+    path = tmp_path / 'state.db'
+    connection = sqlite3.connect(str(path))
+    with connection:
+        connection.execute(
+            'CREATE TABLE clubroom_status (channel TEXT PRIMARY KEY, '
+            'presence INTEGER NOT NULL, status TEXT NOT NULL, '
+            'extra TEXT NOT NULL, topic_updated REAL NOT NULL)')
+        connection.execute(
+            'INSERT INTO clubroom_status VALUES (?, ?, ?, ?, ?)',
+            ('#a', 0, 'closed', '', EARLIER.timestamp()))
+    connection.close()
+    saved = StateStore(path).load()['#a']
+    # Falls back to the last topic update
+    assert saved['status_since'] == EARLIER
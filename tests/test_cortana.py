@@ -0,0 +1,275 @@
+import importlib.util
+import json
+import sys
+import threading
+import time
+import types
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+from fakebot import FakeBot, cortana, prime
+from presence_ipc import PresenceUpdate
+
+
+@pytest.fixture
+def bot(tmp_path):
+    with FakeBot(['#a', '#b']) as bot:
+        prime(bot, tmp_path)
+        yield bot
+
+
+class RenderingServer:
+    '''Serialises what it's given like StatusServer does'''
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channels):
+        self.published.append(json.dumps(channels, sort_keys=True))
+
+
+def test_publish_status_skips_when_clean(bot):
+    server = bot.memory['status_server'] = RenderingServer()
+    cortana.publish_status(bot)
+    cortana.publish_status(bot)
+    assert len(server.published) == 1
+    assert set(json.loads(server.published[0])) == {'#a', '#b'}
+
+
+def test_publish_status_from_many_threads(bot):
+    server = bot.memory['status_server'] = RenderingServer()
+    errors = []
+
+    def worker(channel):
+        try:
+            for number in range(200):
+                bot.memory['clubroom_status'][channel].update(
+                    extra=str(number))
+                cortana.save_state(bot, channel)
+                cortana.publish_status(bot)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker, args=(channel,))
+               for channel in ('#a', '#b', '#a', '#b')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    last = json.loads(server.published[-1])
+    assert last['#a']['extra'] == last['#b']['extra'] == '199'
+
+
+@pytest.fixture
+def scheduler(bot):
+    scheduler = bot.memory['scheduler'] = cortana.Scheduler()
+    bot.memory['time_rules'] = (None, None)
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def test_held_topic_written_when_topic_never_comes(bot, scheduler,
+                                                   monkeypatch):
+    monkeypatch.setattr(cortana, 'RECONCILE_TIMEOUT', 0.1)
+    cortana.hold_topic_writes(bot, ['#a'])
+    cortana.update_clubroom_status(bot, '#a', 'open', 'pelit', 'irc', 'x')
+    # Held while waiting for the topic
+    assert not bot.written
+    assert wait_for(lambda: bot.written)
+    assert bot.written == [(('TOPIC', '#a'), 'JMT11CD: open, pelit | bench')]
+    assert '#a' not in bot.memory['reconciling']
+
+
+def test_reconciled_hold_is_not_written_again(bot, scheduler, monkeypatch):
+    monkeypatch.setattr(cortana, 'RECONCILE_TIMEOUT', 0.1)
+    cortana.hold_topic_writes(bot, ['#a'])
+    cortana.reconcile(bot, '#a', 'JMT11CD: closed | bench')
+    time.sleep(0.2)
+    assert not bot.written
+
+
+def test_rehash_only_rereads_our_section(bot):
+    bot.config.parser.set('core', 'owner', 'changed at runtime')
+    with open(bot.config.filename, 'a') as config:
+        config.write('banned_words = spam,eggs\n')
+    trigger = types.SimpleNamespace(admin=True, owner=True, nick='admin',
+                                    sender='#a')
+    cortana.handle_rehash(bot, trigger)
+    assert bot.said == [(None, 'Filter updated.')]
+    assert bot.config.core.owner == 'changed at runtime'
+    assert bot.config.cortana.banned_words == ['spam', 'eggs']
+    assert cortana.rejected(bot, 'someone', 'open SPAM')
+
+
+def test_zero_rates_turn_limits_off():
+    with FakeBot(['#a']) as bot:
+        with open(bot.config.filename, 'a') as config:
+            config.write(
+                'nick_rate = 0\nchannel_rate = 0\n'
+                'ipc_socket = {0}/sopel.sock\ngpio_socket = {0}/gpio.sock\n'
+                'presence_file = {0}/presence.{{}}\n'.format(bot.homedir))
+        bot.config = type(bot.config)(bot.config.filename)
+        bot.channels['#a'].topic = ''
+        try:
+            cortana.setup(bot)
+            assert not cortana.limited(bot, 'nick', '#a')
+        finally:
+            cortana.shutdown(bot)
+
+
+def test_reservation_counted_from_status_since(bot, scheduler):
+    bot.memory['time_rules'] = (1.0, None)
+    data = bot.memory['clubroom_status']['#a']
+    reserved_at = datetime.now() - timedelta(hours=2)
+    data.update(presence=True, status='reserved', extra='kokous',
+                topic_updated=reserved_at)
+    # A topic rewrite since doesn't restart the reservation
+    cortana.sync_channel_topic(bot, '#a')
+    cortana.schedule_rules(bot, '#a')
+    assert wait_for(lambda: data.status == 'closed')
+    assert data.extra == ''
+
+
+def test_extra_expires_after_midnight(bot, scheduler):
+    data = bot.memory['clubroom_status']['#a']
+    data.update(status='closed', extra='huomenna klo 10',
+                topic_updated=datetime.now() - timedelta(days=1))
+    cortana.sync_channel_topic(bot, '#a')
+    cortana.schedule_rules(bot, '#a')
+    assert wait_for(lambda: data.extra == '')
+
+
+def stale_open(bot, channel):
+    '''Open with an extra set yesterday'''
+    data = bot.memory['clubroom_status'][channel]
+    data.update(presence=True, status='open', extra='pelit',
+                topic_updated=datetime.now() - timedelta(days=1))
+    cortana.sync_presence_file(bot, channel)
+    return data
+
+
+@pytest.mark.parametrize('close', [
+    lambda bot: cortana.handle_presence_update(bot, PresenceUpdate(
+        '#a', 'closed', None, 'button', 1, 'gpio')),
+    lambda bot: cortana.sync_presence(bot, '#a', False),
+], ids=['ipc', 'file'])
+def test_closing_clears_stale_extra(bot, close):
+    data = stale_open(bot, '#a')
+    close(bot)
+    assert (data.presence, data.status, data.extra) == (False, 'closed', '')
+    assert bot.written == [(('TOPIC', '#a'), 'JMT11CD: closed | bench')]
+    # The file event following an update over IPC has nothing left to do
+    cortana.sync_presence(bot, '#a', False)
+    assert len(bot.written) == 1
+
+
+def test_ipc_keeps_todays_extra(bot):
+    data = bot.memory['clubroom_status']['#a']
+    data.update(presence=True, status='open', extra='pelit')
+    cortana.handle_presence_update(bot, PresenceUpdate(
+        '#a', 'closed', None, 'button', 1, 'gpio'))
+    assert data.extra == 'pelit'
+
+
+def test_ipc_reporting_counts_as_present(bot):
+    data = stale_open(bot, '#a')
+    cortana.handle_presence_update(bot, PresenceUpdate(
+        '#a', 'reporting', 'siivous', 'button', 1, 'gpio'))
+    assert data.presence
+    assert cortana.presence_path(bot, '#a').exists()
+
+
+class OldChannelState:
+    '''ChannelState as it was at state version 2, before status_since'''
+    __slots__ = ('presence', 'status', 'extra', 'topic_updated')
+
+    def __init__(self, presence, status, extra, topic_updated):
+        self.presence = presence
+        self.status = status
+        self.extra = extra
+        self.topic_updated = topic_updated
+
+    def as_dict(self):
+        return {'presence': self.presence, 'status': self.status,
+                'extra': self.extra, 'topic_updated': self.topic_updated}
+
+
+EARLIER = datetime(2024, 5, 4, 18, 0)
+# Channel state left in memory by each state version
+LEFT_BEHIND = {
+    0: lambda: {'presence': 1, 'status': ' reserved ', 'extra': ' kokous ',
+                'topic_updated': EARLIER},
+    1: lambda: {'presence': True, 'status': 'reserved', 'extra': 'kokous',
+                'topic_updated': EARLIER},
+    2: lambda: OldChannelState(True, 'reserved', 'kokous', EARLIER),
+    3: lambda: cortana.ChannelState(True, 'reserved', 'kokous', datetime.now(),
+                                    EARLIER),
+}
+
+
+@pytest.mark.parametrize('version', sorted(LEFT_BEHIND))
+def test_handoff_migrates(version):
+    bot = types.SimpleNamespace(memory=cortana.SopelMemory())
+    bot.memory['clubroom_status'] = {'#a': LEFT_BEHIND[version]()}
+    if version:
+        bot.memory['cortana_state_version'] = version
+    assert cortana.handoff(bot) == {'#a'}
+    assert bot.memory['cortana_state_version'] == cortana.STATE_VERSION
+    data = bot.memory['clubroom_status']['#a']
+    assert type(data) is cortana.ChannelState
+    assert (data.presence, data.status, data.extra) == \
+        (True, 'reserved', 'kokous')
+    assert data.status_since == EARLIER
+
+
+@pytest.mark.parametrize('memory', [
+    {},
+    {'clubroom_status': {'#a': {}},
+     'cortana_state_version': cortana.STATE_VERSION + 1},
+], ids=['first_load', 'downgrade'])
+def test_handoff_starts_over(memory):
+    bot = types.SimpleNamespace(memory=cortana.SopelMemory(memory))
+    assert cortana.handoff(bot) == set()
+    assert bot.memory['clubroom_status'] == {}
+    assert bot.memory['cortana_state_version'] == cortana.STATE_VERSION
+
+
+def test_reload_picks_up_current_helpers(bot, monkeypatch):
+    '''Helpers cached from before status_since, then .reload cortana'''
+    cached = dict(sys.modules)
+    stale = types.ModuleType('channel_state')
+    stale.__file__ = str(Path(cortana.UTILS_PATH) / 'channel_state.py')
+    stale.ChannelState = OldChannelState
+    sys.modules['channel_state'] = stale
+    try:
+        spec = importlib.util.spec_from_file_location(
+            'cortana_reloaded', cortana.__file__)
+        reloaded = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(reloaded)
+    finally:
+        sys.modules.clear()
+        sys.modules.update(cached)
+    assert reloaded.ChannelState is not OldChannelState
+
+    bot.memory['clubroom_status']['#a'] = OldChannelState(
+        True, 'open', 'pelit', EARLIER)
+    bot.memory['cortana_state_version'] = 2
+    reloaded.handoff(bot)
+    reloaded.handle_presence_update(bot, PresenceUpdate(
+        '#a', 'closed', None, 'button', 1, 'gpio'))
+    data = bot.memory['clubroom_status']['#a']
+    assert (data.presence, data.status, data.extra) == (False, 'closed', '')
+    assert bot.written == [(('TOPIC', '#a'), 'JMT11CD: closed | bench')]
@@ -0,0 +1,103 @@
+import queue
+import threading
+import time
+
+import pytest
+from gpiozero.pins.mock import MockFactory, MockPWMPin
+
+import handle_gpio
+from button_gestures import GestureDetector
+from indicators import IndicatorScheduler
+
+# Generous, the threads involved react within milliseconds
+TIMEOUT = 2.0
+
+
+class RecordingLink:
+    '''Stands in for PresenceLink, records the statuses sent to Sopel'''
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, channel, status, extra, source):
+        self.sent.append(status)
+
+
+def wait_for(condition, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    '''handle_gpio.run() on mock pins and a presence file in tmp_path'''
+    factory = MockFactory(pin_class=MockPWMPin)
+    events = queue.Queue()
+    away, home, button = handle_gpio.setup_devices(events, factory)
+    indicators = IndicatorScheduler({'home': home, 'away': away})
+    indicators.start()
+    presence_file = tmp_path / 'cortana.presence'
+    watcher = handle_gpio.watch_presence(presence_file, events)
+    link = RecordingLink()
+    # Long presses made short to keep the tests quick
+    gestures = GestureDetector(0.03, 0.3, 0.0)
+    thread = threading.Thread(
+        target=handle_gpio.run,
+        args=(presence_file, events, indicators, link, None, gestures),
+        daemon=True)
+    thread.start()
+    yield presence_file, link, home, button
+    events.put((handle_gpio.EVENT_STOP, None, time.monotonic()))
+    thread.join(TIMEOUT)
+    watcher.stop()
+    indicators.stop()
+    for device in (away, home, button):
+        device.close()
+    # Mock pins are shared by every MockFactory until reset
+    factory.reset()
+    assert not thread.is_alive()
+
+
+def test_presence_file_drives_indicators(daemon):
+    presence_file, _, home, _ = daemon
+    assert wait_for(lambda: home.value == 0)
+    presence_file.touch()
+    assert wait_for(lambda: home.value == 1)
+    presence_file.unlink()
+    assert wait_for(lambda: home.value == 0)
+
+
+def test_button_toggles_presence(daemon):
+    presence_file, _, home, button = daemon
+    for present in (True, False):
+        # Apart enough not to count as bounce
+        time.sleep(0.1)
+        button.pin.drive_high()
+        time.sleep(0.1)
+        button.pin.drive_low()
+        assert wait_for(lambda: presence_file.exists() == present)
+        assert wait_for(lambda: home.value == int(present))
+
+
+def test_long_press_reserves_without_toggling(daemon):
+    presence_file, link, home, button = daemon
+    button.pin.drive_high()
+    assert wait_for(lambda: link.sent)
+    # Held past the long press time, then let go
+    time.sleep(0.1)
+    button.pin.drive_low()
+    time.sleep(0.1)
+    assert link.sent == ['reserved']
+    assert presence_file.exists()
+
+
+def test_stop_ends_loop(tmp_path):
+    events = queue.Queue()
+    indicators = IndicatorScheduler({})
+    events.put((handle_gpio.EVENT_STOP, None, time.monotonic()))
+    # Returns instead of blocking forever
+    handle_gpio.run(tmp_path / 'cortana.presence', events, indicators)
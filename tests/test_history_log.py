@@ -0,0 +1,110 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from history_log import INDEX_EVERY, INDEX_SUFFIX, SEGMENT_SUFFIX, \
+    HistoryLog
+
+MAY = datetime(2024, 5, 1, tzinfo=timezone.utc).timestamp()
+JUNE = datetime(2024, 6, 1, tzinfo=timezone.utc).timestamp()
+# Enough records for a few index entries
+COUNT = INDEX_EVERY * 3 + 5
+
+
+def fill(history, start, count=COUNT):
+    '''Append count transitions a minute apart, returns their timestamps'''
+    timestamps = [start + 60 * number for number in range(count)]
+    for number, timestamp in enumerate(timestamps):
+        history.append('#a', 'open' if number % 2 else 'closed', str(number),
+                       'test', timestamp)
+    return timestamps
+
+
+def local(timestamp):
+    return datetime.fromtimestamp(timestamp)
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = HistoryLog(tmp_path)
+    yield history
+    history.close()
+
+
+def test_segments_roll_over_by_month(history):
+    fill(history, JUNE - 60 * 10, 20)
+    assert history.segments() == ['2024-05', '2024-06']
+    extras = [event.extra for event in history.query()]
+    assert extras == [str(number) for number in range(20)]
+
+
+def test_query_range_within_segment(history):
+    timestamps = fill(history, MAY)
+    start, end = timestamps[100], timestamps[150]
+    events = list(history.query(local(start), local(end)))
+    assert [event.extra for event in events] == \
+        [str(number) for number in range(100, 150)]
+    assert events[0].timestamp == local(start)
+
+
+def test_query_range_across_segments(history):
+    before = fill(history, JUNE - 60 * COUNT)
+    after = fill(history, JUNE)
+    events = list(history.query(local(before[-10]), local(after[10])))
+    assert len(events) == 20
+    assert [event.extra for event in events] == \
+        [str(number) for number in range(COUNT - 10, COUNT)] + \
+        [str(number) for number in range(10)]
+    # Filters apply after the range
+    assert all(event.status == 'open' for event in
+               history.query(local(before[-10]), local(after[10]),
+                             channel='#a', status='open'))
+    assert not list(history.query(channel='#b'))
+
+
+def test_torn_tail_is_truncated(history, tmp_path):
+    fill(history, MAY, INDEX_EVERY)
+    history.close()
+    log_path = tmp_path / ('2024-05' + SEGMENT_SUFFIX)
+    size = log_path.stat().st_size
+    with open(log_path, 'ab') as handle:
+        # Half a record header left by a crash
+        handle.write(b'\x00' * 7)
+
+    reopened = HistoryLog(tmp_path)
+    reopened.append('#a', 'closed', 'after', 'test', MAY + 60 * INDEX_EVERY)
+    reopened.close()
+    extras = [event.extra for event in reopened.query()]
+    assert extras == [str(number) for number in range(INDEX_EVERY)] + \
+        ['after']
+    assert log_path.stat().st_size > size
+    # The record count carried on, the new record started an index entry
+    index = reopened._read_index('2024-05')
+    assert [entry[0] for entry in index] == [MAY, MAY + 60 * INDEX_EVERY]
+    assert index[1][1] == size
+
+
+@pytest.mark.parametrize('damage', [
+    lambda path: path.unlink(),
+    # Torn entry
+    lambda path: path.write_bytes(path.read_bytes()[:-3]),
+    # Offset past the end of the log
+    lambda path: path.write_bytes(path.read_bytes()[:-8] + b'\xff' * 8),
+], ids=['missing', 'torn', 'bad_offset'])
+def test_damaged_index_is_rebuilt(history, tmp_path, damage):
+    fill(history, MAY)
+    history.close()
+    index_path = tmp_path / ('2024-05' + INDEX_SUFFIX)
+    good = index_path.read_bytes()
+    damage(index_path)
+
+    reopened = HistoryLog(tmp_path)
+    reopened.append('#a', 'closed', 'after', 'test', MAY + 60 * COUNT)
+    reopened.close()
+    assert index_path.read_bytes() == good
+    assert len(list(reopened.query())) == COUNT + 1
+    timestamps = [MAY + 60 * number for number in range(COUNT)]
+    events = list(reopened.query(local(timestamps[130]),
+                                 local(timestamps[140])))
+    assert [event.extra for event in events] == \
+        [str(number) for number in range(130, 140)]
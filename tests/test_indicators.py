@@ -0,0 +1,85 @@
+import time
+
+import pytest
+from gpiozero import LED, PWMLED
+from gpiozero.pins.mock import MockFactory, MockPWMPin
+
+import indicators
+from indicators import PATTERNS, IndicatorScheduler, fade
+
+
+@pytest.fixture
+def leds():
+    '''Indicator LEDs on mock pins, which record every value written'''
+    factory = MockFactory(pin_class=MockPWMPin)
+    away = PWMLED(18, pin_factory=factory)
+    home = LED(23, pin_factory=factory)
+    scheduler = IndicatorScheduler({'home': home, 'away': away})
+    scheduler.start()
+    yield scheduler, home, away
+    scheduler.stop()
+    away.close()
+    home.close()
+    # Mock pins are shared by every MockFactory until reset
+    factory.reset()
+
+
+def values(device):
+    '''Values written to a mock pin'''
+    return [state.state for state in device.pin.states]
+
+
+def test_fades_step_through_levels():
+    frames = fade(0.0, 1.0, 1.0)
+    assert len(frames) == indicators.LEVELS
+    assert sum(seconds for _, seconds in frames) == pytest.approx(1.0)
+    # A fade faster than the levels allow is capped at FPS
+    assert len(fade(0.0, 1.0, 0.2)) == int(0.2 * indicators.FPS)
+
+
+def test_closed_pulse_wakes_up_rarely(leds):
+    scheduler, home, away = leds
+    before = indicators.WAKEUPS.labels().value
+    scheduler.show('closed')
+    time.sleep(2.0)
+    wakeups = indicators.WAKEUPS.labels().value - before
+    # 16 steps in the first second and 5 in the next instead of
+    # gpiozero's 25 a second
+    assert 10 <= wakeups <= 25
+    written = values(away)
+    assert len(written) <= 25
+    assert max(written) == pytest.approx(1.0)
+
+
+def test_steady_pattern_writes_once(leds):
+    scheduler, home, away = leds
+    scheduler.show('open')
+    time.sleep(0.2)
+    before = indicators.WAKEUPS.labels().value
+    writes = len(home.pin.states)
+    time.sleep(0.5)
+    assert indicators.WAKEUPS.labels().value == before
+    assert len(home.pin.states) == writes
+    assert home.value == 1
+
+
+def test_flash_returns_to_pattern(leds):
+    scheduler, home, away = leds
+    scheduler.show('open')
+    time.sleep(0.05)
+    scheduler.flash('error')
+    time.sleep(0.05)
+    assert home.value == 1
+    time.sleep(0.1)
+    assert home.value == 0
+    # Five blinks of 0.2 seconds
+    time.sleep(1.2)
+    assert home.value == 1
+    assert scheduler.pattern == 'open'
+
+
+def test_every_pattern_has_frames():
+    for name, pattern in PATTERNS.items():
+        for led, frames in pattern.leds.items():
+            assert frames, (name, led)
+            assert all(0.0 <= value <= 1.0 for value, _ in frames)
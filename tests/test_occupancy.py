@@ -0,0 +1,56 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import occupancy
+from occupancy import OccupancyStats
+
+
+def make_events(count=200, seed=1):
+    rng = random.Random(seed)
+    timestamp = datetime(2024, 1, 1, 8)
+    events = []
+    for _ in range(count):
+        timestamp += timedelta(minutes=rng.randint(1, 600))
+        channel = rng.choice(['#a', '#b'])
+        events.append((timestamp, channel,
+                       rng.choice(['open', 'closed', 'reserved'])))
+    return events
+
+
+def incremental(events):
+    stats = {}
+    for timestamp, channel, status in events:
+        stats.setdefault(channel, OccupancyStats()).transition(
+            timestamp, status)
+    return stats
+
+
+def test_split_by_hour_and_week():
+    stats = OccupancyStats()
+    # Sunday 23:30 to Monday 00:45
+    stats.transition(datetime(2024, 1, 7, 23, 30), 'open')
+    stats.transition(datetime(2024, 1, 8, 0, 45), 'closed')
+    assert stats.hours[6 * 24 + 23] == 1800
+    assert stats.hours[0] == 2700
+    assert sorted(stats.weeks.values()) == [1800, 2700]
+    assert stats.open_since is None
+
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_rebuild_matches_transitions(monkeypatch, vectorized):
+    if not vectorized:
+        monkeypatch.setattr(occupancy, 'numpy', None)
+    elif occupancy.numpy is None:
+        pytest.skip('numpy not installed')
+    events = make_events()
+    rebuilt = OccupancyStats.rebuild(events)
+    expected = incremental(events)
+    assert rebuilt.keys() == expected.keys()
+    for channel, stats in expected.items():
+        assert rebuilt[channel].hours == pytest.approx(stats.hours)
+        assert rebuilt[channel].weeks.keys() == stats.weeks.keys()
+        for week, total in stats.weeks.items():
+            assert rebuilt[channel].weeks[week] == pytest.approx(total)
+        assert rebuilt[channel].open_since == stats.open_since
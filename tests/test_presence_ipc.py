@@ -0,0 +1,74 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from presence_ipc import PresenceLink, PresenceUpdate, decode, encode
+
+VALID = {'channel': '#test', 'status': 'open', 'extra': None,
+         'source': 'button', 'seq': 1, 'origin': 'gpio'}
+
+
+def test_round_trip():
+    update = PresenceUpdate(**VALID)
+    assert decode(encode(update)) == update
+
+
+@pytest.mark.parametrize('fields', [
+    {'channel': ['#a']},
+    {'channel': {'#a': 1}},
+    {'extra': 5},
+    {'origin': None},
+    {'source': []},
+    {'status': 'hacked'},
+    {'status': ['open']},
+    {'seq': '1'},
+    {'seq': True},
+    {'seq': -1},
+])
+def test_decode_rejects(fields):
+    with pytest.raises(ValueError):
+        decode(json.dumps(dict(VALID, **fields)).encode())
+
+
+@pytest.mark.parametrize('data', [
+    b'\xff', b'[]', b'"open"', b'{}', b'{"status": "open"}',
+    b'[' * 100000,
+])
+def test_decode_rejects_garbage(data):
+    with pytest.raises(ValueError):
+        decode(data)
+
+
+def test_receiver_survives(tmp_path):
+    received = []
+    done = threading.Event()
+
+    def callback(update):
+        received.append(update)
+        if update.extra == 'boom':
+            raise RuntimeError('callback failed')
+        if update.extra == 'last':
+            done.set()
+
+    link = PresenceLink('sopel', tmp_path / 'sopel.sock',
+                        tmp_path / 'gpio.sock', callback)
+    link.start()
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    seq = int(time.time() * 1000)
+    try:
+        for data in (
+                json.dumps(dict(VALID, channel=['#a'])).encode(),
+                json.dumps(dict(VALID, seq=seq + 10 ** 12)).encode(),
+                b'\xff',
+                encode(PresenceUpdate(**dict(VALID, seq=seq, extra='boom'))),
+                encode(PresenceUpdate(**dict(VALID, seq=seq + 1,
+                                             extra='last')))):
+            sender.sendto(data, str(link.path))
+        assert done.wait(2)
+    finally:
+        sender.close()
+        link.stop()
+    assert [update.extra for update in received] == ['boom', 'last']
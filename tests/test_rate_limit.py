@@ -0,0 +1,23 @@
+from rate_limit import ALLOWED, IGNORED, LIMITED, RateLimiter
+
+
+def test_burst_then_limited_once():
+    limiter = RateLimiter(1 / 60, 2)
+    assert [limiter.check('nick') for _ in range(4)] == \
+        [ALLOWED, ALLOWED, LIMITED, IGNORED]
+    # Other keys have buckets of their own
+    assert limiter.check('other') == ALLOWED
+
+
+def test_zero_rate_is_unlimited():
+    for rate in (0, 0.0, -1):
+        limiter = RateLimiter(rate, 3)
+        assert all(limiter.check('nick') == ALLOWED for _ in range(100))
+        assert len(limiter) == 0
+
+
+def test_keys_are_bounded():
+    limiter = RateLimiter(1 / 60, 1, max_keys=10)
+    for number in range(100):
+        limiter.check(number)
+    assert len(limiter) == 10
@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+from rate_limit import TokenBucket
+from telegram_outbox import GROUP_RATE, Outbox, RateLimited
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+
+def test_groups_get_the_group_bucket():
+    async def main():
+        sent = []
+
+        async def send(chat_id, text):
+            sent.append((chat_id, text))
+
+        outbox = Outbox(send)
+        outbox.put(-1001234, 'group')
+        outbox.put(1234, 'user')
+        await outbox.close()
+        return outbox, sent
+
+    outbox, sent = run(main())
+    assert sorted(sent) == [(-1001234, 'group'), (1234, 'user')]
+    assert outbox._buckets[-1001234].rate == GROUP_RATE
+    assert outbox._buckets[1234].rate > GROUP_RATE
+
+
+def test_retry_after_holds_every_chat():
+    async def main():
+        sent = []
+        throttled = []
+
+        async def send(chat_id, text):
+            if not throttled:
+                throttled.append(time.monotonic())
+                raise RateLimited(0.3)
+            sent.append((chat_id, time.monotonic()))
+
+        outbox = Outbox(send, global_rate=1000.0)
+        outbox.put(1, 'first')
+        await asyncio.sleep(0.05)
+        outbox.put(2, 'second')
+        await outbox.close()
+        return throttled[0], sent
+
+    throttled_at, sent = run(main())
+    assert {chat_id for chat_id, _ in sent} == {1, 2}
+    for _, sent_at in sent:
+        assert sent_at - throttled_at >= 0.25
+
+
+def test_pause_keeps_the_longer_wait():
+    bucket = TokenBucket(1.0, 1)
+    bucket.pause(10)
+    bucket.pause(1)
+    assert bucket.delay() > 9
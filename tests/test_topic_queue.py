@@ -0,0 +1,115 @@
+import time
+
+import pytest
+
+import topic_queue
+from topic_queue import ECHO_TIMEOUTS, SKIPPED, TopicWriter
+
+
+class Clock:
+    '''Stands in for the time module, moved by hand'''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(topic_queue, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def writer(clock):
+    # Not started, writes are collected by due() below
+    return TopicWriter(None, debounce=0.5, min_interval=3.0,
+                       echo_timeout=30.0)
+
+
+def due(writer, clock, seconds=0.0):
+    '''Move the clock and return the writes the thread would send'''
+    clock.now += seconds
+    with writer._condition:
+        return writer._collect()
+
+
+def test_burst_is_coalesced(writer, clock):
+    writer.submit('#a', 'open')
+    clock.now += 0.3
+    writer.submit('#a', 'closed')
+    clock.now += 0.3
+    writer.submit('#a', 'open, pelit')
+    # Every submit pushes the write back by the debounce
+    assert due(writer, clock, 0.4) == []
+    assert due(writer, clock, 0.1) == [('#a', 'open, pelit')]
+    assert due(writer, clock, 10) == []
+
+
+def test_channels_are_independent(writer, clock):
+    writer.submit('#a', 'open')
+    writer.submit('#b', 'closed')
+    assert sorted(due(writer, clock, 0.5)) == [('#a', 'open'),
+                                               ('#b', 'closed')]
+
+
+def test_confirmed_topic_is_skipped(writer, clock):
+    skipped = SKIPPED._default.value
+    writer.confirm('#a', 'open')
+    writer.submit('#a', 'open')
+    assert due(writer, clock, 0.5) == []
+    assert SKIPPED._default.value == skipped + 1
+
+
+def test_in_flight_topic_is_not_written_twice(writer, clock):
+    writer.submit('#a', 'open')
+    assert due(writer, clock, 0.5) == [('#a', 'open')]
+    # Toggled back before the echo came
+    writer.submit('#a', 'closed')
+    writer.submit('#a', 'open')
+    assert due(writer, clock, 5) == []
+    writer.confirm('#a', 'open')
+    writer.submit('#a', 'open')
+    assert due(writer, clock, 5) == []
+
+
+def test_unechoed_write_is_retried(writer, clock):
+    timeouts = ECHO_TIMEOUTS._default.value
+    writer.submit('#a', 'open')
+    assert due(writer, clock, 0.5) == [('#a', 'open')]
+    writer.submit('#a', 'open')
+    assert due(writer, clock, 5) == []
+    # Past the echo timeout the server is assumed not to have it
+    writer.submit('#a', 'open')
+    assert due(writer, clock, 30) == [('#a', 'open')]
+    assert ECHO_TIMEOUTS._default.value == timeouts + 1
+
+
+def test_writes_are_spaced(writer, clock):
+    writer.submit('#a', 'open')
+    assert due(writer, clock, 0.5) == [('#a', 'open')]
+    writer.confirm('#a', 'open')
+    writer.submit('#a', 'closed')
+    # Debounced at 0.5s, but only min_interval after the last write
+    assert due(writer, clock, 2.9) == []
+    assert due(writer, clock, 0.2) == [('#a', 'closed')]
+
+
+def test_thread_sends_and_stops():
+    sent = []
+    writer = TopicWriter(lambda channel, topic: sent.append((channel, topic)),
+                         debounce=0.01, min_interval=0.0)
+    writer.start()
+    try:
+        writer.submit('#a', 'open')
+        for _ in range(200):
+            if sent:
+                break
+            time.sleep(0.005)
+    finally:
+        writer.stop()
+    assert sent == [('#a', 'open')]
+    assert not writer.is_alive()
@@ -0,0 +1,96 @@
+"""
+Audit log
+
+Who changed the clubroom status and how, one JSON object per line:
+
+    {"time": "2024-05-04T18:02:11.512+03:00", "event": "state",
+     "channel": "#polygame", "source": "irc", "nick": "someone",
+     "old": {"status": "closed", ...}, "new": {"status": "open", ...}}
+
+Records are handed to a QueueListener thread, which does the formatting,
+writing and size based rotation. Callers never wait for the SD card.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+from datetime import datetime
+from typing import Optional
+
+# Rotate at this size, keeping BACKUPS old files
+MAX_BYTES = 1024 * 1024
+BACKUPS = 5
+# Fields of the channel state that are logged
+STATE_FIELDS = ('status', 'extra', 'presence')
+
+
+class JsonFormatter(logging.Formatter):
+    '''Formats records made by AuditLog as JSON lines'''
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).astimezone()
+            .isoformat(timespec='milliseconds'),
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'audit', {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class AuditLog:
+    '''Queued JSON lines log of commands and state changes'''
+
+    def __init__(self, path: str, max_bytes: int = MAX_BYTES,
+                 backups: int = BACKUPS):
+        self.path = path
+        self._handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8',
+            delay=True)
+        self._handler.setFormatter(JsonFormatter())
+        self._queue = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(
+            self._queue, self._handler)
+        # Own logger per file, reloading the plugin must not add another
+        # handler to a shared one
+        self._logger = logging.Logger('cortana.audit')
+        self._logger.addHandler(_QueueHandler(self._queue))
+        # Last logged state per channel, so callers don't have to keep
+        # the old state around
+        self._states = {}
+
+    def start(self):
+        self._listener.start()
+
+    def stop(self):
+        '''Write out everything queued and close the file'''
+        self._listener.stop()
+        self._handler.close()
+
+    def prime(self, channel: str, data: dict):
+        '''Remember the state of channel without logging it'''
+        self._states[channel] = {key: data.get(key) for key in STATE_FIELDS}
+
+    def command(self, channel: str, source: str, nick: Optional[str],
+                text: str, result: str):
+        '''Log a status command and what became of it'''
+        self._log('command', channel=channel, source=source, nick=nick,
+                  text=text, result=result)
+
+    def state(self, channel: str, data: dict, source: str,
+              nick: Optional[str] = None):
+        '''Log a state change of channel to data'''
+        new = {key: data.get(key) for key in STATE_FIELDS}
+        old = self._states.get(channel)
+        self._states[channel] = new
+        self._log('state', channel=channel, source=source, nick=nick,
+                  old=old, new=new)
+
+    def _log(self, event: str, **fields):
+        self._logger.info(event, extra={'audit': fields})
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    '''Hands records over as they are, JsonFormatter needs the fields'''
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
@@ -0,0 +1,115 @@
+"""
+Button gestures
+
+Turns raw button edges into presses, long presses and double presses. The
+edges come timestamped from the GPIO callbacks, so the detector is a plain
+state machine: feed it edges with ``edge()``, call ``poll()`` once
+``timeout()`` runs out and act on the gestures both return. Nothing here
+touches the pins or the clock, synthetic edge timings give the same
+results as a real button.
+
+A level counts once it has held for ``debounce`` seconds. Contact bounce
+and glitches shorter than that never make it out as a press. A plain press
+is only reported once it can't turn into anything else: on release, or
+with double presses enabled once the window for a second press is over.
+A long press is reported as soon as the button has been held long enough
+and a double press on the second press, so neither of them ever toggles
+the state on the way.
+"""
+from typing import List, Optional, Tuple
+
+PRESS = 'press'
+LONG_PRESS = 'long_press'
+DOUBLE_PRESS = 'double_press'
+
+# Seconds a level has to hold before it counts
+DEBOUNCE = 0.03
+# Seconds to hold the button for a long press
+LONG_PRESS_TIME = 1.0
+# Seconds from a release to the next press for a double press, 0 disables
+DOUBLE_PRESS_TIME = 0.0
+
+# (gesture, time it was decided at)
+Gesture = Tuple[str, float]
+
+
+class GestureDetector:
+    '''Debounced edges in, gestures out'''
+
+    def __init__(self, debounce: float = DEBOUNCE,
+                 long_press: float = LONG_PRESS_TIME,
+                 double_press: float = DOUBLE_PRESS_TIME):
+        self.debounce = debounce
+        self.long_press = long_press
+        self.double_press = double_press
+        # Raw level and when it last changed, None once it has settled
+        self._level = False
+        self._changed = None
+        # Debounced level and when it last went down
+        self._pressed = False
+        self._pressed_at = None
+        # The current press already made a gesture, its release makes none
+        self._consumed = False
+        # Release of a plain press waiting to see if a second one follows
+        self._released_at = None
+
+    def edge(self, pressed: bool, at: float) -> List[Gesture]:
+        '''Feed a raw edge, returns gestures completed by it'''
+        # Whatever was held long enough before this edge counts
+        gestures = self.poll(at)
+        if pressed != self._level:
+            self._level = pressed
+            self._changed = at
+        return gestures
+
+    def poll(self, now: float) -> List[Gesture]:
+        '''Returns gestures that became due by now'''
+        gestures = []
+        if self._changed is not None and \
+                now - self._changed >= self.debounce:
+            if self._level != self._pressed:
+                self._settle(self._changed + self.debounce, gestures)
+            self._changed = None
+        if self._pressed and not self._consumed and \
+                now - self._pressed_at >= self.long_press:
+            self._consumed = True
+            gestures.append((LONG_PRESS, self._pressed_at + self.long_press))
+        if self._released_at is not None and not self._pressed and \
+                now - self._released_at >= self.double_press:
+            # No second press came
+            gestures.append((PRESS, self._released_at + self.double_press))
+            self._released_at = None
+        return gestures
+
+    def timeout(self, now: float) -> Optional[float]:
+        '''Seconds until poll() has something to do, None if never'''
+        due = []
+        if self._changed is not None:
+            due.append(self._changed + self.debounce)
+        if self._pressed and not self._consumed:
+            due.append(self._pressed_at + self.long_press)
+        if self._released_at is not None and not self._pressed:
+            due.append(self._released_at + self.double_press)
+        if not due:
+            return None
+        return max(0.0, min(due) - now)
+
+    def _settle(self, at: float, gestures: List[Gesture]):
+        '''Debounced level changed, at is when it became stable'''
+        self._pressed = self._level
+        if self._pressed:
+            self._pressed_at = at
+            self._consumed = False
+            if self._released_at is not None:
+                # Second press within the window
+                self._released_at = None
+                self._consumed = True
+                gestures.append((DOUBLE_PRESS, at))
+            return
+        if self._consumed:
+            return
+        if self.double_press > 0:
+            # Wait and see if this is the first of a double press
+            self._released_at = at
+            return
+        gestures.append((PRESS, at))
@@ -0,0 +1,68 @@
+"""
+Channel state
+
+The clubroom state of a single channel. Fields are changed through
+``update()``, which tells which of them actually changed, so callers can
+skip work when nothing changed.
+``status_since`` is when the status or extra last changed, unlike
+``topic_updated`` which every topic write moves.
+Instances use __slots__ and stay small however many channels there are.
+"""
+from datetime import datetime
+from typing import FrozenSet, Optional
+
+# Fields that make up the state, compared by update() and diff()
+FIELDS = ('presence', 'status', 'extra')
+# Changes to these move status_since
+STATUS_FIELDS = frozenset(['status', 'extra'])
+NO_CHANGES = frozenset()
+
+
+class ChannelState:
+    '''Presence, status and extra of a channel'''
+    __slots__ = FIELDS + ('topic_updated', 'status_since')
+
+    def __init__(self, presence: bool = False, status: str = 'closed',
+                 extra: str = '', topic_updated: Optional[datetime] = None,
+                 status_since: Optional[datetime] = None):
+        self.presence = presence
+        self.status = status
+        self.extra = extra
+        self.topic_updated = topic_updated or datetime.now()
+        self.status_since = status_since or self.topic_updated
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ChannelState':
+        return cls(bool(data.get('presence')), data.get('status') or 'closed',
+                   data.get('extra') or '', data.get('topic_updated'),
+                   data.get('status_since'))
+
+    def as_dict(self) -> dict:
+        return {'presence': self.presence, 'status': self.status,
+                'extra': self.extra, 'topic_updated': self.topic_updated,
+                'status_since': self.status_since}
+
+    def update(self, topic_updated: Optional[datetime] = None,
+               **fields) -> FrozenSet[str]:
+        '''Set fields, returns the names of the ones that changed'''
+        changed = frozenset(name for name, value in fields.items()
+                            if getattr(self, name) != value)
+        if topic_updated is not None:
+            self.topic_updated = topic_updated
+        if not changed:
+            return NO_CHANGES
+        for name in changed:
+            setattr(self, name, fields[name])
+        if changed & STATUS_FIELDS:
+            self.status_since = topic_updated or datetime.now()
+        return changed
+
+    def diff(self, other: 'ChannelState') -> dict:
+        '''{field: (ours, theirs)} for fields that differ from other'''
+        return {name: (getattr(self, name), getattr(other, name))
+                for name in FIELDS
+                if getattr(self, name) != getattr(other, name)}
+
+    def __repr__(self):
+        return 'ChannelState(presence={!r}, status={!r}, extra={!r})'.format(
+            self.presence, self.status, self.extra)
@@ -0,0 +1,107 @@
+"""
+Content filter
+
+Successor of the bannedwords and bannedusers checks of the legacy bot.
+Banned words are found with an Aho-Corasick automaton, so a line is
+scanned once no matter how many words there are, instead of once per word.
+Matching ignores case like the legacy checks did, and banned nicks are a
+set lookup.
+
+The lists can be swapped at any time with ``update()``, checks running at
+the same time see either the old or the new lists.
+"""
+from collections import deque
+from typing import Iterable, Optional
+
+# Reasons returned by ContentFilter.check()
+BANNED_USER = 'user'
+BANNED_WORD = 'word'
+
+
+class WordMatcher:
+    '''Finds any of words in a text in a single pass'''
+
+    def __init__(self, words: Iterable[str]):
+        self.words = frozenset(
+            word.casefold() for word in words if word.strip())
+        # Trie of the words, node 0 is the root
+        self._goto = [{}]
+        self._fail = [0]
+        # Word ending at the node or at any of its suffixes
+        self._output = [None]
+        for word in sorted(self.words):
+            self._add(word)
+        self._link()
+
+    def _add(self, word: str):
+        node = 0
+        for char in word:
+            child = self._goto[node].get(char)
+            if child is None:
+                child = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+                self._goto[node][char] = child
+            node = child
+        self._output[node] = word
+
+    def _link(self):
+        '''Point every node to its longest proper suffix in the trie'''
+        goto, fail, output = self._goto, self._fail, self._output
+        # Breadth first, suffixes are always shallower than the node
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                queue.append(child)
+                suffix = fail[node]
+                while suffix and char not in goto[suffix]:
+                    suffix = fail[suffix]
+                fail[child] = goto[suffix].get(char, 0)
+                if output[child] is None:
+                    output[child] = output[fail[child]]
+
+    def search(self, text: str) -> Optional[str]:
+        '''First word found in text, None if there are none'''
+        if not self.words:
+            return None
+        goto, fail, output = self._goto, self._fail, self._output
+        node = 0
+        for char in text.casefold():
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node] is not None:
+                return output[node]
+        return None
+
+
+class ContentFilter:
+    '''Banned nicks and words, ``check()`` may be called from any thread'''
+
+    def __init__(self, words: Iterable[str] = (), users: Iterable[str] = ()):
+        self._lists = (WordMatcher(()), frozenset())
+        self.update(words, users)
+
+    def update(self, words: Iterable[str], users: Iterable[str]) -> bool:
+        '''Replace the lists, returns True if they changed'''
+        matcher, banned = self._lists
+        words = frozenset(word.casefold() for word in words if word.strip())
+        users = frozenset(user.casefold() for user in users if user.strip())
+        if words == matcher.words and users == banned:
+            return False
+        if words != matcher.words:
+            matcher = WordMatcher(words)
+        # One assignment, readers never see a new matcher with old users
+        self._lists = (matcher, users)
+        return True
+
+    def check(self, nick: Optional[str], text: str) -> Optional[str]:
+        '''Reason to reject text from nick, None if it's fine'''
+        matcher, banned = self._lists
+        if nick and nick.casefold() in banned:
+            return BANNED_USER
+        if matcher.search(text) is not None:
+            return BANNED_WORD
+        return None
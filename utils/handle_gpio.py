@@ -1,27 +1,76 @@
 #!/usr/bin/env python3
 import os
-from datetime import datetime
+import queue
+import time
 from pathlib import Path
-from time import sleep
 import logging
 
 from gpiozero import LED, PWMLED, Button
 
+import button_gestures
+from button_gestures import GestureDetector
+from indicators import PATTERNS, IndicatorScheduler
+from metrics import REGISTRY, start_exporter
+from profiling import section, start_profiler
+from status_page import PageWriter
+from presence_ipc import PresenceLink
+from presence_watcher import PresenceWatcher
+
 PRESENCE_FILE = os.environ.get('PRESENCE_FILE', '/tmp/cortana.presence')
+# Channel the button reports for, unset means all of them
+PRESENCE_CHANNEL = os.environ.get('PRESENCE_CHANNEL') or None
+# Sockets for talking to Sopel, see presence_ipc.py
+GPIO_SOCKET = os.environ.get('GPIO_SOCKET', '/tmp/cortana.gpio.sock')
+SOPEL_SOCKET = os.environ.get('SOPEL_SOCKET', '/tmp/cortana.sopel.sock')
+# Prometheus metrics over HTTP on localhost, or rewritten to a file
+METRICS_PORT = int(os.environ['METRICS_PORT']) \
+    if os.environ.get('METRICS_PORT') else None
+METRICS_FILE = os.environ.get('METRICS_FILE') or None
+# Keep a static status page here for a web server, off when unset
+STATUS_PAGE = os.environ.get('STATUS_PAGE') or None
+# Profile the main loop into this directory, off when unset
+PROFILE_DIR = os.environ.get('CORTANA_PROFILE') or None
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0.1'))
+# Button timings in seconds, see button_gestures.py
+BUTTON_DEBOUNCE = float(os.environ.get(
+    'BUTTON_DEBOUNCE', button_gestures.DEBOUNCE))
+BUTTON_LONG_PRESS = float(os.environ.get(
+    'BUTTON_LONG_PRESS', button_gestures.LONG_PRESS_TIME))
+BUTTON_DOUBLE_PRESS = float(os.environ.get('BUTTON_DOUBLE_PRESS', '0.4'))
+# Status set by each gesture, a plain press toggles open and closed and an
+# empty status turns the gesture off
+GESTURE_STATUS = {
+    button_gestures.LONG_PRESS:
+        os.environ.get('BUTTON_LONG_PRESS_STATUS', 'reserved'),
+    button_gestures.DOUBLE_PRESS:
+        os.environ.get('BUTTON_DOUBLE_PRESS_STATUS', ''),
+}
+
+# Events delivered to the main loop as (event, value, time.monotonic())
+EVENT_PRESENCE = 'presence'
+EVENT_UPDATE = 'update'
+EVENT_BUTTON = 'button'
+# Not queued, the main loop woke up for a gesture timeout
+EVENT_TICK = 'tick'
+EVENT_STOP = 'stop'
+
+EVENTS = REGISTRY.counter(
+    'cortana_gpio_events_total', 'Events handled by the main loop', ['event'])
+EVENT_SECONDS = REGISTRY.histogram(
+    'cortana_gpio_event_seconds', 'Time spent handling an event', ['event'])
+QUEUE_SECONDS = REGISTRY.histogram(
+    'cortana_gpio_queue_seconds', 'Time events waited in the queue')
+INDICATOR_CHANGES = REGISTRY.counter(
+    'cortana_gpio_indicator_changes_total', 'Indicator pattern changes',
+    ['state'])
+GESTURES = REGISTRY.counter(
+    'cortana_gpio_gestures_total', 'Button gestures recognised', ['gesture'])
+PRESS_SECONDS = REGISTRY.histogram(
+    'cortana_gpio_press_seconds', 'Time from a button gesture being '
+    'decided to the new state being set')
 
-def main():
-    # setup
-    # See https://www.raspberrypi.org/documentation/usage/gpio/
-    # Pins are on the edge of the connector, right next to each-other
-    # Indicator should connect the positive side (anode, yellow wire) to GPIO pin 23
-    # and negative side (cathode, orange wire) to ground
-    # Button should connect 3V3 (blue wire) to GPIO pin 24 (green wire)
-    away_indicator = PWMLED(pin=18, active_high=False, initial_value=False)
-    home_indicator = LED(pin=23, active_high=False, initial_value=False)
-    button = Button(pin=17, pull_up=False)
-    button.when_held = handle_button
-    button.hold_time = 0.5
 
+def main():
     # Setup logging
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.DEBUG)
@@ -35,29 +84,162 @@ def main():
     # to the Sopel bot
     presence_file = Path(PRESENCE_FILE)
 
-    # Prime the state from file, defaults to False if file does not exist
-    last_state = state = read_state(presence_file)
+    # Everything the main loop reacts to arrives through this queue
+    events = queue.Queue()
+    away_indicator, home_indicator, button = setup_devices(events)
+    # One thread animates both LEDs
+    indicators = IndicatorScheduler(
+        {'home': home_indicator, 'away': away_indicator})
+    indicators.start()
+    watcher = watch_presence(presence_file, events)
+    link = connect_sopel(events)
+    exporter = start_exporter(METRICS_PORT, METRICS_FILE)
+    profiler = None
+    if PROFILE_DIR:
+        profiler = start_profiler(PROFILE_DIR, PROFILE_SAMPLE_RATE)
+
+    page = PageWriter(STATUS_PAGE) if STATUS_PAGE else None
+    gestures = GestureDetector(
+        BUTTON_DEBOUNCE, BUTTON_LONG_PRESS,
+        BUTTON_DOUBLE_PRESS if GESTURE_STATUS[button_gestures.DOUBLE_PRESS]
+        else 0.0)
 
     logger.info('Starting main loop')
+    try:
+        run(presence_file, events, indicators, link, page, gestures)
+    finally:
+        indicators.stop()
+        link.stop()
+        watcher.stop()
+        if exporter is not None:
+            exporter.stop()
+        if profiler is not None:
+            profiler.stop()
+
+
+def setup_devices(events: queue.Queue, pin_factory=None):
+    '''Create the indicators and the button, button presses go to events'''
+    # See https://www.raspberrypi.org/documentation/usage/gpio/
+    # Pins are on the edge of the connector, right next to each-other
+    # Indicator should connect the positive side (anode, yellow wire) to GPIO pin 23
+    # and negative side (cathode, orange wire) to ground
+    # Button should connect 3V3 (blue wire) to GPIO pin 24 (green wire)
+    away_indicator = PWMLED(pin=18, active_high=False, initial_value=False,
+                            pin_factory=pin_factory)
+    home_indicator = LED(pin=23, active_high=False, initial_value=False,
+                         pin_factory=pin_factory)
+    # Raw edges, debounced and classified by the main loop
+    button = Button(pin=17, pull_up=False, bounce_time=None,
+                    pin_factory=pin_factory)
+    button.when_pressed = lambda: events.put(
+        (EVENT_BUTTON, True, time.monotonic()))
+    button.when_released = lambda: events.put(
+        (EVENT_BUTTON, False, time.monotonic()))
+    return away_indicator, home_indicator, button
+
+
+def watch_presence(presence_file: Path, events: queue.Queue) -> PresenceWatcher:
+    '''Start a watcher pushing presence file changes to events'''
+    watcher = PresenceWatcher(
+        presence_file.parent,
+        lambda name, present: events.put(
+            (EVENT_PRESENCE, present, time.monotonic())),
+        match=lambda name: name == presence_file.name)
+    watcher.start()
+    return watcher
+
+
+def connect_sopel(events: queue.Queue) -> PresenceLink:
+    '''Start listening for state updates from Sopel'''
+    def handle_update(update):
+        # Updates for other channels are none of our business
+        if PRESENCE_CHANNEL is None or update.channel in (None, PRESENCE_CHANNEL):
+            events.put((EVENT_UPDATE, update, time.monotonic()))
+
+    link = PresenceLink('gpio', GPIO_SOCKET, SOPEL_SOCKET, handle_update)
+    link.start()
+    return link
+
+
+def run(presence_file: Path, events: queue.Queue,
+        indicators: IndicatorScheduler, link: PresenceLink = None,
+        page: PageWriter = None, gestures: GestureDetector = None):
+    '''Block on events and keep the indicators in sync until stopped'''
+    if gestures is None:
+        gestures = GestureDetector()
+    # Prime the state from file, defaults to False if file does not exist
+    state = read_state(presence_file)
+    # Status and extra shown on the page, only Sopel knows the extra
+    shown = {'status': 'open' if state else 'closed', 'extra': ''}
+    set_indicators(shown['status'], indicators)
+    if page is not None:
+        page.publish({PRESENCE_CHANNEL: shown})
 
     while True:
-        # Update the state from file
-        state = read_state(presence_file)
+        # Sleeps until the button or the file changes, or a gesture is due
+        now = time.monotonic()
+        try:
+            event, value, queued_at = events.get(
+                timeout=gestures.timeout(now))
+        except queue.Empty:
+            event, value, queued_at = EVENT_TICK, None, time.monotonic()
+        if event == EVENT_STOP:
+            break
+        start = time.monotonic()
+        QUEUE_SECONDS.observe(start - queued_at)
+        EVENTS.labels(event).inc()
+        with section('gpio_' + event):
+            if event in (EVENT_BUTTON, EVENT_TICK):
+                found = gestures.edge(value, queued_at) \
+                    if event == EVENT_BUTTON else gestures.poll(start)
+                value = None
+                for gesture, decided_at in found:
+                    try:
+                        status = handle_gesture(presence_file, gesture)
+                    except OSError:
+                        logging.getLogger(__name__).exception(
+                            'Updating %s failed', presence_file)
+                        indicators.flash('error')
+                        continue
+                    if status is None:
+                        continue
+                    # Show the new state right away instead of waiting for
+                    # the watcher to echo our own file change back
+                    state = status != 'closed'
+                    shown = {'status': status, 'extra': ''}
+                    set_indicators(status, indicators)
+                    if link is not None:
+                        link.send(PRESENCE_CHANNEL, status, None, 'button')
+                    PRESS_SECONDS.observe(time.monotonic() - decided_at)
+            elif event == EVENT_UPDATE:
+                # Sopel also keeps the file in sync, this just gets here first
+                update, value = value, value.status in ['open', 'reserved']
+                shown = {'status': update.status,
+                         'extra': shown['extra'] if update.extra is None
+                         else update.extra}
 
-        # Check if state changed
-        if state != last_state:
-            # Set LED based on the state
-            if state:
-                home_indicator.on()
-                away_indicator.off()
-            else:
-                home_indicator.off()
-                away_indicator.pulse(fade_in_time=1, fade_out_time=3)
-            logger.info('Toggling LED state: %s', 'on' if state else 'off')
-            last_state = state
+            # Check if state changed
+            if event == EVENT_PRESENCE and value != state:
+                shown = {'status': 'open' if value else 'closed',
+                         'extra': ''}
+            if value is not None:
+                state = value
+            set_indicators(shown['status'], indicators)
+            if page is not None:
+                # Rewritten only if the page actually changed
+                page.publish({PRESENCE_CHANNEL: shown})
+        EVENT_SECONDS.labels(event).observe(time.monotonic() - start)
 
-        # Sleep before next round
-        sleep(0.5)
+
+def set_indicators(status: str, indicators: IndicatorScheduler):
+    '''Show the LED pattern for status'''
+    # Anything but closed means someone is there
+    pattern = status if status in PATTERNS else 'open'
+    if pattern == indicators.pattern:
+        return
+    indicators.show(pattern)
+    INDICATOR_CHANGES.labels(pattern).inc()
+    logging.getLogger(__name__).info('Showing LED pattern: %s', pattern)
 
 
 def read_state(presence_file: Path) -> bool:
@@ -67,15 +249,40 @@ def read_state(presence_file: Path) -> bool:
     return False
 
 
-def handle_button():
-    '''Toggle presence based on button input'''
-    presence_file = Path(PRESENCE_FILE)
+def handle_gesture(presence_file: Path, gesture: str):
+    '''Apply a button gesture to the presence file, returns the status'''
+    GESTURES.labels(gesture).inc()
+    if gesture == button_gestures.PRESS:
+        return handle_button(presence_file)
+    status = GESTURE_STATUS.get(gesture)
+    if not status:
+        return None
+    logging.getLogger(__name__).info('Setting local status: %s', status)
+    set_presence(presence_file, status != 'closed')
+    return status
+
+
+def handle_button(presence_file: Path) -> str:
+    '''Toggle presence based on button input, returns the new status'''
     if presence_file.exists():
         logging.getLogger(__name__).info('Toggling local presence state: absent')
-        presence_file.unlink()
-    else:
-        logging.getLogger(__name__).info('Toggling local presence state: present')
+        set_presence(presence_file, False)
+        return 'closed'
+    logging.getLogger(__name__).info('Toggling local presence state: present')
+    set_presence(presence_file, True)
+    return 'open'
+
+
+def set_presence(presence_file: Path, present: bool):
+    '''Create or remove the presence file'''
+    if present:
         presence_file.touch()
+        return
+    try:
+        presence_file.unlink()
+    except FileNotFoundError:
+        # Sopel beat us to it
+        pass
 
 
 if __name__ == "__main__":
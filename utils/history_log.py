@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Status history log
+
+Append-only binary log of clubroom state transitions, split into monthly
+segments (UTC) so old months are never touched again. Each segment has a
+sparse index of (timestamp, offset) pairs, so a time range query only reads
+the records inside the range plus at most INDEX_EVERY records before it.
+
+Record layout, little endian:
+    float64 timestamp, uint8 channel length, uint8 status length,
+    uint16 extra length, uint8 source length, then the UTF-8 strings
+"""
+import argparse
+import bisect
+import logging
+import os
+import struct
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional
+
+RECORD_HEADER = struct.Struct('<dBBHB')
+INDEX_ENTRY = struct.Struct('<dQ')
+# Add an index entry every this many records
+INDEX_EVERY = 64
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+
+logger = logging.getLogger(__name__)
+
+HistoryEvent = namedtuple(
+    'HistoryEvent', 'timestamp channel status extra source')
+
+
+def segment_name(timestamp: float) -> str:
+    '''Name of the segment holding timestamp, one per month'''
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m')
+
+
+def segment_bounds(name: str):
+    '''Return the [start, end) timestamps covered by a segment'''
+    start = datetime.strptime(name, '%Y-%m').replace(tzinfo=timezone.utc)
+    if start.month == 12:
+        end = start.replace(year=start.year + 1, month=1)
+    else:
+        end = start.replace(month=start.month + 1)
+    return start.timestamp(), end.timestamp()
+
+
+def _encode(field: str, limit: int) -> bytes:
+    '''Encode a field, cutting it at limit bytes without splitting chars'''
+    return field.encode('utf-8')[:limit].decode('utf-8', 'ignore') \
+        .encode('utf-8')
+
+
+def encode_record(timestamp: float, channel: str, status: str, extra: str,
+                  source: str) -> bytes:
+    channel = _encode(channel, 0xff)
+    status = _encode(status, 0xff)
+    extra = _encode(extra or '', 0xffff)
+    source = _encode(source, 0xff)
+    return RECORD_HEADER.pack(timestamp, len(channel), len(status),
+                              len(extra), len(source)) + \
+        channel + status + extra + source
+
+
+def read_records(handle, end: float = float('inf')) -> Iterator:
+    '''Yield (offset, timestamp, channel, status, extra, source) from handle
+
+    Stops at end of file, at the first record at or past end or at a torn
+    record left behind by a crash.
+    '''
+    while True:
+        offset = handle.tell()
+        header = handle.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        timestamp, *lengths = RECORD_HEADER.unpack(header)
+        if timestamp >= end:
+            return
+        body = handle.read(sum(lengths))
+        if len(body) < sum(lengths):
+            return
+        fields = []
+        position = 0
+        for length in lengths:
+            fields.append(body[position:position + length].decode('utf-8'))
+            position += length
+        yield (offset, timestamp, *fields)
+
+
+class HistoryLog:
+    '''Segmented, indexed, append-only log of state transitions'''
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._segment = None
+        self._log = None
+        self._index = None
+        self._count = 0
+        self._last = float('-inf')
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+    def _close_segment(self):
+        if self._log is not None:
+            self._log.close()
+            self._index.close()
+        self._segment = self._log = self._index = None
+
+    def _open_segment(self, name: str):
+        '''Open a segment for appending, repairing a torn tail'''
+        self._close_segment()
+        log_path = self.directory / (name + SEGMENT_SUFFIX)
+        entries = self._load_index(name)
+        self._count = 0
+        self._last = float('-inf')
+        offset = entries[-1][1] if entries else 0
+        if entries:
+            self._count = INDEX_EVERY * (len(entries) - 1)
+        good = offset
+        if log_path.exists():
+            with open(log_path, 'rb') as handle:
+                handle.seek(offset)
+                for record in read_records(handle):
+                    good = handle.tell()
+                    self._last = record[1]
+                    self._count += 1
+            if good < log_path.stat().st_size:
+                logger.warning('Truncating torn record at %d in %s',
+                               good, log_path)
+                os.truncate(log_path, good)
+        self._log = open(log_path, 'ab')
+        self._index = open(self.directory / (name + INDEX_SUFFIX), 'ab')
+        self._segment = name
+
+    def _read_index(self, name: str) -> list:
+        '''Read the usable entries from the index of a segment'''
+        try:
+            data = (self.directory / (name + INDEX_SUFFIX)).read_bytes()
+        except FileNotFoundError:
+            return []
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        return list(INDEX_ENTRY.iter_unpack(data[:usable]))
+
+    def _load_index(self, name: str) -> list:
+        '''Read the index of a segment, rebuilding it if it looks wrong'''
+        index_path = self.directory / (name + INDEX_SUFFIX)
+        log_path = self.directory / (name + SEGMENT_SUFFIX)
+        if not log_path.exists():
+            return []
+        entries = self._read_index(name)
+        size = log_path.stat().st_size
+        if index_path.exists() and \
+                index_path.stat().st_size == len(entries) * INDEX_ENTRY.size \
+                and all(offset <= size for _, offset in entries):
+            return entries
+
+        # Missing or damaged, rebuild from the log itself
+        logger.warning('Rebuilding history index for %s', name)
+        entries = []
+        with open(log_path, 'rb') as handle:
+            for number, record in enumerate(read_records(handle)):
+                if number % INDEX_EVERY == 0:
+                    entries.append((record[1], record[0]))
+        index_path.write_bytes(b''.join(
+            INDEX_ENTRY.pack(*entry) for entry in entries))
+        return entries
+
+    def append(self, channel: str, status: str, extra: str, source: str,
+               timestamp: Optional[float] = None):
+        '''Append a transition, timestamp defaults to now'''
+        if timestamp is None:
+            timestamp = datetime.now(timezone.utc).timestamp()
+        with self._lock:
+            name = segment_name(timestamp)
+            if name != self._segment:
+                self._open_segment(name)
+            # Keep the segment sorted even if the clock steps backwards
+            timestamp = max(timestamp, self._last)
+            offset = self._log.tell()
+            self._log.write(encode_record(
+                timestamp, channel, status, extra, source))
+            self._log.flush()
+            if self._count % INDEX_EVERY == 0:
+                self._index.write(INDEX_ENTRY.pack(timestamp, offset))
+                self._index.flush()
+            self._count += 1
+            self._last = timestamp
+
+    def segments(self) -> list:
+        '''Names of all segments, oldest first'''
+        return sorted(path.stem for path in
+                      self.directory.glob('*' + SEGMENT_SUFFIX))
+
+    def query(self, start: Optional[datetime] = None,
+              end: Optional[datetime] = None, channel: Optional[str] = None,
+              status: Optional[str] = None) -> Iterator[HistoryEvent]:
+        '''Yield events with start <= timestamp < end, oldest first
+
+        Naive datetimes are taken to be local time. Only segments
+        overlapping the range are opened and each one is entered through
+        its index.
+        '''
+        start = start.timestamp() if start else float('-inf')
+        end = end.timestamp() if end else float('inf')
+        with self._lock:
+            # Make sure everything we wrote is visible to the readers
+            if self._log is not None:
+                self._log.flush()
+        for name in self.segments():
+            first, last = segment_bounds(name)
+            if last <= start or first >= end:
+                continue
+            # Never rebuild here, the segment may be in the middle of a write
+            entries = self._read_index(name)
+            position = bisect.bisect_right(
+                [timestamp for timestamp, _ in entries], start) - 1
+            offset = entries[position][1] if position >= 0 else 0
+            with open(self.directory / (name + SEGMENT_SUFFIX), 'rb') as handle:
+                handle.seek(offset)
+                for record in read_records(handle, end):
+                    _, timestamp, *fields = record
+                    if timestamp < start:
+                        continue
+                    event = HistoryEvent(datetime.fromtimestamp(timestamp),
+                                         *fields)
+                    if channel is not None and event.channel != channel:
+                        continue
+                    if status is not None and event.status != status:
+                        continue
+                    yield event
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the status history')
+    parser.add_argument('directory', help='History log directory')
+    parser.add_argument('--since', type=datetime.fromisoformat,
+                        help='Start of range, ISO 8601 local time')
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        help='End of range (exclusive), ISO 8601 local time')
+    parser.add_argument('--channel', help='Only events for this channel')
+    parser.add_argument('--status', help='Only events with this status')
+    args = parser.parse_args()
+
+    history = HistoryLog(args.directory)
+    for event in history.query(args.since, args.until, args.channel,
+                               args.status):
+        print('{:%Y-%m-%d %H:%M:%S} {} {} {!r} ({})'.format(*event))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Indicator patterns
+
+Every LED pattern is a table of (value, seconds) frames per LED, computed
+once on import. A single thread plays the current pattern on all LEDs. It
+sleeps until the next frame is due and only writes values that change,
+instead of gpiozero starting a thread per blink() or pulse() that wakes
+up 25 times a second. Fades step through LEVELS brightness levels, the
+slow closed pulse wakes up 8 times a second. Steady patterns cost no
+wakeups at all.
+
+New patterns are added to PATTERNS with the helpers below. show() selects
+the pattern to keep playing, and flash() plays a non-repeating one on top
+of it once.
+"""
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from metrics import REGISTRY
+
+# Most frames per second in fades, same as gpiozero
+FPS = 25
+# Brightness steps, a fade takes one frame per step it crosses. More than
+# the eye tells apart on a LED would only cost wakeups
+LEVELS = 16
+
+# ((value, seconds), ...), None holds the value until the pattern changes
+Frames = Tuple[Tuple[float, Optional[float]], ...]
+
+WRITES = REGISTRY.counter(
+    'cortana_gpio_indicator_writes_total', 'LED values written', ['led'])
+WAKEUPS = REGISTRY.counter(
+    'cortana_gpio_indicator_wakeups_total', 'Indicator thread wakeups')
+
+
+class Pattern(NamedTuple):
+    # Frames for each LED by name, LEDs left out are switched off
+    leds: Dict[str, Frames]
+    repeat: bool = True
+
+
+def compress(frames) -> Frames:
+    '''Merge neighbouring frames with the same value'''
+    merged = []
+    for value, seconds in frames:
+        if merged and merged[-1][0] == value and merged[-1][1] is not None:
+            seconds = None if seconds is None else merged[-1][1] + seconds
+            merged[-1] = (value, seconds)
+        else:
+            merged.append((value, seconds))
+    return tuple(merged)
+
+
+def steady(value: float) -> Frames:
+    return ((value, None),)
+
+
+def blink(on_time: float, off_time: float, times: int = 1) -> Frames:
+    return ((1.0, on_time), (0.0, off_time)) * times
+
+
+def fade(start: float, end: float, seconds: float) -> Frames:
+    '''Linear fade from start to end'''
+    steps = max(1, min(int(seconds * FPS),
+                       round(abs(end - start) * LEVELS)))
+    return compress(
+        (round((start + (end - start) * step / steps) * LEVELS) / LEVELS,
+         seconds / steps)
+        for step in range(steps))
+
+
+def pulse(fade_in: float, fade_out: float) -> Frames:
+    return compress(fade(0.0, 1.0, fade_in) + fade(1.0, 0.0, fade_out))
+
+
+PATTERNS = {
+    'open': Pattern({'home': steady(1.0), 'away': steady(0.0)}),
+    'closed': Pattern({'home': steady(0.0), 'away': pulse(1, 3)}),
+    'reserved': Pattern({'home': blink(0.5, 0.5), 'away': steady(0.0)}),
+    'error': Pattern({'home': blink(0.1, 0.1, 5), 'away': blink(0.1, 0.1, 5)},
+                     repeat=False),
+}
+
+
+class _Track:
+    '''Playback position of a pattern on one LED'''
+    __slots__ = ('frames', 'index', 'due')
+
+    def __init__(self, frames: Frames, now: float):
+        self.frames = frames
+        self.index = 0
+        self.due = now
+
+
+class IndicatorScheduler(threading.Thread):
+    '''Plays PATTERNS on LEDs given by name, e.g. {'home': LED(23)}'''
+
+    def __init__(self, leds: dict, patterns: dict = PATTERNS):
+        super().__init__(name='indicators', daemon=True)
+        self.leds = leds
+        self.patterns = patterns
+        self.pattern = None
+        self._flashing = None
+        self._tracks = {}
+        self._written = {}
+        self._condition = threading.Condition()
+        self._stopping = False
+
+    def show(self, name: str):
+        '''Keep playing pattern name, does nothing if it already is'''
+        with self._condition:
+            if name == self.pattern:
+                return
+            self.pattern = name
+            if self._flashing is None:
+                self._play(name)
+
+    def flash(self, name: str):
+        '''Play a pattern once, then go back to the current one'''
+        with self._condition:
+            self._flashing = name
+            self._play(name)
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        with self._condition:
+            while not self._stopping:
+                WAKEUPS.inc()
+                self._condition.wait(self._step(time.monotonic()))
+
+    def _play(self, name: str):
+        '''Start pattern name from its first frame, caller locks'''
+        now = time.monotonic()
+        frames = self.patterns[name].leds
+        self._tracks = {led: _Track(frames.get(led, steady(0.0)), now)
+                        for led in self.leds}
+        self._condition.notify()
+
+    def _step(self, now: float) -> Optional[float]:
+        '''Write frames that are due, returns seconds until the next one'''
+        pattern = self.patterns.get(self._flashing or self.pattern)
+        if pattern is None:
+            return None
+        finished = True
+        for led, track in self._tracks.items():
+            while track.due is not None and track.due <= now:
+                if track.index == len(track.frames):
+                    if not pattern.repeat:
+                        track.due = None
+                        break
+                    track.index = 0
+                value, seconds = track.frames[track.index]
+                track.index += 1
+                self._write(led, value)
+                if seconds is None:
+                    track.due = None
+                # Scheduled from the previous frame so timing doesn't
+                # drift, unless we fell more than a frame behind
+                elif now - track.due > seconds:
+                    track.due = now + seconds
+                else:
+                    track.due += seconds
+            if track.due is not None:
+                finished = False
+
+        if finished and self._flashing is not None:
+            # Flash is over, back to the pattern it interrupted
+            self._flashing = None
+            if self.pattern is not None:
+                self._play(self.pattern)
+                return 0.0
+        due = [track.due for track in self._tracks.values()
+               if track.due is not None]
+        if not due:
+            return None
+        return max(0.0, min(due) - now)
+
+    def _write(self, led: str, value: float):
+        if self._written.get(led) == value:
+            return
+        self._written[led] = value
+        self.leds[led].value = value
+        WRITES.labels(led).inc()
@@ -0,0 +1,318 @@
+"""
+Runtime metrics
+
+Counters and latency histograms shared by the Sopel plugin and the GPIO
+daemon, exported in the Prometheus text format either over HTTP on a local
+port or as a file rewritten every few seconds for the node exporter's
+textfile collector.
+
+Recording only takes a lock and bumps a few numbers, so it stays on all the
+time; nothing is formatted until someone scrapes.
+"""
+import bisect
+import functools
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Sequence
+
+# Upper bounds in seconds, tuned for handlers that mostly take microseconds
+# and topic echoes that take up to a few seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = ''):
+    '''Format a label set, extra is an already formatted label'''
+    pairs = ['{}="{}"'.format(name, _escape(str(value)))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._children = {}
+        if not self.label_names:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        '''Child for a set of label values, keep it around on hot paths'''
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError('{} takes labels {}'.format(
+                    self.name, self.label_names))
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def render(self) -> list:
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.render(self.name, self.label_names, values))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name, label_names, values):
+        return ['{}{} {}'.format(name, _labels(label_names, values),
+                                 _number(self.value))]
+
+
+class Counter(_Metric):
+    '''Monotonic count, name should end in _total'''
+    kind = 'counter'
+    _child = _CounterChild
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class _HistogramChild:
+    __slots__ = ('_lock', '_bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self._lock = threading.Lock()
+        self._bounds = bounds
+        # One slot per bucket plus +Inf, cumulated when rendering
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self, name, label_names, values):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._bounds + (float('inf'),), counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                name, _labels(label_names, values,
+                              'le="{}"'.format(_number(bound))), cumulative))
+        labels = _labels(label_names, values)
+        lines.append('{}_sum{} {}'.format(name, labels, _number(total)))
+        lines.append('{}_count{} {}'.format(name, labels, cumulative))
+        return lines
+
+
+class Histogram(_Metric):
+    '''Distribution of observed values, seconds unless named otherwise'''
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+        super().__init__(name, documentation, labels)
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+
+class Registry:
+    '''Named set of metrics
+
+    Asking for a metric that already exists returns it, so a reloaded
+    module keeps counting where it left off.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('{} is already a {}'.format(
+                    name, metric.kind))
+            return metric
+
+    def counter(self, name: str, documentation: str,
+                labels: Sequence[str] = ()) -> Counter:
+        return self._get(Counter, name, documentation, labels)
+
+    def histogram(self, name: str, documentation: str,
+                  labels: Sequence[str] = (),
+                  buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, documentation, labels,
+                         buckets=buckets)
+
+    def render(self) -> str:
+        '''Everything in the Prometheus text format'''
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for _, metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+CALLS = REGISTRY.counter(
+    'cortana_calls_total', 'Calls per instrumented function', ['function'])
+ERRORS = REGISTRY.counter(
+    'cortana_errors_total', 'Calls that raised per instrumented function',
+    ['function'])
+DURATION = REGISTRY.histogram(
+    'cortana_call_duration_seconds', 'Time spent per instrumented function',
+    ['function'])
+
+
+def timed(name: str = None):
+    '''Decorator counting calls and errors and timing a function
+
+    functools.wraps also copies the attributes Sopel's decorators set, so
+    this can go either above or below them.
+    '''
+    def decorate(function):
+        label = name or function.__name__
+        calls = CALLS.labels(label)
+        errors = ERRORS.labels(label)
+        duration = DURATION.labels(label)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            calls.inc()
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                duration.observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+class MetricsServer(threading.Thread):
+    '''Serve the registry over HTTP, GET on any path returns everything'''
+
+    def __init__(self, port: int, host: str = '127.0.0.1',
+                 registry: Registry = REGISTRY):
+        super().__init__(name='metrics-server', daemon=True)
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry_.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes every few seconds would drown everything else
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        if self.is_alive():
+            self.server.shutdown()
+            self.join()
+        self.server.server_close()
+
+
+class MetricsFile(threading.Thread):
+    '''Rewrite the registry to path every interval seconds
+
+    The file is replaced atomically so readers never see half of it.
+    '''
+
+    def __init__(self, path, interval: float = 15.0,
+                 registry: Registry = REGISTRY):
+        super().__init__(name='metrics-file', daemon=True)
+        self.path = str(path)
+        self.interval = interval
+        self.registry = registry
+        self._stopping = threading.Event()
+
+    def write(self):
+        temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(temporary, 'w') as handle:
+                handle.write(self.registry.render())
+            os.replace(temporary, self.path)
+        except OSError:
+            logger.exception('Writing metrics to %s failed', self.path)
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        '''Write one last time and wait for the thread to exit'''
+        self._stopping.set()
+        if self.is_alive():
+            self.join()
+        self.write()
+
+
+def start_exporter(port: int = None, path=None, host: str = '127.0.0.1'):
+    '''Start whichever exporter is configured, None if neither is'''
+    if port is not None:
+        exporter = MetricsServer(port, host)
+    elif path:
+        exporter = MetricsFile(path)
+    else:
+        return None
+    exporter.start()
+    return exporter
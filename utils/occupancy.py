@@ -0,0 +1,174 @@
+"""
+Occupancy statistics
+
+Open time per hour of the week and per ISO week, kept up to date on every
+status transition. Rebuilding from the history log bins all intervals in
+one go with NumPy when it's installed and falls back to plain Python.
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+HOURS_PER_WEEK = 7 * 24
+# Hour-of-week bins start on a Monday at midnight, local time
+EPOCH = datetime(1970, 1, 5)
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+BARS = ' ▁▂▃▄▅▆▇█'
+# Re-render at most this often while the room is open
+OPEN_RENDER_INTERVAL = 300
+
+
+def local_seconds(timestamp: datetime) -> float:
+    '''Seconds since EPOCH in local wall clock time'''
+    return (timestamp - EPOCH).total_seconds()
+
+
+def is_open(status: str) -> bool:
+    return status != 'closed'
+
+
+def week_label(week: int) -> str:
+    '''ISO week label for a week number counted from EPOCH'''
+    year, number, _ = (EPOCH + timedelta(weeks=week)).isocalendar()
+    return '{}-W{:02d}'.format(year, number)
+
+
+class OccupancyStats:
+    '''Open time aggregates for a single channel'''
+
+    def __init__(self):
+        self.hours = [0.0] * HOURS_PER_WEEK
+        self.weeks = {}
+        self.open_since = None
+        self.version = 0
+        self._lock = threading.Lock()
+        self._rendered = None
+        self._rendered_key = None
+
+    def transition(self, timestamp: datetime, status: str):
+        '''Feed a status transition'''
+        with self._lock:
+            if is_open(status):
+                if self.open_since is None:
+                    self.open_since = timestamp
+            elif self.open_since is not None:
+                self._add(local_seconds(self.open_since),
+                          local_seconds(timestamp))
+                self.open_since = None
+                self.version += 1
+
+    def _add(self, start: float, end: float):
+        '''Add an open interval hour by hour, caller locks'''
+        while start < end:
+            hour = int(start // 3600)
+            step = min(end, (hour + 1) * 3600) - start
+            self.hours[hour % HOURS_PER_WEEK] += step
+            week = hour // HOURS_PER_WEEK
+            self.weeks[week] = self.weeks.get(week, 0.0) + step
+            start += step
+
+    @classmethod
+    def rebuild(cls, events) -> dict:
+        '''Build stats per channel from (timestamp, channel, status) events'''
+        intervals = {}
+        open_since = {}
+        for timestamp, channel, status in events:
+            if is_open(status):
+                open_since.setdefault(channel, timestamp)
+            elif channel in open_since:
+                intervals.setdefault(channel, []).append(
+                    (local_seconds(open_since.pop(channel)),
+                     local_seconds(timestamp)))
+            intervals.setdefault(channel, [])
+
+        stats = {}
+        for channel, spans in intervals.items():
+            stats[channel] = channel_stats = cls()
+            if numpy is not None and spans:
+                channel_stats._bin(numpy.array(spans, dtype=float))
+            else:
+                for start, end in spans:
+                    channel_stats._add(start, end)
+            channel_stats.open_since = open_since.get(channel)
+        return stats
+
+    def _bin(self, spans):
+        '''Vectorized _add() for an (n, 2) array of intervals'''
+        starts, ends = spans[:, 0], spans[:, 1]
+        first = int(starts.min() // 3600)
+        count = int(ends.max() // 3600) - first + 1
+        start_hour = (starts // 3600).astype(int) - first
+        end_hour = (ends // 3600).astype(int) - first
+
+        # Seconds open per absolute hour: whole hours through a difference
+        # array, partial hours at both ends added directly
+        whole = numpy.zeros(count + 1)
+        numpy.add.at(whole, start_hour + 1, 1)
+        numpy.add.at(whole, numpy.maximum(end_hour, start_hour + 1), -1)
+        seconds = numpy.cumsum(whole)[:count] * 3600
+        same = start_hour == end_hour
+        numpy.add.at(seconds, start_hour[same], (ends - starts)[same])
+        numpy.add.at(seconds, start_hour[~same],
+                     ((start_hour + first + 1) * 3600 - starts)[~same])
+        numpy.add.at(seconds, end_hour[~same],
+                     (ends - (end_hour + first) * 3600)[~same])
+
+        absolute = numpy.arange(first, first + count)
+        hours = numpy.bincount(absolute % HOURS_PER_WEEK, weights=seconds,
+                               minlength=HOURS_PER_WEEK)
+        weeks = absolute // HOURS_PER_WEEK
+        week_totals = numpy.bincount(weeks - weeks[0], weights=seconds)
+        with self._lock:
+            self.hours = [total + extra for total, extra
+                          in zip(self.hours, hours.tolist())]
+            for offset, total in enumerate(week_totals.tolist()):
+                if total:
+                    week = int(weeks[0]) + offset
+                    self.weeks[week] = self.weeks.get(week, 0.0) + total
+            self.version += 1
+
+    def render(self, now: datetime = None) -> list:
+        '''Reply lines, cached until the stats change'''
+        now = now or datetime.now()
+        with self._lock:
+            key = self.version
+            if self.open_since is not None:
+                key = (self.version, int(time.time() // OPEN_RENDER_INTERVAL))
+            if key != self._rendered_key:
+                self._rendered = self._render(now)
+                self._rendered_key = key
+            return self._rendered
+
+    def _render(self, now: datetime) -> list:
+        '''Build the reply lines, caller locks'''
+        hours = list(self.hours)
+        weeks = dict(self.weeks)
+        if self.open_since is not None:
+            # Count the ongoing session without committing it
+            ongoing = OccupancyStats()
+            ongoing._add(local_seconds(self.open_since), local_seconds(now))
+            hours = [a + b for a, b in zip(hours, ongoing.hours)]
+            for week, total in ongoing.weeks.items():
+                weeks[week] = weeks.get(week, 0.0) + total
+
+        this_week = int(local_seconds(now) // 3600) // HOURS_PER_WEEK
+        totals = ', '.join(
+            '{} {:.1f}h'.format(week_label(week), weeks.get(week, 0.0) / 3600)
+            for week in range(this_week - 3, this_week + 1))
+        lines = ['Open time per week: ' + totals]
+
+        # Share of recorded weeks each hour was open, as a bar per hour
+        recorded = this_week - min(weeks, default=this_week) + 1
+        for day, name in enumerate(DAYS):
+            bars = ''.join(
+                BARS[min(len(BARS) - 1, round(
+                    hours[day * 24 + hour] / (3600 * recorded) *
+                    (len(BARS) - 1)))]
+                for hour in range(24))
+            lines.append('{} |{}|'.format(name, bars))
+        return lines
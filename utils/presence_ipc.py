@@ -0,0 +1,193 @@
+"""
+Presence IPC
+
+Datagram protocol over Unix domain sockets between the GPIO daemon and the
+Sopel plugin. Each side binds its own socket and sends JSON encoded state
+updates to the other. Every update carries a sequence number from a hybrid
+logical clock (wall clock milliseconds, bumped past anything seen from the
+peer), so both sides order concurrent updates the same way: higher sequence
+wins and ties go to the lexically greater origin.
+
+The presence file stays the source of truth for anything not speaking this
+protocol, sending silently does nothing if the peer is not listening.
+"""
+import json
+import logging
+import socket
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+from typing import Callable, Optional
+
+# Largest datagram we are willing to read
+MAX_DATAGRAM = 4096
+# Statuses an update may carry, status and reporting are kept as is by the
+# plugin's status command
+STATUSES = frozenset(['open', 'closed', 'reserved', 'status', 'reporting'])
+# Milliseconds a sequence number may be ahead of our wall clock, one from
+# far in the future would drag our clock along for good
+MAX_SKEW = 3600 * 1000
+
+logger = logging.getLogger(__name__)
+
+PresenceUpdate = namedtuple(
+    'PresenceUpdate', 'channel status extra source seq origin')
+PresenceUpdate.__doc__ = '''A single state change
+
+``channel`` is None for updates about every channel the sender knows of and
+``extra`` is None when the sender does not know or care about it.
+'''
+
+
+def encode(update: PresenceUpdate) -> bytes:
+    return json.dumps(update._asdict(), separators=(',', ':')).encode('utf-8')
+
+
+def decode(data: bytes) -> PresenceUpdate:
+    '''Parse a datagram, raises ValueError on anything malformed'''
+    try:
+        fields = json.loads(data.decode('utf-8'))
+        update = PresenceUpdate(**fields)
+    except (UnicodeDecodeError, TypeError, RecursionError) as error:
+        raise ValueError(str(error)) from error
+    # Anyone able to write to the socket can send these, the fields end up
+    # as dict keys and in the topic
+    if isinstance(update.seq, bool) or not isinstance(update.seq, int) or \
+            update.seq < 0 or \
+            not isinstance(update.status, str) or \
+            update.status not in STATUSES or \
+            not isinstance(update.origin, str) or \
+            not isinstance(update.source, str) or \
+            not all(value is None or isinstance(value, str)
+                    for value in (update.channel, update.extra)):
+        raise ValueError('Malformed update: {!r}'.format(fields))
+    return update
+
+
+class PresenceLink:
+    '''One end of the presence IPC channel
+
+    ``callback(update)`` is called from the receiver thread for every update
+    from the peer that is newer than anything seen for its channel.
+    '''
+
+    def __init__(self, origin: str, path, peer_path,
+                 callback: Callable[[PresenceUpdate], None]):
+        self.origin = origin
+        self.path = Path(path)
+        self.peer_path = Path(peer_path)
+        self.callback = callback
+        self._clock = 0
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._socket = None
+        self._thread = None
+
+    def start(self):
+        '''Bind our socket and start receiving updates'''
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(str(self.path))
+        self._thread = threading.Thread(
+            target=self._receive, name='presence-ipc', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Close the socket and wait for the receiver to exit'''
+        if self._socket is None:
+            return
+        # Wake up the receiver with an empty datagram
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        waker = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            waker.sendto(b'', str(self.path))
+        except OSError:
+            pass
+        finally:
+            waker.close()
+        self._thread.join()
+        self._socket.close()
+        self._socket = None
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def _tick(self, seen: int = 0) -> int:
+        '''Advance the clock past now and past anything seen, caller locks'''
+        self._clock = max(self._clock + 1, seen + 1, int(time.time() * 1000))
+        return self._clock
+
+    def _newer(self, update: PresenceUpdate) -> bool:
+        '''Check if update beats the latest one for its channel, caller locks'''
+        if update.channel is None:
+            # Has to beat every channel to apply to all of them
+            known = list(self._latest.values())
+        else:
+            known = [self._latest.get(update.channel), self._latest.get(None)]
+        for latest in known:
+            if latest is not None and \
+                    (update.seq, update.origin) <= (latest.seq, latest.origin):
+                return False
+        if update.channel is None:
+            # Channel wide update supersedes everything before it
+            self._latest.clear()
+        self._latest[update.channel] = update
+        return True
+
+    def send(self, channel: Optional[str], status: str,
+             extra: Optional[str], source: str) -> PresenceUpdate:
+        '''Stamp a local change and send it to the peer'''
+        with self._lock:
+            update = PresenceUpdate(channel, status, extra, source,
+                                    self._tick(), self.origin)
+            self._newer(update)
+        if self._socket is not None:
+            try:
+                self._socket.sendto(encode(update), str(self.peer_path))
+            except (FileNotFoundError, ConnectionRefusedError):
+                # Peer is not running, the presence file covers for it
+                pass
+            except OSError as error:
+                logger.warning('Sending presence update failed: %s', error)
+        return update
+
+    def _receive(self):
+        while True:
+            try:
+                data = self._socket.recv(MAX_DATAGRAM)
+            except OSError:
+                return
+            if not data:
+                # Empty datagram from stop()
+                return
+            # Nothing a peer sends may end the receiver
+            try:
+                self._handle(data)
+            except Exception:
+                logger.exception('Handling presence update failed')
+
+    def _handle(self, data: bytes):
+        try:
+            update = decode(data)
+        except ValueError as error:
+            logger.warning('Dropping malformed presence update: %s', error)
+            return
+        if update.seq > time.time() * 1000 + MAX_SKEW:
+            logger.warning('Dropping presence update from the future: %r',
+                           update)
+            return
+        with self._lock:
+            self._tick(update.seq)
+            accepted = self._newer(update)
+        if not accepted:
+            logger.debug('Ignoring stale presence update %r', update)
+            return
+        self.callback(update)
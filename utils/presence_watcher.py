@@ -0,0 +1,189 @@
+"""
+Presence file watcher
+
+Watches a directory for presence files appearing and disappearing and
+reports the changes through a callback. Uses inotify when the platform
+provides it and falls back to polling the directory otherwise.
+"""
+import ctypes
+import logging
+import os
+import select
+import struct
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+
+# inotify(7) event masks we care about
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+WATCH_MASK = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+
+logger = logging.getLogger(__name__)
+
+
+def _load_inotify():
+    '''Return libc with inotify bindings or None if not available'''
+    try:
+        # The running interpreter is already linked against libc
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class PresenceWatcher(threading.Thread):
+    '''Background thread reporting presence file changes in a directory
+
+    ``callback(name, present)`` is called from the watcher thread for each
+    file name accepted by ``match`` whenever the file is created or removed.
+    On startup and after an inotify queue overflow, the directory is
+    rescanned and every change since the last known state is reported.
+    '''
+
+    def __init__(self, directory, callback: Callable[[str, bool], None],
+                 match: Optional[Callable[[str], bool]] = None,
+                 poll_interval: float = 5.0, use_inotify: bool = True):
+        super().__init__(name='presence-watcher', daemon=True)
+        self.directory = Path(directory)
+        self.callback = callback
+        self.match = match or (lambda name: True)
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.backend = None
+        self._known = set()
+        self._stop_r, self._stop_w = os.pipe()
+
+    def stop(self):
+        '''Ask the watcher to exit and wait for it'''
+        if self._stop_w is None:
+            return
+        os.write(self._stop_w, b'\0')
+        if self.is_alive():
+            self.join()
+        os.close(self._stop_r)
+        os.close(self._stop_w)
+        self._stop_r = self._stop_w = None
+
+    def start(self):
+        # Take the baseline before returning so the caller can do its own
+        # initial sync without racing the watcher
+        self._known = self._scan()
+        super().start()
+
+    def run(self):
+        if not (self.use_inotify and self._run_inotify()):
+            self._run_polling()
+
+    def _scan(self) -> set:
+        '''Return the set of matching file names currently present'''
+        try:
+            with os.scandir(self.directory) as entries:
+                return {entry.name for entry in entries
+                        if self.match(entry.name)}
+        except OSError:
+            return set()
+
+    def _rescan(self):
+        '''Diff the directory against the last known state'''
+        current = self._scan()
+        for name in sorted(current - self._known):
+            self._emit(name, True)
+        for name in sorted(self._known - current):
+            self._emit(name, False)
+
+    def _emit(self, name: str, present: bool):
+        '''Record and report a single change'''
+        if present:
+            self._known.add(name)
+        else:
+            self._known.discard(name)
+        try:
+            self.callback(name, present)
+        except Exception:
+            logger.exception('Presence callback failed for %s', name)
+
+    def _stopping(self, timeout: Optional[float]) -> bool:
+        '''Wait for the stop pipe, returning True if stop was requested'''
+        ready, _, _ = select.select([self._stop_r], [], [], timeout)
+        return bool(ready)
+
+    def _run_polling(self):
+        self.backend = 'polling'
+        logger.info('Polling %s every %.1fs', self.directory,
+                    self.poll_interval)
+        while not self._stopping(self.poll_interval):
+            self._rescan()
+
+    def _run_inotify(self) -> bool:
+        '''Watch using inotify, returns False if inotify is unavailable'''
+        libc = _load_inotify()
+        if libc is None:
+            return False
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return False
+        try:
+            wd = libc.inotify_add_watch(
+                fd, os.fsencode(str(self.directory)), WATCH_MASK)
+            if wd < 0:
+                logger.warning('inotify_add_watch failed for %s: %s',
+                               self.directory,
+                               os.strerror(ctypes.get_errno()))
+                return False
+            self.backend = 'inotify'
+            logger.info('Watching %s with inotify', self.directory)
+            # Catch anything that changed between the scan and the watch
+            self._rescan()
+            while True:
+                ready, _, _ = select.select([fd, self._stop_r], [], [])
+                if self._stop_r in ready:
+                    return True
+                if not self._read_events(fd):
+                    # Directory itself went away, fall back to polling
+                    logger.warning('Lost inotify watch on %s',
+                                   self.directory)
+                    return False
+        finally:
+            os.close(fd)
+
+    def _read_events(self, fd: int) -> bool:
+        '''Drain pending inotify events, returns False if the watch died'''
+        try:
+            buffer = os.read(fd, 64 * (EVENT_HEADER.size + 256))
+        except BlockingIOError:
+            return True
+        offset = 0
+        while offset < len(buffer):
+            _, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            name = os.fsdecode(name)
+
+            if mask & IN_Q_OVERFLOW:
+                self._rescan()
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                return False
+            elif not name or not self.match(name):
+                continue
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                if name not in self._known:
+                    self._emit(name, True)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                if name in self._known:
+                    self._emit(name, False)
+        return True
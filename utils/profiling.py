@@ -0,0 +1,195 @@
+"""
+On-demand profiling
+
+Off unless start_profiler() is called, the wrapped functions then only
+check a module global. When on, a random sample of calls to each profiled
+section runs under cProfile and tracemalloc tracks allocations; every
+interval the collected stats and the allocation growth since the last
+report are written to a timestamped report, keeping the newest few.
+"""
+import contextlib
+import cProfile
+import functools
+import io
+import logging
+import pstats
+import random
+import threading
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+REPORT_PREFIX = 'profile-'
+REPORT_SUFFIX = '.txt'
+# Rows per section and allocation sites per report
+TOP_FUNCTIONS = 25
+TOP_ALLOCATIONS = 20
+
+logger = logging.getLogger(__name__)
+
+# The running profiler, None when profiling is off
+PROFILER = None
+NULL_SECTION = contextlib.nullcontext()
+
+
+class Profiler(threading.Thread):
+    '''Sampling profiler writing a report to directory every interval'''
+
+    def __init__(self, directory, sample_rate: float = 0.1,
+                 interval: float = 300.0, keep: int = 20, frames: int = 10):
+        super().__init__(name='profiler', daemon=True)
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.keep = keep
+        self.frames = frames
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {}
+        self._calls = {}
+        self._sampled = {}
+        self._snapshot = None
+        self._stopping = threading.Event()
+
+    @contextlib.contextmanager
+    def section(self, name: str):
+        '''Profile the block if it's picked for sampling'''
+        with self._lock:
+            self._calls[name] = self._calls.get(name, 0) + 1
+        # cProfile can only have one profiler per thread
+        if getattr(self._local, 'active', False) or \
+                random.random() >= self.sample_rate:
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Someone else is profiling this thread
+            yield
+            return
+        self._local.active = True
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.active = False
+            self._add(name, profile)
+
+    def _add(self, name: str, profile: cProfile.Profile):
+        with self._lock:
+            self._sampled[name] = self._sampled.get(name, 0) + 1
+            stats = self._stats.get(name)
+            if stats is None:
+                self._stats[name] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+
+    def start(self):
+        tracemalloc.start(self.frames)
+        self._snapshot = self._take_snapshot()
+        super().start()
+
+    @staticmethod
+    def _take_snapshot() -> tracemalloc.Snapshot:
+        '''Snapshot of allocations, leaving out our own bookkeeping'''
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, module.__file__)
+            for module in (tracemalloc, cProfile, pstats, __import__(__name__))
+        ])
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        '''Write a last report and turn profiling off'''
+        global PROFILER
+        if PROFILER is self:
+            PROFILER = None
+        self._stopping.set()
+        if self.is_alive():
+            self.join()
+        self.report()
+        tracemalloc.stop()
+
+    def report(self):
+        '''Write out and reset everything collected since the last report'''
+        with self._lock:
+            stats, self._stats = self._stats, {}
+            calls, self._calls = self._calls, {}
+            sampled, self._sampled = self._sampled, {}
+        now = datetime.now()
+        out = io.StringIO()
+        out.write('Profile report {:%Y-%m-%d %H:%M:%S}, sampling {:.0%} '
+                  'of calls\n'.format(now, self.sample_rate))
+
+        for name in sorted(calls):
+            out.write('\n== {}: {} calls, {} sampled\n'.format(
+                name, calls[name], sampled.get(name, 0)))
+            if name in stats:
+                stats[name].stream = out
+                stats[name].sort_stats('cumulative').print_stats(
+                    TOP_FUNCTIONS)
+
+        if tracemalloc.is_tracing():
+            snapshot = self._take_snapshot()
+            out.write('\n== Allocation growth since the last report\n')
+            for difference in snapshot.compare_to(
+                    self._snapshot, 'lineno')[:TOP_ALLOCATIONS]:
+                out.write('{}\n'.format(difference))
+            self._snapshot = snapshot
+
+        path = self.directory / '{}{:%Y%m%d-%H%M%S-%f}{}'.format(
+            REPORT_PREFIX, now, REPORT_SUFFIX)
+        try:
+            path.write_text(out.getvalue())
+        except OSError:
+            logger.exception('Writing profile report %s failed', path)
+            return
+        self._rotate()
+
+    def _rotate(self):
+        '''Remove all but the newest keep reports'''
+        reports = sorted(self.directory.glob(
+            REPORT_PREFIX + '*' + REPORT_SUFFIX))
+        for path in reports[:-self.keep]:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def start_profiler(directory, sample_rate: float = 0.1,
+                   interval: float = 300.0) -> Profiler:
+    '''Turn profiling on, stop() the returned profiler to turn it off'''
+    global PROFILER
+    profiler = Profiler(directory, sample_rate, interval)
+    profiler.start()
+    PROFILER = profiler
+    return profiler
+
+
+def section(name: str):
+    '''Context manager profiling a block, does nothing when profiling is off'''
+    profiler = PROFILER
+    if profiler is None:
+        return NULL_SECTION
+    return profiler.section(name)
+
+
+def profiled(name: str = None):
+    '''Decorator profiling a function under its own name'''
+    def decorate(function):
+        label = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = PROFILER
+            if profiler is None:
+                return function(*args, **kwargs)
+            with profiler.section(label):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
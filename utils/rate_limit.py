@@ -0,0 +1,108 @@
+"""
+Rate limiting
+
+Token buckets, and a table of them keyed by nick or channel for limiting
+commands. The table forgets buckets that have filled up again, since those
+behave exactly like new ones, and past max_keys the least recently used
+ones. Its size stays bounded however many nicks come and go.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# Results of RateLimiter.check()
+ALLOWED = 'allowed'
+# First refusal since the key was last allowed, worth telling the user
+LIMITED = 'limited'
+# Refused again, already told
+IGNORED = 'ignored'
+
+
+class TokenBucket:
+    '''Allows rate events per second with bursts of up to capacity'''
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        '''Seconds until a token is available, 0 if there is one'''
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        '''Empty the bucket and keep it empty for at least seconds'''
+        self.delay()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class _Entry:
+    __slots__ = ('bucket', 'warned')
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.warned = False
+
+
+class RateLimiter:
+    '''A token bucket per key, ``check()`` may be called from any thread
+
+    A rate of 0 or less allows everything.
+    '''
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 1024):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.unlimited = rate <= 0
+        # Seconds for an empty bucket to fill up again
+        self.refill = 0.0 if self.unlimited else burst / rate
+        # Least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def check(self, key) -> str:
+        '''Take a token for key, returns ALLOWED, LIMITED or IGNORED'''
+        if self.unlimited:
+            return ALLOWED
+        with self._lock:
+            self._evict(time.monotonic())
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(
+                    TokenBucket(self.rate, self.burst))
+                if len(self._entries) > self.max_keys:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+            if entry.bucket.delay():
+                if entry.warned:
+                    return IGNORED
+                entry.warned = True
+                return LIMITED
+            entry.bucket.take()
+            entry.warned = False
+            return ALLOWED
+
+    def _evict(self, now: float):
+        '''Drop buckets that have been idle long enough to be full again'''
+        entries = self._entries
+        while entries:
+            entry = next(iter(entries.values()))
+            if now - entry.bucket.updated < self.refill:
+                # The rest were used even more recently
+                return
+            entries.popitem(last=False)
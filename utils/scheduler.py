@@ -0,0 +1,104 @@
+"""
+Deadline scheduler
+
+Runs callbacks at given wall clock times from a single thread. Pending
+calls are kept in a heap and the thread sleeps until the earliest one is
+due, so nothing runs between deadlines however many there are. Every
+call has a key. Scheduling a key again replaces its pending call, which
+makes rules easy to recompute from scratch whenever the state changes.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Hashable
+
+# Longest single sleep in seconds, wall clock jumps (NTP setting the clock
+# of a Pi without an RTC) are noticed at least this often
+MAX_SLEEP = 3600.0
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(threading.Thread):
+    '''Calls ``callback()`` at ``when`` (a time.time() timestamp) by key'''
+
+    def __init__(self):
+        super().__init__(name='scheduler', daemon=True)
+        # [when, sequence, key, callback], callback is None once cancelled
+        self._heap = []
+        self._entries = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+
+    def schedule(self, key: Hashable, when: float, callback: Callable):
+        '''Call callback at when, replacing anything pending for key'''
+        with self._condition:
+            self._cancel(key)
+            entry = [when, next(self._sequence), key, callback]
+            self._entries[key] = entry
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                # New earliest deadline, sleep less
+                self._condition.notify()
+
+    def cancel(self, key: Hashable):
+        with self._condition:
+            self._cancel(key)
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._entries)
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while True:
+            with self._condition:
+                due = self._wait()
+                if due is None:
+                    return
+            # Outside the lock, callbacks may schedule more
+            for key, callback in due:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception('Scheduled call %r failed', key)
+
+    def _wait(self):
+        '''Sleep until something is due, caller locks'''
+        while not self._stopping:
+            now = time.time()
+            due = []
+            while self._heap and (self._heap[0][3] is None or
+                                  self._heap[0][0] <= now):
+                _, _, key, callback = heapq.heappop(self._heap)
+                if callback is not None:
+                    del self._entries[key]
+                    due.append((key, callback))
+            if due:
+                return due
+            timeout = MAX_SLEEP
+            if self._heap:
+                timeout = min(timeout, self._heap[0][0] - now)
+            self._condition.wait(timeout)
+        return None
+
+    def _cancel(self, key: Hashable):
+        '''Caller locks'''
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        # Left in the heap until it comes up, unless they pile up
+        entry[3] = None
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [entry for entry in self._heap
+                          if entry[3] is not None]
+            heapq.heapify(self._heap)
@@ -0,0 +1,128 @@
+"""
+Clubroom state store
+
+Keeps the latest state of each channel in SQLite so it survives restarts.
+Writes are handed to a background thread which coalesces them per channel
+and flushes them in a single transaction.
+"""
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS clubroom_status (
+    channel TEXT PRIMARY KEY,
+    presence INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    extra TEXT NOT NULL,
+    topic_updated REAL NOT NULL,
+    status_since REAL
+)
+'''
+# Columns added since the table was first created, with their types
+ADDED_COLUMNS = [('status_since', 'REAL')]
+
+
+def connect(path) -> sqlite3.Connection:
+    connection = sqlite3.connect(str(path))
+    connection.execute('PRAGMA journal_mode=WAL')
+    # WAL keeps the database consistent, losing the last flush on power
+    # loss is fine
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute(SCHEMA)
+    columns = {row[1] for row in
+               connection.execute('PRAGMA table_info(clubroom_status)')}
+    for name, kind in ADDED_COLUMNS:
+        if name not in columns:
+            connection.execute('ALTER TABLE clubroom_status ADD COLUMN '
+                               '{} {}'.format(name, kind))
+    return connection
+
+
+class StateStore(threading.Thread):
+    '''Write-behind SQLite store for the channel state dicts
+
+    ``put()`` only queues the state, the thread writes everything queued
+    within ``flush_delay`` seconds of the first change in one go.
+    '''
+
+    def __init__(self, path, flush_delay: float = 1.0):
+        super().__init__(name='state-store', daemon=True)
+        self.path = path
+        self.flush_delay = flush_delay
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._stopping = False
+        # Create the database up front so errors show up in setup()
+        connect(self.path).close()
+
+    def load(self) -> dict:
+        '''Read the state of every stored channel'''
+        connection = connect(self.path)
+        try:
+            rows = connection.execute(
+                'SELECT channel, presence, status, extra, topic_updated, '
+                'status_since FROM clubroom_status').fetchall()
+        finally:
+            connection.close()
+        return {
+            channel: {
+                'presence': bool(presence),
+                'status': status,
+                'extra': extra,
+                'topic_updated': datetime.fromtimestamp(topic_updated),
+                # Unknown for rows saved before there was a column for it
+                'status_since': datetime.fromtimestamp(
+                    topic_updated if since is None else since)
+            } for channel, presence, status, extra, topic_updated, since in rows
+        }
+
+    def put(self, channel: str, data: dict):
+        '''Queue the state of channel for writing'''
+        status_since = data.get('status_since') or data['topic_updated']
+        row = (channel, int(data['presence']), data['status'], data['extra'],
+               data['topic_updated'].timestamp(), status_since.timestamp())
+        with self._condition:
+            self._pending[channel] = row
+            self._condition.notify()
+
+    def stop(self):
+        '''Flush anything queued and wait for the thread to exit'''
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        connection = connect(self.path)
+        try:
+            while True:
+                with self._condition:
+                    while not self._pending and not self._stopping:
+                        self._condition.wait()
+                    # Give the rest of the burst a chance to arrive
+                    self._condition.wait_for(
+                        lambda: self._stopping, self.flush_delay)
+                    rows = list(self._pending.values())
+                    self._pending.clear()
+                    stopping = self._stopping
+                if rows:
+                    self._flush(connection, rows)
+                if stopping:
+                    return
+        finally:
+            connection.close()
+
+    def _flush(self, connection: sqlite3.Connection, rows: list):
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO clubroom_status '
+                    '(channel, presence, status, extra, topic_updated, '
+                    'status_since) VALUES (?, ?, ?, ?, ?, ?)', rows)
+        except sqlite3.Error:
+            logger.exception('Saving %d channel states failed', len(rows))
@@ -0,0 +1,117 @@
+"""
+Status page
+
+HTML rendering of the clubroom status, the successor of the open.html and
+closed.html pages the legacy button reader copied into place. Pages are
+cached per status and extra, the common ones are rendered on import.
+
+PageWriter publishes the page as a static file for a web server to serve.
+It only writes when the page changes and replaces the file atomically, so
+readers see either the old or the new page and never half of one.
+"""
+import functools
+import logging
+import os
+import threading
+from html import escape
+from pathlib import Path
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>JMT11CD</title>
+<style>
+table#poo {{
+width: 100%;
+background-color: #f7f7ff;
+}}
+#grn {{
+color: #009933;
+}}
+#rd {{
+color: #cc0000;
+}}
+#yl {{
+color: #cc8800;
+}}
+</style>
+</head>
+<body>
+<table id="poo">
+{rows}
+</table>
+</body>
+</html>
+'''
+ROW = '''<tr>
+<td>
+<img src="cortana1.jpg" alt="Cortana" height="100px" width="100px">
+</td>
+<td>
+<b>JMT11CD:<br> <span id="{color}">{status}</span></b>{extra}</td>
+</tr>
+'''
+COLORS = {'open': 'grn', 'closed': 'rd'}
+# Statuses pages are rendered for ahead of time
+STATUSES = ['open', 'closed', 'reserved']
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=256)
+def render_row(status: str, extra: str = '') -> str:
+    return ROW.format(
+        color=COLORS.get(status, 'yl'), status=escape(status.upper()),
+        extra='<br>' + escape(extra) if extra else '')
+
+
+@functools.lru_cache(maxsize=256)
+def render_rows(rows: tuple) -> str:
+    '''Page for a tuple of (status, extra) rows'''
+    return PAGE.format(rows=''.join(
+        render_row(status, extra) for status, extra in rows))
+
+
+def render(channels: dict) -> str:
+    '''Page for {channel: {'status': ..., 'extra': ...}}'''
+    return render_rows(tuple(
+        (data['status'], data.get('extra') or '')
+        for _, data in sorted(channels.items())))
+
+
+for _status in STATUSES:
+    render_rows(((_status, ''),))
+
+
+class PageWriter:
+    '''Keep a static copy of the status page at path'''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        try:
+            # Don't rewrite an up to date page left by the previous run
+            self._written = self.path.read_bytes()
+        except OSError:
+            self._written = None
+
+    def publish(self, channels: dict) -> bool:
+        '''Write the page for channels if it changed, True if written'''
+        page = render(channels).encode('utf-8')
+        with self._lock:
+            if page == self._written:
+                return False
+            # Same directory, os.replace() can't cross file systems
+            temporary = self.path.with_name(
+                '.{}.{}.tmp'.format(self.path.name, os.getpid()))
+            try:
+                with open(temporary, 'wb') as handle:
+                    handle.write(page)
+                os.chmod(temporary, 0o644)
+                os.replace(temporary, self.path)
+            except OSError:
+                logger.exception('Publishing %s failed', self.path)
+                return False
+            self._written = page
+            return True
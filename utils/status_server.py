@@ -0,0 +1,165 @@
+"""
+Status HTTP endpoint
+
+Serves the clubroom status from memory in its own thread and event loop:
+
+    GET /status.json    JSON, {channel: {status, extra, presence, updated}}
+    GET / or /status    HTML page
+    GET /events         server-sent events, one "status" event per change
+
+Both documents are rendered once per change and carry an ETag, so a poll
+of an unchanged status is answered with an empty 304.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+
+from aiohttp import web
+
+import status_page
+
+# Seconds between keepalive comments on idle event streams
+HEARTBEAT = 15.0
+
+logger = logging.getLogger(__name__)
+
+
+class _Rendered:
+    '''Everything served for one version of the status'''
+    __slots__ = ('version', 'json', 'html', 'json_etag', 'html_etag')
+
+    def __init__(self, channels: dict):
+        self.json = json.dumps(channels, sort_keys=True).encode('utf-8')
+        self.html = status_page.render(channels).encode('utf-8')
+        self.version = hashlib.sha1(self.json).hexdigest()[:16]
+        self.json_etag = '"{}-json"'.format(self.version)
+        self.html_etag = '"{}-html"'.format(self.version)
+
+
+class StatusServer(threading.Thread):
+    '''HTTP status endpoint, ``publish()`` may be called from any thread'''
+
+    def __init__(self, port: int, host: str = '127.0.0.1'):
+        super().__init__(name='status-server', daemon=True)
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self._rendered = _Rendered({})
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._serving = threading.Event()
+        self._error = None
+
+    def start(self):
+        '''Start serving, raises if the port can't be bound'''
+        super().start()
+        self._serving.wait()
+        if self._error is not None:
+            raise self._error
+
+    def publish(self, channels: dict):
+        '''Serve a new status, does nothing if it didn't change'''
+        rendered = _Rendered(channels)
+        with self._lock:
+            if rendered.version == self._rendered.version:
+                return
+            # Readers always see either the old or the new version in full
+            self._rendered = rendered
+        if self.is_alive():
+            self.loop.call_soon_threadsafe(self._notify)
+
+    def stop(self):
+        if self.is_alive():
+            asyncio.run_coroutine_threadsafe(
+                self._shutdown(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.join()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._start())
+        except Exception as error:
+            self._error = error
+            self._serving.set()
+            self.loop.close()
+            return
+        self._serving.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def _start(self):
+        self._changed = asyncio.Condition()
+        app = web.Application()
+        app.router.add_get('/', self._html)
+        app.router.add_get('/status', self._html)
+        app.router.add_get('/status.json', self._json)
+        app.router.add_get('/events', self._events)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # Port 0 picks a free one, remember which
+        self.port = self._runner.addresses[0][1]
+
+    async def _shutdown(self):
+        # End event streams first, cleanup() waits for open requests
+        async with self._changed:
+            self._stopping = True
+            self._changed.notify_all()
+        await self._runner.cleanup()
+
+    async def _notify_changed(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    def _notify(self):
+        asyncio.ensure_future(self._notify_changed())
+
+    def _document(self, request, body: bytes, etag: str, content_type: str):
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag in request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, headers=headers,
+                            content_type=content_type, charset='utf-8')
+
+    async def _json(self, request):
+        rendered = self._rendered
+        return self._document(request, rendered.json, rendered.json_etag,
+                              'application/json')
+
+    async def _html(self, request):
+        rendered = self._rendered
+        return self._document(request, rendered.html, rendered.html_etag,
+                              'text/html')
+
+    async def _events(self, request):
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        # Resume where a reconnecting client left off
+        sent = request.headers.get('Last-Event-ID')
+        try:
+            while not self._stopping:
+                rendered = self._rendered
+                if rendered.version != sent:
+                    await response.write(
+                        b'event: status\nid: ' +
+                        rendered.version.encode('ascii') +
+                        b'\ndata: ' + rendered.json + b'\n\n')
+                    sent = rendered.version
+                async with self._changed:
+                    try:
+                        await asyncio.wait_for(self._changed.wait_for(
+                            lambda: self._stopping or
+                            self._rendered.version != sent), HEARTBEAT)
+                        continue
+                    except asyncio.TimeoutError:
+                        pass
+                await response.write(b': keepalive\n\n')
+        except ConnectionResetError:
+            pass
+        return response
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Telegram bot
+
+Python 3 port of legacy/telegram/bot.py. Updates are fetched with Telegram
+long polling over a single keep-alive HTTP session, so a message is seen as
+soon as it's sent instead of on the next 0.5 s poll. Presence changes are
+pushed by an inotify watcher on the presence file instead of checking the
+file on every loop. Replies go through the queue in telegram_outbox.py, so
+sending never holds up reading updates.
+
+Point TELEGRAM_API_URL at bench/fake_telegram.py to run it locally.
+"""
+import asyncio
+import logging
+import os
+import random
+import re
+from pathlib import Path
+
+import aiohttp
+
+from metrics import REGISTRY, start_exporter
+from presence_watcher import PresenceWatcher
+from telegram_outbox import Outbox, RateLimited
+import wordlists
+
+TOKEN = os.environ.get('TELEGRAM_TOKEN', '')
+API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+# Announcements go to the first chat with this title we hear from
+CHAT_TITLE = os.environ.get('TELEGRAM_CHAT_TITLE', 'polygame')
+PRESENCE_FILE = os.environ.get('PRESENCE_FILE', '/tmp/cortana.presence')
+METRICS_PORT = int(os.environ['METRICS_PORT']) \
+    if os.environ.get('METRICS_PORT') else None
+METRICS_FILE = os.environ.get('METRICS_FILE') or None
+# Seconds Telegram may hold a getUpdates request open
+POLL_TIMEOUT = 30
+# Seconds to wait after a failed request, doubled up to RETRY_MAX
+RETRY_MIN = 1.0
+RETRY_MAX = 60.0
+
+# Commands addressed to us, with or without a mention
+STATUS_QUERY = re.compile(
+    r'\A((@)?(cortana)(_tg_bot)?(:)?\s(status))(\?)?(:)?\Z')
+WHO_QUERY = re.compile(
+    r'\A((@)?(cortana)(_tg_bot)?(:)?\s(who)(\sare\syou)?)(\?)?(:)?\Z')
+WHO_COMMAND = re.compile(r'(/who)(@cortana_tg_bot)?')
+STATUS_COMMAND = re.compile(r'(/status)(@cortana_tg_bot)?')
+
+REQUESTS = REGISTRY.counter(
+    'cortana_telegram_requests_total', 'Bot API requests', ['method'])
+REQUEST_ERRORS = REGISTRY.counter(
+    'cortana_telegram_request_errors_total', 'Failed Bot API requests',
+    ['method'])
+UPDATES = REGISTRY.counter(
+    'cortana_telegram_updates_total', 'Updates received from Telegram')
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramError(Exception):
+    '''The Bot API answered with ok: false'''
+
+
+class TelegramBot:
+    '''Long polling Telegram bot reporting the clubroom status
+
+    ``set_presence()`` must be called from the event loop thread.
+    '''
+
+    def __init__(self, token: str, api_url: str = API_URL,
+                 chat_title: str = CHAT_TITLE, present: bool = False,
+                 poll_timeout: int = POLL_TIMEOUT):
+        self.url = '{}/bot{}/'.format(api_url.rstrip('/'), token)
+        self.chat_title = chat_title.lower()
+        self.present = present
+        self.poll_timeout = poll_timeout
+        # Used to report presence changes, first chat matching chat_title
+        self.chat_id = None
+        self.session = None
+        self.outbox = None
+        self._offset = None
+
+    async def __aenter__(self):
+        # One pooled connection for both long polls and replies
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=2,
+                                           keepalive_timeout=120),
+            timeout=aiohttp.ClientTimeout(total=self.poll_timeout + 15))
+        self.outbox = Outbox(self._send_message)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.outbox.close()
+        await self.session.close()
+
+    async def request(self, method: str, **params):
+        '''Call a Bot API method, returns its result'''
+        REQUESTS.labels(method).inc()
+        try:
+            async with self.session.post(self.url + method,
+                                         json=params) as response:
+                body = await response.json(content_type=None)
+        except Exception:
+            REQUEST_ERRORS.labels(method).inc()
+            raise
+        if not body.get('ok'):
+            REQUEST_ERRORS.labels(method).inc()
+            if body.get('error_code') == 429:
+                raise RateLimited(
+                    body.get('parameters', {}).get('retry_after', RETRY_MIN))
+            raise TelegramError('{} failed: {}'.format(
+                method, body.get('description')))
+        return body['result']
+
+    def send_message(self, chat_id, text: str):
+        '''Queue a message, delivered in the background'''
+        self.outbox.put(chat_id, text)
+
+    async def _send_message(self, chat_id, text: str):
+        await self.request('sendMessage', chat_id=chat_id, text=text)
+
+    async def run(self):
+        '''Poll for updates until cancelled'''
+        delay = RETRY_MIN
+        params = {'timeout': self.poll_timeout, 'allowed_updates': ['message']}
+        while True:
+            if self._offset is not None:
+                params['offset'] = self._offset
+            try:
+                updates = await self.request('getUpdates', **params)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.warning('Polling failed, retrying in %.0fs: %s',
+                               delay, error)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX)
+                continue
+            delay = RETRY_MIN
+            for update in updates:
+                UPDATES.inc()
+                self._offset = update['update_id'] + 1
+                try:
+                    self.process(update)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception('Update handling error: %r', update)
+
+    def process(self, update: dict):
+        '''Handle a single update'''
+        msg = update.get('message')
+        if msg is None or 'text' not in msg:
+            # Edits, inline queries and stickers are not for us
+            return
+        text = msg['text'].lower()
+        chat = msg['chat']
+        chat_id = chat['id']
+
+        if self.chat_id is None and \
+                chat.get('title', '').lower() == self.chat_title:
+            logger.info('Reporting presence changes to %s (%s)',
+                        chat['title'], chat_id)
+            self.chat_id = chat_id
+
+        # Someone replied to a message, was it for us?
+        if 'reply_to_message' in msg:
+            return
+
+        if STATUS_QUERY.search(text):
+            self.send_status(chat_id)
+            return
+        if WHO_QUERY.search(text):
+            self.send_who(chat_id)
+            return
+
+        for entity in msg.get('entities', []):
+            if entity['type'] == 'bot_command':
+                if WHO_COMMAND.search(text):
+                    self.send_who(chat_id)
+                elif STATUS_COMMAND.search(text):
+                    self.send_status(chat_id)
+                return
+
+    def send_status(self, chat_id):
+        lines = wordlists.STATUS_OPEN if self.present \
+            else wordlists.STATUS_CLOSED
+        self.send_message(chat_id, random.choice(lines))
+
+    def send_who(self, chat_id):
+        # Queued back to back, these go out as one message
+        self.send_message(chat_id, random.choice(wordlists.WHO_ARE_YOU))
+        self.send_message(chat_id, wordlists.DUTY)
+
+    def set_presence(self, present: bool):
+        '''Record a presence change and announce it'''
+        if present == self.present:
+            return
+        self.present = present
+        if self.chat_id is None:
+            return
+        lines = wordlists.OPENED if present else wordlists.CLOSED
+        self.send_message(self.chat_id, random.choice(lines))
+
+
+async def serve(presence_file: Path):
+    '''Run the bot with presence changes pushed from the presence file'''
+    loop = asyncio.get_running_loop()
+    async with TelegramBot(TOKEN) as bot:
+        watcher = PresenceWatcher(
+            presence_file.parent,
+            lambda name, present: loop.call_soon_threadsafe(
+                bot.set_presence, present),
+            match=lambda name: name == presence_file.name)
+        watcher.start()
+        # Nobody to announce to yet, this only primes the state
+        bot.set_presence(presence_file.exists())
+        try:
+            await bot.run()
+        finally:
+            watcher.stop()
+
+
+def main():
+    if not TOKEN:
+        raise SystemExit('Set TELEGRAM_TOKEN to the bot token')
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    exporter = start_exporter(METRICS_PORT, METRICS_FILE)
+    try:
+        asyncio.run(serve(Path(PRESENCE_FILE)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if exporter is not None:
+            exporter.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+Telegram outbound queue
+
+Messages are queued per chat and delivered by one task per chat, so a
+slow or rate limited chat never holds up the others or the update loop.
+Each send takes a token from the chat's bucket and from a global one,
+sized after the Bot API limits, groups getting a slower bucket than
+private chats. Whatever piled up for a chat while it waited goes out merged
+into a single message. A 429 puts the message back at the front of the
+queue and holds that chat and every other one as long as Telegram asks.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from metrics import REGISTRY
+from rate_limit import TokenBucket
+
+# Bot API limits: about one message per second in a chat, 20 per minute in
+# a group and 30 per second overall
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+GROUP_RATE = 20 / 60
+GROUP_BURST = 1
+GLOBAL_RATE = 30.0
+GLOBAL_BURST = 30
+MAX_MESSAGE_LENGTH = 4096
+# Seconds to wait after a failed send, doubled up to RETRY_MAX
+RETRY_MIN = 1.0
+RETRY_MAX = 60.0
+# Give up on a message after this many failures other than 429
+MAX_ATTEMPTS = 5
+
+SENT = REGISTRY.counter(
+    'cortana_telegram_messages_sent_total', 'Messages delivered to Telegram')
+MERGED = REGISTRY.counter(
+    'cortana_telegram_messages_merged_total',
+    'Queued messages merged into another one')
+THROTTLED = REGISTRY.counter(
+    'cortana_telegram_throttled_total', '429 responses from Telegram')
+DROPPED = REGISTRY.counter(
+    'cortana_telegram_messages_dropped_total', 'Messages given up on')
+QUEUE_SECONDS = REGISTRY.histogram(
+    'cortana_telegram_queue_seconds', 'Time from queueing to delivery')
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimited(Exception):
+    '''Raised by the send function when Telegram answers 429'''
+
+    def __init__(self, retry_after: float):
+        super().__init__('Retry after {}s'.format(retry_after))
+        self.retry_after = retry_after
+
+
+class Outbox:
+    '''Per chat message queues drained by ``send(chat_id, text)``
+
+    Must be used from a single event loop.
+    '''
+
+    def __init__(self, send: Callable[[object, str], Awaitable],
+                 chat_rate: float = CHAT_RATE, chat_burst: int = CHAT_BURST,
+                 group_rate: float = GROUP_RATE,
+                 group_burst: int = GROUP_BURST,
+                 global_rate: float = GLOBAL_RATE,
+                 global_burst: int = GLOBAL_BURST):
+        self.send = send
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.bucket = TokenBucket(global_rate, global_burst)
+        self._queues = {}
+        self._buckets = {}
+        self._tasks = {}
+
+    def put(self, chat_id, text: str):
+        '''Queue a message, never blocks'''
+        queue = self._queues.setdefault(chat_id, deque())
+        queue.append((time.monotonic(), text))
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.ensure_future(
+                self._deliver(chat_id))
+
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def close(self, timeout: float = 5.0):
+        '''Try to deliver what's queued, then drop the rest'''
+        tasks = list(self._tasks.values())
+        if tasks:
+            _, late = await asyncio.wait(tasks, timeout=timeout)
+            for task in late:
+                task.cancel()
+            if late:
+                logger.warning('Dropped %d queued messages on close',
+                               self.pending())
+        self._queues.clear()
+
+    async def _acquire(self, bucket: TokenBucket):
+        while True:
+            delay = bucket.delay()
+            if not delay:
+                bucket.take()
+                return
+            await asyncio.sleep(delay)
+
+    def _merge(self, queue: deque):
+        '''Pop as many queued messages as fit into one'''
+        queued_at, text = queue.popleft()
+        while queue and len(text) + 1 + len(queue[0][1]) <= \
+                MAX_MESSAGE_LENGTH:
+            text += '\n' + queue.popleft()[1]
+            MERGED.inc()
+        return queued_at, text
+
+    async def _deliver(self, chat_id):
+        queue = self._queues[chat_id]
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Group and channel ids are negative, users' positive
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._buckets[chat_id] = bucket
+        try:
+            await self._drain(chat_id, queue, bucket)
+        finally:
+            # Before returning, so put() starts a new task from now on
+            del self._tasks[chat_id]
+            if not queue:
+                self._queues.pop(chat_id, None)
+
+    async def _drain(self, chat_id, queue: deque, bucket: TokenBucket):
+        attempts = 0
+        delay = RETRY_MIN
+        while queue:
+            await self._acquire(bucket)
+            await self._acquire(self.bucket)
+            # Anything queued while we waited goes out in one message
+            queued_at, text = self._merge(queue)
+            try:
+                await self.send(chat_id, text)
+            except RateLimited as error:
+                THROTTLED.inc()
+                logger.info('Throttled in %s for %.0fs', chat_id,
+                            error.retry_after)
+                # The wait applies to the whole bot, not just this chat
+                bucket.pause(error.retry_after)
+                self.bucket.pause(error.retry_after)
+                queue.appendleft((queued_at, text))
+                continue
+            except Exception:
+                attempts += 1
+                if attempts >= MAX_ATTEMPTS:
+                    logger.exception('Dropping message to %s', chat_id)
+                    DROPPED.inc()
+                    attempts = 0
+                    delay = RETRY_MIN
+                    continue
+                logger.warning('Sending to %s failed, retrying in %.0fs',
+                               chat_id, delay, exc_info=True)
+                queue.appendleft((queued_at, text))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX)
+                continue
+            SENT.inc()
+            QUEUE_SECONDS.observe(time.monotonic() - queued_at)
+            attempts = 0
+            delay = RETRY_MIN
@@ -0,0 +1,149 @@
+"""
+Topic write queue
+
+Coalesces topic changes per channel so a burst of status toggles turns into
+a single TOPIC write, and nothing is written if the server already has the
+topic we want.
+"""
+import logging
+import threading
+import time
+from typing import Callable
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+WRITES = REGISTRY.counter(
+    'cortana_topic_writes_total', 'TOPIC writes sent to the server')
+SKIPPED = REGISTRY.counter(
+    'cortana_topic_writes_skipped_total',
+    'Due topic writes skipped because the server has or will have the topic')
+ECHO_TIMEOUTS = REGISTRY.counter(
+    'cortana_topic_echo_timeouts_total', 'TOPIC writes never echoed back')
+ECHO_LATENCY = REGISTRY.histogram(
+    'cortana_topic_echo_seconds', 'Time from TOPIC write to its echo')
+
+
+class _ChannelTopic:
+    '''Write state of a single channel'''
+    __slots__ = ('desired', 'confirmed', 'in_flight', 'sent_at',
+                 'last_write', 'due')
+
+    def __init__(self):
+        self.desired = None
+        self.confirmed = None
+        self.in_flight = None
+        self.sent_at = 0.0
+        self.last_write = float('-inf')
+        self.due = None
+
+
+class TopicWriter(threading.Thread):
+    '''Background thread writing channel topics through ``send``
+
+    ``submit()`` asks for a topic, the write happens once no new topic has
+    been asked for ``debounce`` seconds, at most once per ``min_interval``
+    seconds per channel. ``confirm()`` should be called with whatever topic
+    the server reports. Writes matching the confirmed topic or one still in
+    flight are skipped; a write not echoed within ``echo_timeout`` seconds
+    stops counting as in flight.
+    '''
+
+    def __init__(self, send: Callable[[str, str], None], debounce: float = 0.5,
+                 min_interval: float = 3.0, echo_timeout: float = 30.0):
+        super().__init__(name='topic-writer', daemon=True)
+        self.send = send
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.echo_timeout = echo_timeout
+        self._channels = {}
+        self._condition = threading.Condition()
+        self._stopping = False
+
+    def _channel(self, channel: str) -> _ChannelTopic:
+        '''Get write state for channel, caller locks'''
+        state = self._channels.get(channel)
+        if state is None:
+            state = self._channels[channel] = _ChannelTopic()
+        return state
+
+    def submit(self, channel: str, topic: str):
+        '''Ask for channel topic to be set'''
+        with self._condition:
+            state = self._channel(channel)
+            state.desired = topic
+            state.due = max(time.monotonic() + self.debounce,
+                            state.last_write + self.min_interval)
+            self._condition.notify()
+
+    def confirm(self, channel: str, topic: str):
+        '''Record the topic the server reported for channel'''
+        with self._condition:
+            state = self._channel(channel)
+            state.confirmed = topic
+            if state.in_flight == topic:
+                latency = time.monotonic() - state.sent_at
+                ECHO_LATENCY.observe(latency)
+                logger.debug('Topic for %s echoed back in %.3fs', channel,
+                             latency)
+                state.in_flight = None
+                if state.desired != topic and state.due is None:
+                    # Asked for something else while this was in flight
+                    state.due = state.last_write + self.min_interval
+                    self._condition.notify()
+
+    def stop(self):
+        '''Drop anything queued and wait for the thread to exit'''
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while True:
+            with self._condition:
+                writes = self._collect()
+                if self._stopping:
+                    return
+                if not writes:
+                    self._condition.wait(self._timeout())
+                    continue
+            # Don't hold the lock while talking to the server
+            for channel, topic in writes:
+                WRITES.inc()
+                try:
+                    self.send(channel, topic)
+                except Exception:
+                    logger.exception('Writing topic for %s failed', channel)
+
+    def _timeout(self):
+        '''Seconds until the next write is due, caller locks'''
+        dues = [state.due for state in self._channels.values()
+                if state.due is not None]
+        if not dues:
+            return None
+        return max(0.0, min(dues) - time.monotonic())
+
+    def _collect(self):
+        '''Pick up writes that are due, caller locks'''
+        now = time.monotonic()
+        writes = []
+        for channel, state in self._channels.items():
+            if state.due is None or state.due > now:
+                continue
+            state.due = None
+            if state.in_flight is not None and \
+                    now - state.sent_at > self.echo_timeout:
+                logger.warning('Topic for %s was never echoed back', channel)
+                ECHO_TIMEOUTS.inc()
+                state.in_flight = None
+            if state.desired in (state.confirmed, state.in_flight):
+                # Server already has it or will have it shortly
+                SKIPPED.inc()
+                continue
+            state.in_flight = state.desired
+            state.sent_at = state.last_write = now
+            writes.append((channel, state.desired))
+        return writes
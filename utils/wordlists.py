@@ -0,0 +1,95 @@
+"""
+Word lists
+
+Lines Cortana picks from at random, carried over from the legacy bots.
+"""
+
+# Answer to "who are you?"
+WHO_ARE_YOU = [
+    "A collection of lies; that's all I am! Stolen thoughts and memories!",
+    "I am Cortana, UNSC Artificial Intelligence (SN: CTN 0452-9)",
+    "This is UNSC A.I. Serial Number CTN0452-9. "
+    "I am a monument to all your sins.",
+]
+DUTY = 'It is my duty to monitor and report on the JMT11CD Clubroom status.'
+
+# Something to say when the clubroom is opened
+OPENED = [
+    "I've got a friendly contact! "
+    "But who would be crazy enough to come in here?",
+    "I'm picking up movement in the clubroom!",
+    "I'm picking up unknown energy signatures in the clubroom.",
+    "Activity detected in the clubroom!",
+    "Contacts in the clubroom!",
+    "System activation detected!",
+    "Sensors indicate presence of lifeforms in the clubroom.",
+]
+
+# Something to say when the clubroom is closed
+CLOSED = [
+    "It appears everyone is evacuating the room.",
+    "Whatever was going on in the clubroom, it appears to have ended.",
+    "The players have left the building.",
+    "Activity in clubroom has ended.",
+    "Everyone left. Clubroom empty.",
+]
+
+# Answer to a status query when open
+STATUS_OPEN = [
+    "The clubroom is currently open!",
+    "There appears to be activity in the clubroom.",
+    "As far as I know, there should be people present in the clubroom.",
+    "Latest intel indicate activity in the area!",
+    "My systems say the room is active.",
+]
+
+# Answer to a status query when closed
+STATUS_CLOSED = [
+    "There appears to be nothing going on in the clubroom.",
+    "It appears everyone has evacuated.",
+    "Scanning... Just ... dust and echoes.",
+    "The clubroom is closed.",
+    "No allied signals detected in the clubroom.",
+    "No one there.",
+    "Looks abandoned.",
+    "No intelligent life detected.",
+    "Nothing is happening in the clubroom.",
+]
+
+# Answer to a status change containing a banned word
+STUPID_TOPIC = [
+    "Well, someone's overcompensating.",
+    "You sure that's a good idea?",
+    "You did that on purpose, didn't you?",
+    "And people say I've got a big head.",
+    "This is the way the world ends...",
+    "I don't think so...",
+    "Huh.",
+    "Ok...",
+    "This can't be right.",
+    "Wait. Something's not right.",
+    "You do your job, and I'll do mine, ok?",
+    "I don't know about you, but I usually like a little more 'intel' "
+    "with my intel...",
+    "I can't believe he did that.",
+    "What are you talking about?",
+    "I know what you're thinking, and it's crazy.",
+    "I wish I had more time to decipher these inscriptions.",
+    "Wait, what's that?",
+]
+
+# Answer to a banned user
+NOT_ALLOWED = [
+    "You are not authorized to do that.",
+]
+
+# Reminder that the clubroom has been open for {hours} hours
+STALE_OPEN = [
+    "The clubroom has been open for {hours} hours. Did someone forget "
+    "to close it?",
+    "{hours} hours and the clubroom is still open. Is anyone there?",
+]
+
+# Defaults for the banned_words and banned_users settings
+BANNED_WORDS = ["HITLER", "TISSIT"]
+BANNED_USERS = ["KALADESU"]